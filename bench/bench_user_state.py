@@ -0,0 +1,105 @@
+"""
+Memory held by user_data for many synthetic users.
+
+    python bench/bench_user_state.py [users]
+
+Each user sends one update that sets a little user_data. Compares PTB's plain
+in-memory dict ("before") with UserStatePersistence on a scratch database
+("after"), measured with tracemalloc. USER_STATE_MAX_RESIDENT and the
+group-commit settings are read from the environment like the bot does.
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+os.environ.setdefault("BOT_TOKEN", "123:bench")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+_TMP = tempfile.mkdtemp(prefix="shop-bench-")
+os.environ["DATABASE_PATH"] = os.path.join(_TMP, "shop.db")
+os.environ["SESSION_DIR"] = os.path.join(_TMP, "sessions")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiosqlite  # noqa: E402
+from telegram.ext import ApplicationBuilder  # noqa: E402
+
+import main  # noqa: E402
+from main import CONFIG  # noqa: E402
+
+
+async def bench_user_state(users: int):
+    """{"before"|"after": {bytes, resident, elapsed}}."""
+    state = {"menu": "countries", "last_country": "US", "page": 0}
+    chunk = 1000
+    results = {}
+    tracemalloc.start()
+    try:
+        started = time.monotonic()
+        base = tracemalloc.get_traced_memory()[0]
+        plain = defaultdict(dict)
+        for uid in range(1, users + 1):
+            plain[uid].update(state, page=uid % 5)
+        results["before"] = {
+            "bytes": tracemalloc.get_traced_memory()[0] - base,
+            "resident": len(plain),
+            "elapsed": time.monotonic() - started,
+        }
+        del plain
+
+        path = os.path.join(_TMP, "bench_user_state.db")
+        async with aiosqlite.connect(path) as db:
+            await db.executescript(main.SCHEMA_SQL)
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.commit()
+        repo = main.SqliteRepository(
+            path,
+            main.SqliteWriter(path, CONFIG["GROUP_COMMIT_MAX_OPS"],
+                              CONFIG["GROUP_COMMIT_MAX_DELAY_MS"],
+                              CONFIG["WRITE_DURABILITY"]))
+        await repo.init()
+        persistence = main.make_user_state_persistence(repo)
+        app = ApplicationBuilder().token("0:bench").persistence(
+            persistence).build()
+        persistence.application = app
+        started = time.monotonic()
+        base = tracemalloc.get_traced_memory()[0]
+        for first in range(1, users + 1, chunk):
+            ids = range(first, min(first + chunk, users + 1))
+            # what Application.process_update does for each update
+            await asyncio.gather(*(persistence.refresh_user_data(
+                uid, app.user_data[uid]) for uid in ids))
+            for uid in ids:
+                app.user_data[uid].update(state, page=uid % 5)
+            app.mark_data_for_update_persistence(user_ids=ids)
+            await app.update_persistence()
+        await persistence.flush()
+        results["after"] = {
+            "bytes": tracemalloc.get_traced_memory()[0] - base,
+            "resident": len(app.user_data),
+            "elapsed": time.monotonic() - started,
+        }
+        await repo.close()
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def cli():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    try:
+        results = asyncio.run(bench_user_state(users))
+    finally:
+        shutil.rmtree(_TMP, ignore_errors=True)
+    print(f"{users} users, max resident {CONFIG['USER_STATE_MAX_RESIDENT']}")
+    for mode, r in results.items():
+        print(f"{mode}: {r['bytes'] / 2**20:.1f} MB for {r['resident']} "
+              f"users in memory ({r['elapsed']:.1f}s)")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,82 @@
+"""
+Write throughput of the SQLite repository with group commit off and on.
+
+    python bench/bench_writes.py [ops] [concurrency]
+
+Each run issues `ops` balance updates, `concurrency` at a time, against a
+scratch copy of the schema; GROUP_COMMIT_MAX_OPS, GROUP_COMMIT_MAX_DELAY_MS
+and WRITE_DURABILITY are read from the environment like the bot does.
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123:bench")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+_TMP = tempfile.mkdtemp(prefix="shop-bench-")
+os.environ["DATABASE_PATH"] = os.path.join(_TMP, "shop.db")
+os.environ["SESSION_DIR"] = os.path.join(_TMP, "sessions")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiosqlite  # noqa: E402
+
+import main  # noqa: E402
+from main import CONFIG  # noqa: E402
+
+
+async def bench_writes(ops: int, concurrency: int):
+    """{mode: {elapsed, writes_per_sec, commits_per_sec}} for mode off/on."""
+    results = {}
+    for mode in ("off", "on"):
+        path = os.path.join(_TMP, f"bench_{mode}.db")
+        async with aiosqlite.connect(path) as db:
+            await db.executescript(main.SCHEMA_SQL)
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.executemany("INSERT INTO users (id) VALUES (?)",
+                                 [(i, ) for i in range(concurrency)])
+            await db.commit()
+        writer = None
+        if mode == "on":
+            writer = main.SqliteWriter(path, CONFIG["GROUP_COMMIT_MAX_OPS"],
+                                       CONFIG["GROUP_COMMIT_MAX_DELAY_MS"],
+                                       CONFIG["WRITE_DURABILITY"])
+        repo = main.SqliteRepository(path, writer)
+        await repo.init()
+        started = time.monotonic()
+        done = 0
+        while done < ops:
+            n = min(concurrency, ops - done)
+            await asyncio.gather(*(repo.adjust_balance(i, 1.0, "bench")
+                                   for i in range(n)))
+            done += n
+        elapsed = time.monotonic() - started
+        commits = writer.commits if writer else ops
+        await repo.close()
+        results[mode] = {
+            "elapsed": elapsed,
+            "writes_per_sec": ops / elapsed,
+            "commits_per_sec": commits / elapsed,
+        }
+    return results
+
+
+def cli():
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    try:
+        results = asyncio.run(bench_writes(ops, concurrency))
+    finally:
+        shutil.rmtree(_TMP, ignore_errors=True)
+    print(f"{ops} writes, {concurrency} concurrent, "
+          f"durability {CONFIG['WRITE_DURABILITY']}")
+    for mode, r in results.items():
+        print(f"group commit {mode}: {r['writes_per_sec']:.0f} writes/s, "
+              f"{r['commits_per_sec']:.0f} commits/s ({r['elapsed']:.2f}s)")
+
+
+if __name__ == "__main__":
+    cli()
@@ -7,22 +7,52 @@ Author: adapted for Ajay
 import os
 import json
 import asyncio
+import bisect
+import contextvars
+import csv
+import gzip
+import io
+import itertools
 import logging
+import multiprocessing
+import multiprocessing.connection as mp_connection
 import re
+import threading
+import time
+import math
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import traceback
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
 from typing import Optional, Dict, List
 
 import aiosqlite
 from zoneinfo import ZoneInfo
+
+try:
+    import asyncpg  # only needed with STORAGE_BACKEND=postgres
+except ImportError:
+    asyncpg = None
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import (ApplicationBuilder, ContextTypes, CommandHandler,
-                          CallbackQueryHandler, MessageHandler, filters)
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import (ApplicationBuilder, ApplicationHandlerStop,
+                          BasePersistence, BaseRateLimiter, ContextTypes,
+                          CommandHandler, CallbackQueryHandler,
+                          MessageHandler, PersistenceInput, TypeHandler,
+                          filters)
 from telegram.request import HTTPXRequest
 
 from telethon import TelegramClient, events
+from telethon.sessions import SQLiteSession, StringSession
 from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, PhoneNumberInvalidError
+from telethon.errors.rpcbaseerrors import FloodError
 
 # ============================
 # CONFIG — set your values here
@@ -39,8 +69,9 @@ def get_required_env(key: str) -> str:
 
 
 CONFIG = {
+    # required unless every tenant in TENANTS_FILE has its own bot_token
     "BOT_TOKEN":
-    get_required_env("BOT_TOKEN"),
+    os.getenv("BOT_TOKEN"),
     "API_ID":
     int(get_required_env("API_ID")),
     "API_HASH":
@@ -58,8 +89,135 @@ CONFIG = {
     int(os.getenv("FORCE_JOIN_CHAT_ID", "-1002731834108")),
     "DATABASE_PATH":
     os.getenv("DATABASE_PATH", "shop.db"),
+    # JSON list of bots served by this process (see load_tenants); unset = one
+    # bot configured by the variables here
+    "TENANTS_FILE":
+    os.getenv("TENANTS_FILE", ""),
+    # "sqlite" (DATABASE_PATH) or "postgres" (DATABASE_URL, shared by several instances)
+    "STORAGE_BACKEND":
+    os.getenv("STORAGE_BACKEND", "sqlite"),
+    "DATABASE_URL":
+    os.getenv("DATABASE_URL", ""),
+    "PG_POOL_SIZE":
+    int(os.getenv("PG_POOL_SIZE", "10")),
+    # SQLite group commit: one writer task batches writes into shared transactions
+    "GROUP_COMMIT":
+    os.getenv("GROUP_COMMIT", "1") == "1",
+    "GROUP_COMMIT_MAX_OPS":
+    int(os.getenv("GROUP_COMMIT_MAX_OPS", "64")),
+    "GROUP_COMMIT_MAX_DELAY_MS":
+    float(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", "2")),
+    # "full": fsync every commit; "normal": WAL without fsync per commit (faster,
+    # the last commits can be lost on power failure but the DB stays consistent)
+    "WRITE_DURABILITY":
+    os.getenv("WRITE_DURABILITY", "full"),
     "SESSION_DIR":
     os.getenv("SESSION_DIR", "sessions"),
+    # "db": StringSession blobs in the sessions table, "file": one .session file per account
+    "SESSION_BACKEND":
+    os.getenv("SESSION_BACKEND", "db"),
+    "SESSION_CACHE_SIZE":
+    int(os.getenv("SESSION_CACHE_SIZE", "2048")),
+    "USERNAME_CACHE_SIZE":
+    int(os.getenv("USERNAME_CACHE_SIZE", "10000")),
+    # context.user_data is kept in the user_state table: written behind every
+    # USER_STATE_FLUSH_SECONDS, dropped from memory after USER_STATE_IDLE_MINUTES
+    # without updates (or beyond USER_STATE_MAX_RESIDENT users) and loaded
+    # again on the user's next update
+    "USER_STATE_FLUSH_SECONDS":
+    float(os.getenv("USER_STATE_FLUSH_SECONDS", "10")),
+    "USER_STATE_IDLE_MINUTES":
+    float(os.getenv("USER_STATE_IDLE_MINUTES", "30")),
+    "USER_STATE_MAX_RESIDENT":
+    int(os.getenv("USER_STATE_MAX_RESIDENT", "20000")),
+    # /dashboard is re-rendered at most this often, and edited only when it changed
+    "DASHBOARD_INTERVAL_SECONDS":
+    float(os.getenv("DASHBOARD_INTERVAL_SECONDS", "15")),
+    # event loop watchdog: lag is sampled every LOOP_LAG_INTERVAL_MS; a loop
+    # blocked for LOOP_LAG_THRESHOLD_MS gets its stack logged. LOOP_DEBUG=1
+    # turns on asyncio debug mode (slow callback reports; costly, debugging only)
+    "LOOP_LAG_INTERVAL_MS":
+    float(os.getenv("LOOP_LAG_INTERVAL_MS", "100")),
+    "LOOP_LAG_THRESHOLD_MS":
+    float(os.getenv("LOOP_LAG_THRESHOLD_MS", "250")),
+    "LOOP_DEBUG":
+    os.getenv("LOOP_DEBUG", "0") == "1",
+    "LOOP_SLOW_CALLBACK_MS":
+    float(os.getenv("LOOP_SLOW_CALLBACK_MS", "100")),
+    "BULK_BALANCE_MAX_ROWS":
+    int(os.getenv("BULK_BALANCE_MAX_ROWS", "5000")),
+    # /export splits its gzip output into documents of at most this size
+    # (the Bot API upload limit is 50 MB)
+    "EXPORT_PART_MB":
+    int(os.getenv("EXPORT_PART_MB", "45")),
+    # transactions older than this are folded into transaction_totals and
+    # moved to gzip NDJSON files in ARCHIVE_DIR (0 disables the scheduled run)
+    "ARCHIVE_AFTER_DAYS":
+    int(os.getenv("ARCHIVE_AFTER_DAYS", "90")),
+    "ARCHIVE_DIR":
+    os.getenv("ARCHIVE_DIR", "archive"),
+    "ARCHIVE_BATCH":
+    int(os.getenv("ARCHIVE_BATCH", "5000")),
+    # online snapshots of DATABASE_PATH plus ANALYZE / checkpoint / vacuum
+    # (0 hours disables the scheduled run; /backup still works)
+    "BACKUP_INTERVAL_HOURS":
+    float(os.getenv("BACKUP_INTERVAL_HOURS", "6")),
+    "BACKUP_DIR":
+    os.getenv("BACKUP_DIR", "backups"),
+    "BACKUP_KEEP":
+    int(os.getenv("BACKUP_KEEP", "8")),
+    "BACKUP_KEEP_DAILY":
+    int(os.getenv("BACKUP_KEEP_DAILY", "7")),
+    "BACKUP_PAGES_PER_STEP":
+    int(os.getenv("BACKUP_PAGES_PER_STEP", "256")),
+    "BACKUP_STEP_SLEEP_MS":
+    int(os.getenv("BACKUP_STEP_SLEEP_MS", "10")),
+    "VACUUM_PAGES_PER_RUN":
+    int(os.getenv("VACUUM_PAGES_PER_RUN", "2000")),
+    # restock events per country are collected this long before waiters are messaged
+    "WAITLIST_BATCH_SECONDS":
+    float(os.getenv("WAITLIST_BATCH_SECONDS", "5")),
+    # admission control: concurrent Telethon clients and the waiting-queue size
+    # at which new purchases are refused
+    "TELETHON_MAX_CLIENTS":
+    int(os.getenv("TELETHON_MAX_CLIENTS", "50")),
+    "QUEUE_SHED_THRESHOLD":
+    int(os.getenv("QUEUE_SHED_THRESHOLD", "100")),
+    # Telethon circuit breakers: a session is held back after a FloodWait (for
+    # the time Telegram asks) or after BREAKER_FAILURES consecutive failures
+    # (BREAKER_BASE_SECONDS, doubling up to BREAKER_MAX_SECONDS); every session
+    # is held back when BREAKER_GLOBAL_FAILURES failures land within the window
+    "BREAKER_FAILURES":
+    int(os.getenv("BREAKER_FAILURES", "3")),
+    "BREAKER_BASE_SECONDS":
+    float(os.getenv("BREAKER_BASE_SECONDS", "30")),
+    "BREAKER_MAX_SECONDS":
+    float(os.getenv("BREAKER_MAX_SECONDS", "3600")),
+    "BREAKER_GLOBAL_FAILURES":
+    int(os.getenv("BREAKER_GLOBAL_FAILURES", "20")),
+    "BREAKER_GLOBAL_WINDOW_SECONDS":
+    float(os.getenv("BREAKER_GLOBAL_WINDOW_SECONDS", "60")),
+    "BREAKER_GLOBAL_COOLDOWN_SECONDS":
+    float(os.getenv("BREAKER_GLOBAL_COOLDOWN_SECONDS", "120")),
+    # >0 runs OTP monitoring in that many separate worker processes
+    "OTP_WORKERS":
+    int(os.getenv("OTP_WORKERS", "0")),
+    # abandoned admin uploads are cancelled after this many idle minutes
+    "UPLOAD_TIMEOUT_MINUTES":
+    int(os.getenv("UPLOAD_TIMEOUT_MINUTES", "15")),
+    # background session health sweeper
+    "SWEEP_INTERVAL_MINUTES":
+    int(os.getenv("SWEEP_INTERVAL_MINUTES", "30")),
+    "SWEEP_BATCH_SIZE":
+    int(os.getenv("SWEEP_BATCH_SIZE", "200")),
+    "SWEEP_CONCURRENCY":
+    int(os.getenv("SWEEP_CONCURRENCY", "5")),
+    "SWEEP_JITTER_SECONDS":
+    float(os.getenv("SWEEP_JITTER_SECONDS", "2.0")),
+    "SWEEP_RECHECK_HOURS":
+    float(os.getenv("SWEEP_RECHECK_HOURS", "6")),
+    "SWEEP_CHECK_TIMEOUT":
+    float(os.getenv("SWEEP_CHECK_TIMEOUT", "30")),
     "COUNTRY_PRICES": {
         "US": 40.0,
         "ET": 35.0,
@@ -85,6 +243,29 @@ CONFIG = {
     float(os.getenv("HTTP_WRITE_TIMEOUT", "60.0")),
     "HTTP_POOL_TIMEOUT":
     float(os.getenv("HTTP_POOL_TIMEOUT", "10.0")),
+    # flood control: token buckets per user (rate = tokens/second, burst = bucket size)
+    "FLOOD_UI_RATE":
+    float(os.getenv("FLOOD_UI_RATE", "1.0")),
+    "FLOOD_UI_BURST":
+    int(os.getenv("FLOOD_UI_BURST", "8")),
+    "FLOOD_HEAVY_RATE":
+    float(os.getenv("FLOOD_HEAVY_RATE", "0.1")),
+    "FLOOD_HEAVY_BURST":
+    int(os.getenv("FLOOD_HEAVY_BURST", "3")),
+    "FLOOD_MAX_TRACKED_USERS":
+    int(os.getenv("FLOOD_MAX_TRACKED_USERS", "50000")),
+    # outbound Bot API scheduler: global messages/second, per-chat buckets
+    "OUTBOUND_GLOBAL_RATE":
+    float(os.getenv("OUTBOUND_GLOBAL_RATE", "30")),
+    "OUTBOUND_CHAT_RATE":
+    float(os.getenv("OUTBOUND_CHAT_RATE", "1.0")),
+    "OUTBOUND_CHAT_BURST":
+    int(os.getenv("OUTBOUND_CHAT_BURST", "3")),
+    "OUTBOUND_GROUP_PER_MINUTE":
+    int(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20")),
+    # OTP delivery latency traces kept for /latency
+    "OTP_TRACE_RETENTION_DAYS":
+    int(os.getenv("OTP_TRACE_RETENTION_DAYS", "30")),
 }
 # ============================
 
@@ -102,9 +283,151 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("telegram").setLevel(logging.WARNING)
 logging.getLogger("telegram.ext").setLevel(logging.INFO)
 
-# In-memory state for interactive admin upload sign-in
-# PENDING_UPLOADS[admin_id] = { phone, phone_code_hash, session_fname, country, step }
-PENDING_UPLOADS: Dict[int, Dict] = {}
+# ---------- Tenants (several bots in one process) ----------
+# Settings a tenant can override in TENANTS_FILE (lower-case keys there);
+# everything else in CONFIG is process-wide: the event loop, the PostgreSQL
+# pool, Telethon capacity, OTP workers and the outbound scheduler are shared.
+TENANT_KEYS = ("BOT_TOKEN", "ADMIN_IDS", "FORCE_JOIN_USERNAME",
+               "FORCE_JOIN_CHAT_ID", "COUNTRY_PRICES", "OWNER_HANDLE",
+               "DEVELOPER_CREDITS")
+TENANT_NAME_RE = re.compile(r"^[a-z0-9_]{1,32}$")
+# account and upload ids of a tenant start at slot * TENANT_ID_SPAN, so the
+# in-memory registries keyed by them (monitors, OTP workers, upload clients)
+# stay shared without mixing tenants up
+TENANT_ID_SPAN = 10**9
+
+
+class Tenant:
+    """
+    One bot hosted by this process: its token and shop settings, its own
+    partition of the data (a SQLite file, or a PostgreSQL schema in the shared
+    pool) and counters of the shared resources it uses.
+    """
+
+    def __init__(self, name: str, slot: int, config: Dict, db_path: str,
+                 pg_schema: Optional[str]):
+        self.name = name
+        self.slot = slot
+        self.config = config
+        self.db_path = db_path
+        self.pg_schema = pg_schema
+        self.session_dir = (SESSION_DIR if slot == 0 else os.path.join(
+            SESSION_DIR, name))
+        self.archive_dir = (CONFIG["ARCHIVE_DIR"] if slot == 0 else
+                            os.path.join(CONFIG["ARCHIVE_DIR"], name))
+        self.repo = None  # set below, once the repository classes exist
+        self.app = None  # set by main()
+        self.dashboard = None  # set by build_application()
+        self.archive_stats = {"runs": 0, "archived": 0, "last_run": None,
+                              "last_error": None}
+        self.maintenance_report = {"at": None, "steps": [], "error": None}
+        self.sweep_report: Dict = {}
+        self.usage = {"updates": 0, "throttled": 0, "telethon_seconds": 0.0}
+
+    @property
+    def id_base(self) -> int:
+        return self.slot * TENANT_ID_SPAN
+
+    @property
+    def bot_key(self) -> str:
+        """The bot id part of the token; identifies the bot in the outbound scheduler."""
+        return self.config["BOT_TOKEN"].split(":", 1)[0]
+
+
+def load_tenants() -> List[Tenant]:
+    """
+    TENANTS_FILE holds a JSON list like
+    [{"name": "main"}, {"name": "shop2", "bot_token": "...", "admin_ids": [1],
+      "force_join_username": "@x", "force_join_chat_id": -100..,
+      "country_prices": {"US": 45.0}}]
+    Missing keys fall back to CONFIG. "slot" (default: position in the list)
+    picks the id range and must not change once a tenant has data; slot 0
+    keeps DATABASE_PATH and the public schema, other slots get
+    <DATABASE_PATH stem>_<name>.db (or "database_path") and schema tenant_<name>.
+    """
+    entries = [{}]
+    if CONFIG["TENANTS_FILE"]:
+        with open(CONFIG["TENANTS_FILE"], encoding="utf-8") as f:
+            entries = json.load(f)
+        if not isinstance(entries, list) or not entries:
+            raise ValueError("TENANTS_FILE must hold a non-empty JSON list")
+    stem, ext = os.path.splitext(DB_PATH)
+    tenants = []
+    for position, entry in enumerate(entries):
+        name = str(entry.get("name") or ("default" if position == 0 else ""))
+        if not TENANT_NAME_RE.match(name):
+            raise ValueError(
+                f"Invalid tenant name {name!r} (use a-z, 0-9 and _)")
+        slot = int(entry.get("slot", position))
+        config = {key: entry.get(key.lower(), CONFIG[key]) for key in TENANT_KEYS}
+        if not config["BOT_TOKEN"]:
+            raise ValueError(
+                f"Tenant {name!r} has no bot_token and the 'BOT_TOKEN' environment variable is not set. Please add it to Replit Secrets."
+            )
+        config["ADMIN_IDS"] = [int(x) for x in config["ADMIN_IDS"]]
+        config["FORCE_JOIN_CHAT_ID"] = int(config["FORCE_JOIN_CHAT_ID"])
+        db_path = entry.get("database_path") or (
+            DB_PATH if slot == 0 else f"{stem}_{name}{ext or '.db'}")
+        tenants.append(
+            Tenant(name, slot, config, db_path,
+                   None if slot == 0 else f"tenant_{name}"))
+    for attr in ("name", "slot", "bot_key", "db_path"):
+        if len({getattr(t, attr) for t in tenants}) != len(tenants):
+            raise ValueError(f"Tenants need distinct values of {attr}")
+    return tenants
+
+
+TENANTS = load_tenants()
+# bound per update (bind_tenant) and per scheduler job (for_each_tenant);
+# code running outside both, as in a single-bot setup, sees the first tenant
+CURRENT_TENANT: "contextvars.ContextVar[Tenant]" = contextvars.ContextVar(
+    "tenant")
+
+
+def current_tenant() -> Tenant:
+    return CURRENT_TENANT.get(TENANTS[0])
+
+
+def tenant_config(key: str):
+    """A TENANT_KEYS setting of the current tenant."""
+    return current_tenant().config[key]
+
+
+@contextmanager
+def use_tenant(tenant: Tenant):
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        yield tenant
+    finally:
+        CURRENT_TENANT.reset(token)
+
+
+def for_each_tenant(job):
+    """Wrap a scheduler job so it runs once per tenant, with that tenant bound."""
+
+    async def _run():
+        for tenant in TENANTS:
+            with use_tenant(tenant):
+                try:
+                    await job()
+                except Exception:
+                    logger.exception("%s failed for tenant %s", job.__name__,
+                                     tenant.name)
+
+    _run.__name__ = job.__name__
+    return _run
+
+
+async def bind_tenant(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs in handler group -2, before everything else: binds the tenant of the
+    application that received the update, for all later handlers and the
+    tasks they start.
+    """
+    tenant = context.application.bot_data["tenant"]
+    CURRENT_TENANT.set(tenant)
+    tenant.usage["updates"] += 1
+
 
 # ---------- Schema ----------
 SCHEMA_SQL = """
@@ -114,6 +437,7 @@ CREATE TABLE IF NOT EXISTS users (
   id INTEGER PRIMARY KEY,
   username TEXT,
   balance REAL DEFAULT 0,
+  last_country TEXT,
   created_at TEXT DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -135,7 +459,10 @@ CREATE TABLE IF NOT EXISTS accounts (
   status TEXT NOT NULL DEFAULT 'available',
   price REAL,
   metadata TEXT,
-  created_at TEXT DEFAULT CURRENT_TIMESTAMP
+  created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+  last_checked_at TEXT,
+  last_check_result TEXT,
+  cooldown_until TEXT
 );
 
 CREATE TABLE IF NOT EXISTS transactions (
@@ -144,6 +471,7 @@ CREATE TABLE IF NOT EXISTS transactions (
   account_id INTEGER,
   amount REAL,
   type TEXT,
+  note TEXT,
   created_at TEXT DEFAULT CURRENT_TIMESTAMP,
   FOREIGN KEY(user_id) REFERENCES users(id),
   FOREIGN KEY(account_id) REFERENCES accounts(id)
@@ -153,6 +481,91 @@ CREATE TABLE IF NOT EXISTS settings (
   key TEXT PRIMARY KEY,
   value TEXT
 );
+
+CREATE TABLE IF NOT EXISTS uploads (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  admin_id INTEGER NOT NULL,
+  country_code TEXT NOT NULL,
+  phone_number TEXT,
+  session_file TEXT,
+  phone_code_hash TEXT,
+  state TEXT NOT NULL,
+  otp_attempts INTEGER NOT NULL DEFAULT 0,
+  twofa_attempts INTEGER NOT NULL DEFAULT 0,
+  account_id INTEGER,
+  prompt_message_id INTEGER,
+  updated_at TEXT,
+  expires_at TEXT NOT NULL,
+  created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+  name TEXT PRIMARY KEY,
+  data TEXT NOT NULL,
+  updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+
+-- context.user_data as JSON, written behind and loaded on the user's next update
+CREATE TABLE IF NOT EXISTS user_state (
+  user_id INTEGER PRIMARY KEY,
+  data TEXT NOT NULL,
+  updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+
+-- "Notify me" restock waitlist, served in id (first come, first served) order
+CREATE TABLE IF NOT EXISTS waitlist (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  country_code TEXT NOT NULL,
+  user_id INTEGER NOT NULL,
+  created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE (country_code, user_id)
+);
+
+-- one row per delivered OTP; times are unix epoch seconds
+CREATE TABLE IF NOT EXISTS otp_traces (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  account_id INTEGER,
+  country_code TEXT,
+  source TEXT,
+  reserved_at REAL,
+  queued_at REAL,
+  admitted_at REAL,
+  connected_at REAL,
+  handler_at REAL,
+  message_at REAL,
+  extracted_at REAL,
+  sent_at REAL NOT NULL
+);
+
+-- permanent per-day aggregates of archived transactions ('' = no country)
+CREATE TABLE IF NOT EXISTS transaction_totals (
+  day TEXT NOT NULL,
+  type TEXT NOT NULL,
+  country_code TEXT NOT NULL,
+  count INTEGER NOT NULL,
+  amount REAL NOT NULL,
+  PRIMARY KEY (day, type, country_code)
+);
+"""
+
+# Columns added after tables were first created; init_db adds them to older databases.
+SCHEMA_COLUMNS = {
+    "accounts": [("last_checked_at", "TEXT"), ("last_check_result", "TEXT"),
+                 ("cooldown_until", "TEXT")],
+    "transactions": [("note", "TEXT")],
+    "users": [("last_country", "TEXT")],
+    "otp_traces": [("queued_at", "REAL"), ("admitted_at", "REAL")],
+}
+
+INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_accounts_status_checked ON accounts(status, last_checked_at);
+CREATE INDEX IF NOT EXISTS idx_accounts_country_status ON accounts(country_code, status, id);
+CREATE INDEX IF NOT EXISTS idx_uploads_admin_state ON uploads(admin_id, state);
+CREATE INDEX IF NOT EXISTS idx_otp_traces_sent ON otp_traces(sent_at);
+CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_waitlist_country ON waitlist(country_code, id);
+-- covers purchase_history(): one range read per page
+CREATE INDEX IF NOT EXISTS idx_transactions_user_history ON transactions(user_id, type, id, account_id, amount, created_at);
 """
 
 
@@ -174,26 +587,102 @@ def minutes_from_now(mins: int) -> str:
 
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    tenant = current_tenant()
+    async with aiosqlite.connect(tenant.db_path) as db:
+        cur = await db.execute("PRAGMA auto_vacuum")
+        if (await cur.fetchone())[0] != 2:
+            # incremental mode lets maintenance return free pages in small
+            # steps. A new file switches for free; an existing one needs a full
+            # VACUUM, which locks the DB for as long as it takes, so it is
+            # left to /backup vacuum
+            cur = await db.execute("SELECT COUNT(*) FROM sqlite_master")
+            if (await cur.fetchone())[0] == 0:
+                await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            else:
+                logger.info(
+                    "auto_vacuum is not incremental on %s; /backup vacuum converts it",
+                    tenant.db_path)
         await db.executescript(SCHEMA_SQL)
+        for table, columns in SCHEMA_COLUMNS.items():
+            cur = await db.execute(f"PRAGMA table_info({table})")
+            existing = {r[1] for r in await cur.fetchall()}
+            for name, decl in columns:
+                if name not in existing:
+                    await db.execute(
+                        f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+        await db.executescript(INDEX_SQL)
+        if tenant.id_base:
+            for table in ("accounts", "uploads"):
+                await db.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) SELECT ?, 0 WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name=?)",
+                    (table, table))
+                await db.execute(
+                    "UPDATE sqlite_sequence SET seq=? WHERE name=? AND seq<?",
+                    (tenant.id_base, table, tenant.id_base))
         await db.commit()
 
 
 async def get_user(user_id: int, username: Optional[str]):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT id, username, balance FROM users WHERE id=?", (user_id, ))
-        row = await cur.fetchone()
-        if row:
-            return {"id": row[0], "username": row[1], "balance": row[2]}
-        await db.execute("INSERT INTO users (id, username) VALUES (?, ?)",
-                         (user_id, username))
-        await db.commit()
-        return {"id": user_id, "username": username, "balance": 0.0}
+    user = await REPO.get_or_create_user(user_id, username)
+    USERNAMES.remember(user_id, user["username"])
+    return user
+
+
+class UsernameResolver:
+    """
+    Resolves an admin's "<id>" / "@username" argument to a user id.
+    Usernames match case-insensitively; hits are kept in an LRU cache that
+    get_user refreshes whenever it sees a user's current username.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._ids: "OrderedDict[str, int]" = OrderedDict()
+        self._names: Dict[int, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def remember(self, user_id: int, username: Optional[str]):
+        old = self._names.pop(user_id, None)
+        if old is not None and self._ids.get(old) == user_id:
+            del self._ids[old]
+        if not username:
+            return
+        key = username.lower()
+        previous = self._ids.get(key)
+        if previous is not None and previous != user_id:
+            self._names.pop(previous, None)  # the name moved to another user
+        self._ids[key] = user_id
+        self._ids.move_to_end(key)
+        self._names[user_id] = key
+        while len(self._ids) > self.max_entries:
+            _, evicted = self._ids.popitem(last=False)
+            self._names.pop(evicted, None)
+
+    async def resolve(self, target: str) -> Optional[int]:
+        target = target.strip()
+        if target.isdigit():
+            return int(target)
+        key = target.lstrip("@").lower()
+        if not key:
+            return None
+        user_id = self._ids.get(key)
+        if user_id is not None:
+            self._ids.move_to_end(key)
+            self.hits += 1
+            return user_id
+        self.misses += 1
+        user_id = await REPO.find_user_id(key)
+        if user_id is not None:
+            self.remember(user_id, key)
+        return user_id
+
+
+USERNAMES = UsernameResolver(CONFIG["USERNAME_CACHE_SIZE"])
 
 
 async def check_force_join(user_id: int, app) -> bool:
-    chat_id = CONFIG["FORCE_JOIN_CHAT_ID"]
+    chat_id = tenant_config("FORCE_JOIN_CHAT_ID")
     try:
         member = await app.bot.get_chat_member(chat_id=chat_id,
                                                user_id=user_id)
@@ -206,7 +695,7 @@ async def check_force_join(user_id: int, app) -> bool:
 
 
 def join_buttons() -> InlineKeyboardMarkup:
-    uname = CONFIG["FORCE_JOIN_USERNAME"]
+    uname = tenant_config("FORCE_JOIN_USERNAME")
     if uname and uname.startswith("@"):
         return InlineKeyboardMarkup([[
             InlineKeyboardButton(f"✅ Join {uname}",
@@ -220,7 +709,7 @@ def admin_only(func):
 
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         uid = update.effective_user.id
-        if uid not in CONFIG["ADMIN_IDS"]:
+        if uid not in tenant_config("ADMIN_IDS"):
             # consistent style for unauthorized
             await update.message.reply_text(
                 "❌ Unauthorized. This command is for admins only.")
@@ -230,209 +719,3697 @@ def admin_only(func):
     return wrapper
 
 
-# ---------- Telethon helpers (for convenience) ----------
-async def create_telethon_client(session_path: str):
-    client = TelegramClient(session_path, CONFIG["API_ID"], CONFIG["API_HASH"])
-    await client.connect()
-    return client
+# ---------- Storage repositories ----------
+# All persistent data (users, bans, accounts, transactions and their daily
+# totals, settings, Telethon sessions, uploads, OTP traces, user state and
+# waitlists) goes through REPO: SqliteRepository (default, the tenant's local
+# database file) or PostgresRepository (STORAGE_BACKEND=postgres) so several
+# bot instances can share one database. With PostgreSQL the SQLite file is
+# only created, never used. Each tenant has its own repository; REPO routes to
+# the current one.
 
+ACCOUNT_FIELDS = ("id", "country_code", "phone_number", "session_file",
+                  "two_fa_password", "status", "price", "metadata")
 
-async def check_session_active(session_path: str) -> bool:
-    client = TelegramClient(session_path, CONFIG["API_ID"], CONFIG["API_HASH"])
-    try:
-        await client.start()
-        me = await client.get_me()
-        return me is not None
-    except Exception:
-        return False
-    finally:
-        try:
-            await client.disconnect()
-        except Exception:
-            pass
 
+def account_row(row) -> Optional[Dict]:
+    if not row:
+        return None
+    acc = dict(zip(ACCOUNT_FIELDS, row))
+    acc["metadata"] = json.loads(acc["metadata"]) if acc["metadata"] else {}
+    return acc
+
+
+def sale_outcome(acc: Optional[Dict], user_id: int, balance: float) -> str:
+    """'sold', 'insufficient' or 'unavailable' for a Done tap on acc by user_id."""
+    if acc is None or acc["status"] not in ("reserved", "available"):
+        return "unavailable"
+    if (acc["status"] == "reserved"
+            and acc["metadata"].get("reserved_by") != user_id):
+        return "unavailable"  # reserved for someone else
+    if balance < (acc["price"] or 0.0):
+        return "insufficient"
+    return "sold"
+
+
+EXPORT_COLUMNS = {
+    "transactions": ("id", "created_at", "user_id", "account_id",
+                     "country_code", "amount", "type", "note"),
+    "accounts": ("id", "created_at", "country_code", "phone_number", "status",
+                 "price", "uploaded_by", "last_checked_at",
+                 "last_check_result"),
+    "users": ("id", "created_at", "username", "balance"),
+}
 
-# ---------- APScheduler tick ----------
-async def release_expired_reservations_tick():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT id, metadata FROM accounts WHERE status='reserved'")
-        rows = await cur.fetchall()
-        changed = 0
-        for acc_id, meta in rows:
-            try:
-                m = json.loads(meta) if meta else {}
-                ru = m.get("reserved_until")
-                if not ru:
+
+def export_query(kind: str, since: Optional[str], until: Optional[str],
+                 country: Optional[str], param) -> tuple:
+    """
+    SQL and parameters for an /export of `kind`, filtered by created_at date
+    (since inclusive, until exclusive, 'YYYY-MM-DD') and country. `param(n)`
+    renders the n-th placeholder ('?' for SQLite, '$n' for PostgreSQL).
+    Users are filtered by country through their purchases.
+    """
+    params, where = [], []
+
+    def bind(value):
+        params.append(value)
+        return param(len(params))
+
+    if kind == "transactions":
+        sql = ("SELECT t.id, t.created_at, t.user_id, t.account_id, a.country_code, "
+               "t.amount, t.type, t.note FROM transactions t "
+               "LEFT JOIN accounts a ON a.id = t.account_id")
+        date_col, order = "t.created_at", "t.id"
+        if country:
+            where.append(f"a.country_code = {bind(country)}")
+    elif kind == "accounts":
+        sql = ("SELECT id, created_at, country_code, phone_number, status, price, "
+               "uploaded_by, last_checked_at, last_check_result FROM accounts")
+        date_col, order = "created_at", "id"
+        if country:
+            where.append(f"country_code = {bind(country)}")
+    else:
+        sql = "SELECT u.id, u.created_at, u.username, u.balance FROM users u"
+        date_col, order = "u.created_at", "u.id"
+        if country:
+            where.append(
+                "EXISTS (SELECT 1 FROM transactions t JOIN accounts a ON a.id = t.account_id "
+                f"WHERE t.user_id = u.id AND a.country_code = {bind(country)})")
+    if since:
+        where.append(f"{date_col} >= {bind(since)}")
+    if until:
+        where.append(f"{date_col} < {bind(until)}")
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql + f" ORDER BY {order}", params
+
+
+# Folds transactions up to an id and before a cutoff into transaction_totals;
+# the DELETE with the same bounds follows in the same transaction.
+FOLD_TRANSACTIONS_SQL = (
+    "INSERT INTO transaction_totals (day, type, country_code, count, amount) "
+    "SELECT substr(t.created_at, 1, 10), COALESCE(t.type, ''), COALESCE(a.country_code, ''), "
+    "COUNT(*), COALESCE(SUM(t.amount), 0) "
+    "FROM transactions t LEFT JOIN accounts a ON a.id = t.account_id "
+    "WHERE t.id <= {0} AND t.created_at < {1} GROUP BY 1, 2, 3 "
+    "ON CONFLICT (day, type, country_code) DO UPDATE SET "
+    "count = transaction_totals.count + excluded.count, "
+    "amount = transaction_totals.amount + excluded.amount")
+
+
+class SqliteWriter:
+    """
+    Group commit: one task owns a write connection and runs queued write ops
+    together in a single transaction. A batch is committed once max_ops ops
+    are queued or max_delay has passed since its first op, so a burst costs
+    one fsync instead of one per write. Each op runs in its own savepoint: a
+    failing op is rolled back alone, and its caller gets the exception. Callers
+    are resolved only after the batch has committed.
+    """
+
+    def __init__(self, path: str, max_ops: int, max_delay_ms: float,
+                 durability: str):
+        self.path = path
+        self.max_ops = max(1, max_ops)
+        self.max_delay = max(0.0, max_delay_ms) / 1000.0
+        self.durability = durability
+        self._queue: Optional[asyncio.Queue] = None
+        self._db = None
+        self._task: Optional[asyncio.Task] = None
+        self.commits = 0
+        self.ops = 0
+        self.failed_ops = 0
+        self.max_batch = 0
+
+    async def start(self):
+        if self._task is not None:
+            return
+        # autocommit mode: BEGIN/COMMIT are issued explicitly per batch
+        self._db = await aiosqlite.connect(self.path, isolation_level=None)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        # full: fsync every commit; normal: WAL may lose the last commits on power loss, never corrupts
+        await self._db.execute("PRAGMA synchronous=" + (
+            "FULL" if self.durability == "full" else "NORMAL"))
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        await self._queue.put(None)  # flushes everything queued before it
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self._db.close()
+        self._db = None
+
+    async def submit(self, op):
+        """Run `await op(db)` in the next batch; returns its result once committed."""
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, fut))
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_ops:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(),
+                                                      timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        db = self._db
+        outcomes = []
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            for op, fut in batch:
+                if fut.done():  # caller went away before its turn
+                    outcomes.append(None)
                     continue
-                ru_dt = datetime.fromisoformat(ru)
-                if ru_dt.tzinfo is None:
-                    ru_dt = ru_dt.replace(tzinfo=IST)
-                if ru_dt < datetime.now(IST):
-                    await db.execute(
-                        "UPDATE accounts SET status='available', metadata=NULL WHERE id=?",
-                        (acc_id, ))
-                    changed += 1
+                await db.execute("SAVEPOINT op")
+                try:
+                    outcomes.append((True, await op(db)))
+                    await db.execute("RELEASE op")
+                except Exception as e:
+                    await db.execute("ROLLBACK TO op")
+                    await db.execute("RELEASE op")
+                    outcomes.append((False, e))
+            await db.execute("COMMIT")
+        except Exception as e:
+            logger.error("Group commit of %s ops failed: %s", len(batch), e)
+            try:
+                await db.execute("ROLLBACK")
             except Exception:
-                await db.execute(
-                    "UPDATE accounts SET status='available', metadata=NULL WHERE id=?",
-                    (acc_id, ))
-                changed += 1
+                pass
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.commits += 1
+        self.ops += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        for (_, fut), outcome in zip(batch, outcomes):
+            if outcome is None or fut.done():
+                continue
+            ok, value = outcome
+            if ok:
+                fut.set_result(value)
+            else:
+                self.failed_ops += 1
+                fut.set_exception(value)
+
+    def stats(self) -> Dict:
+        return {
+            "commits": self.commits,
+            "ops": self.ops,
+            "failed": self.failed_ops,
+            "avg_batch": (self.ops / self.commits) if self.commits else 0.0,
+            "max_batch": self.max_batch,
+            "queued": self._queue.qsize() if self._queue else 0,
+        }
+
+
+class SqliteRepository:
+    """
+    Repository over the local SQLite file. Reads open their own connection;
+    writes are ops `async def op(db)` run in one transaction each, or batched
+    by a SqliteWriter when group commit is enabled.
+    """
+
+    def __init__(self, path: str, writer: Optional[SqliteWriter] = None):
+        self.path = path
+        self.writer = writer
 
-        if changed:
+    def _connect(self):
+        return aiosqlite.connect(self.path)
+
+    async def _write(self, op):
+        if self.writer is not None:
+            return await self.writer.submit(op)
+        async with self._connect() as db:
+            # the write lock makes read-then-write ops one step for every writer
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                result = await op(db)
+            except BaseException:
+                await db.rollback()
+                raise
             await db.commit()
+        return result
+
+    async def init(self):
+        # tables are created by init_db()
+        if self.writer is not None:
+            await self.writer.start()
+
+    async def close(self):
+        if self.writer is not None:
+            await self.writer.stop()
+
+    # users and bans
+    @staticmethod
+    async def _sync_user(db, user_id: int, username: Optional[str], row):
+        """
+        Create the user or store a changed username, given its current
+        (id, username, balance, last_country) row or None; returns the user dict.
+        """
+        if not row or row[1] != username:
+            if username is not None:
+                # a username belongs to one user; drop it from whoever had it before
+                await db.execute(
+                    "UPDATE users SET username=NULL WHERE username=? COLLATE NOCASE AND id!=?",
+                    (username, user_id))
+            if row:
+                await db.execute("UPDATE users SET username=? WHERE id=?",
+                                 (username, user_id))
+            else:
+                await db.execute(
+                    "INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)",
+                    (user_id, username))
+        return {
+            "id": user_id,
+            "username": username,
+            "balance": row[2] if row else 0.0,
+            "last_country": row[3] if row else None
+        }
+
+    async def get_or_create_user(self, user_id: int,
+                                 username: Optional[str]) -> Dict:
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT id, username, balance, last_country FROM users WHERE id=?",
+                (user_id, ))
+            row = await cur.fetchone()
+        if row and row[1] == username:
+            return {
+                "id": row[0],
+                "username": row[1],
+                "balance": row[2],
+                "last_country": row[3]
+            }
+        return await self._write(
+            lambda db: self._sync_user(db, user_id, username, row))
+
+    async def find_user_id(self, username: str) -> Optional[int]:
+        """Case-insensitive lookup (uses idx_users_username_nocase)."""
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT id FROM users WHERE username=? COLLATE NOCASE LIMIT 1",
+                (username, ))
+            row = await cur.fetchone()
+        return row[0] if row else None
 
+    async def get_balance(self, user_id: int) -> Optional[float]:
+        async with self._connect() as db:
+            cur = await db.execute("SELECT balance FROM users WHERE id=?",
+                                   (user_id, ))
+            row = await cur.fetchone()
+        return row[0] if row else None
 
-# ---------- Bot flows ----------
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    await get_user(user.id, user.username)
-    await show_main_menu(update, context)
+    async def set_balance(self, user_id: int,
+                          amount: float) -> Optional[float]:
 
+        async def op(db):
+            cur = await db.execute("UPDATE users SET balance=? WHERE id=?",
+                                   (amount, user_id))
+            return amount if cur.rowcount else None
 
-async def verify_join_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if not await check_force_join(q.from_user.id, context.application):
-        await q.edit_message_text(
-            "❌ **You haven't joined the channel yet!**\n\nPlease join and then verify.",
-            reply_markup=InlineKeyboardMarkup(
-                [[
-                    InlineKeyboardButton(
-                        "📢 Join Channel",
-                        url=f"https://t.me/{CONFIG['FORCE_JOIN_USERNAME'][1:]}"
-                    )
-                ],
-                 [
-                     InlineKeyboardButton("✅ Verify Join",
-                                          callback_data="verify_join")
-                 ]]),
-            parse_mode="Markdown")
-        return
-    await show_main_menu_cb(update, context)
+        return await self._write(op)
 
+    async def adjust_balance(self, user_id: int, delta: float, tx_type: str):
+        """
+        Add delta (negative to deduct) and record a transaction, atomically.
+        Returns (ok, balance): ok is False if the user is unknown or a deduction
+        would go below zero; balance is the new or, when refused, current one.
+        """
 
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    is_admin = user.id in CONFIG["ADMIN_IDS"]
-    welcome_text = f"""
-✨ Welcome to Telegram Accounts Shop! ✨
+        async def op(db):
+            cur = await db.execute("SELECT balance FROM users WHERE id=?",
+                                   (user_id, ))
+            row = await cur.fetchone()
+            if not row or row[0] + delta < 0:
+                return False, (row[0] if row else None)
+            await db.execute(
+                "UPDATE users SET balance = balance + ? WHERE id=?",
+                (delta, user_id))
+            await db.execute(
+                "INSERT INTO transactions (user_id, amount, type) VALUES (?, ?, ?)",
+                (user_id, delta, tx_type))
+            return True, row[0] + delta
+
+        return await self._write(op)
+
+    async def find_user_ids(self, usernames: List[str]) -> Dict[str, int]:
+        """Lowercased username -> id for every name that exists."""
+        found = {}
+        names = list({n.lower() for n in usernames})
+        async with self._connect() as db:
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                cur = await db.execute(
+                    "SELECT id, username FROM users WHERE username COLLATE NOCASE IN "
+                    f"({','.join('?' * len(chunk))})", chunk)
+                for uid, uname in await cur.fetchall():
+                    found[uname.lower()] = uid
+        return found
+
+    async def apply_balance_batch(self, rows: List[tuple]) -> List[tuple]:
+        """
+        Apply (user_id, delta, tx_type, note) rows in one transaction, in order.
+        Returns one (ok, balance) per row with adjust_balance's meaning; refused
+        rows (unknown user, deduction below zero) are skipped, the rest commit.
+        """
+
+        async def op(db):
+            ids = list({r[0] for r in rows})
+            balances = {}
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                cur = await db.execute(
+                    f"SELECT id, balance FROM users WHERE id IN ({','.join('?' * len(chunk))})",
+                    chunk)
+                balances.update(await cur.fetchall())
+            results, txs = [], []
+            for user_id, delta, tx_type, note in rows:
+                balance = balances.get(user_id)
+                if balance is None or balance + delta < 0:
+                    results.append((False, balance))
+                    continue
+                balances[user_id] = balance + delta
+                txs.append((user_id, delta, tx_type, note))
+                results.append((True, balance + delta))
+            touched = {t[0] for t in txs}
+            await db.executemany("UPDATE users SET balance=? WHERE id=?",
+                                 [(balances[u], u) for u in touched])
+            await db.executemany(
+                "INSERT INTO transactions (user_id, amount, type, note) VALUES (?, ?, ?, ?)",
+                txs)
+            return results
 
-🤖 Your trusted source for premium Telegram accounts
+        return await self._write(op)
 
-{CONFIG['DEVELOPER_CREDITS']}
+    async def list_user_ids(self) -> List[int]:
+        async with self._connect() as db:
+            cur = await db.execute("SELECT id FROM users")
+            return [r[0] for r in await cur.fetchall()]
 
-💎 Features:
-• Instant OTP Delivery
-• Premium Quality Accounts  
-• 24/7 Support
-• Secure & Reliable
+    async def count_users(self) -> int:
+        async with self._connect() as db:
+            cur = await db.execute("SELECT COUNT(*) FROM users")
+            return (await cur.fetchone())[0]
 
-📊 Available Countries:
-🇺🇸 US - ₹40      🇪🇹 Ethiopia - ₹35
-🇻🇳 Vietnam - ₹35  🇮🇳 India - ₹40  
-🇳🇵 Nepal - ₹40    🇸🇻 El Salvador - ₹55
-🇵🇭 Philippines - ₹80  🇨🇳 China - ₹80
-    """
-    kb = []
-    kb.append(
-        [InlineKeyboardButton("🛒 Buy Accounts", callback_data="buy_accounts")])
-    kb.append([
-        InlineKeyboardButton("💰 Check Balance", callback_data="check_balance")
-    ])
-    if is_admin:
-        kb.append([
-            InlineKeyboardButton("⚡ Admin Panel", callback_data="admin_panel")
-        ])
-    kb.append([
-        InlineKeyboardButton("📞 Contact Support",
-                             url=f"https://t.me/{CONFIG['OWNER_HANDLE']}")
-    ])
-    if update.message:
-        await update.message.reply_text(welcome_text,
-                                        reply_markup=InlineKeyboardMarkup(kb),
-                                        parse_mode="Markdown")
-    else:
-        await update.callback_query.edit_message_text(
-            welcome_text,
-            reply_markup=InlineKeyboardMarkup(kb),
-            parse_mode="Markdown")
+    async def ban(self, user_id: int, reason: str):
 
+        async def op(db):
+            await db.execute("INSERT INTO bans (user_id, reason) VALUES (?, ?)",
+                             (user_id, reason))
 
-async def show_main_menu_cb(update: Update,
-                            context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    if q:
-        await q.answer()
-    await show_main_menu(update, context)
+        await self._write(op)
 
+    async def unban(self, user_id: int):
 
-async def main_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    user = q.from_user
-    is_admin = user.id in CONFIG["ADMIN_IDS"]
-    welcome_text = f"""
-✨ Welcome to Telegram Accounts Shop! ✨
+        async def op(db):
+            await db.execute("DELETE FROM bans WHERE user_id=?", (user_id, ))
 
-🤖 Your trusted source for premium Telegram accounts
+        await self._write(op)
 
-{CONFIG['DEVELOPER_CREDITS']}
+    async def is_banned(self, user_id: int) -> bool:
+        async with self._connect() as db:
+            cur = await db.execute("SELECT 1 FROM bans WHERE user_id=? LIMIT 1",
+                                   (user_id, ))
+            return await cur.fetchone() is not None
 
-💎 Features:
-• Instant OTP Delivery
-• Premium Quality Accounts  
-• 24/7 Support
-• Secure & Reliable
+    # accounts
+    async def add_account(self, country_code: str, phone: str,
+                          session_file: str, two_fa: Optional[str],
+                          uploaded_by: int, price: float) -> int:
 
-📊 Available Countries:
-🇺🇸 US - ₹40      🇪🇹 Ethiopia - ₹35
-🇻🇳 Vietnam - ₹35  🇮🇳 India - ₹40  
-🇳🇵 Nepal - ₹40    🇸🇻 El Salvador - ₹55
-🇵🇭 Philippines - ₹80  🇨🇳 China - ₹80
-    """
-    kb = []
-    kb.append(
-        [InlineKeyboardButton("🛒 Buy Accounts", callback_data="buy_accounts")])
-    kb.append([
-        InlineKeyboardButton("💰 Check Balance", callback_data="check_balance")
-    ])
-    if is_admin:
-        kb.append([
-            InlineKeyboardButton("⚡ Admin Panel", callback_data="admin_panel")
-        ])
-    kb.append([
-        InlineKeyboardButton("📞 Contact Support",
-                             url=f"https://t.me/{CONFIG['OWNER_HANDLE']}")
-    ])
-    await q.edit_message_text(welcome_text,
-                              reply_markup=InlineKeyboardMarkup(kb),
-                              parse_mode="Markdown")
+        async def op(db):
+            cur = await db.execute(
+                "INSERT INTO accounts (country_code, phone_number, session_file, two_fa_password, uploaded_by, status, price, metadata) VALUES (?, ?, ?, ?, ?, 'available', ?, ?)",
+                (country_code, phone, session_file, two_fa, uploaded_by, price,
+                 json.dumps({})))
+            return cur.lastrowid
 
+        return await self._write(op)
 
-async def check_balance_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    user = await get_user(q.from_user.id, q.from_user.username)
-    kb = [[InlineKeyboardButton("🔙 Back to Main", callback_data="main_menu")]]
-    owner_handle = CONFIG['OWNER_HANDLE'].replace('_', '\\_')
-    await q.edit_message_text(
-        f"💰 **Your Balance**\n\n"
-        f"Current Balance: ₹{user['balance']:.2f}\n\n"
-        f"Need to add balance? Contact @{owner_handle}",
-        reply_markup=InlineKeyboardMarkup(kb),
-        parse_mode="Markdown")
+    async def set_account_two_fa(self, acc_id: int,
+                                 password: Optional[str]):
 
+        async def op(db):
+            await db.execute(
+                "UPDATE accounts SET two_fa_password=? WHERE id=?",
+                (password, acc_id))
 
-async def buy_accounts_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    countries = [("US", "United States", 40), ("ET", "Ethiopia", 35),
-                 ("VN", "Vietnam", 35), ("IN", "India", 40),
-                 ("NP", "Nepal", 40), ("SV", "El Salvador", 55),
-                 ("PH", "Philippines", 80), ("CN", "China", 80)]
-    kb = []
-    for i in range(0, len(countries), 2):
+        await self._write(op)
+
+    async def delete_account(self, acc_id: int):
+
+        async def op(db):
+            await db.execute("DELETE FROM accounts WHERE id=?", (acc_id, ))
+
+        await self._write(op)
+
+    async def get_account(self, acc_id: int) -> Optional[Dict]:
+        async with self._connect() as db:
+            cur = await db.execute(
+                f"SELECT {', '.join(ACCOUNT_FIELDS)} FROM accounts WHERE id=?",
+                (acc_id, ))
+            return account_row(await cur.fetchone())
+
+    @staticmethod
+    async def _claim(db, country_code: str, meta: Dict):
+        cur = await db.execute(
+            "SELECT id, phone_number, price, session_file FROM accounts "
+            "WHERE country_code=? AND status='available' AND session_file IS NOT NULL "
+            "AND (cooldown_until IS NULL OR cooldown_until < ?) "
+            "ORDER BY id LIMIT 1", (country_code, now_iso()))
+        row = await cur.fetchone()
+        if not row:
+            return None
+        await db.execute(
+            "UPDATE accounts SET status='reserved', metadata=? WHERE id=?",
+            (json.dumps(meta), row[0]))
+        return tuple(row)
+
+    async def claim_account(self, country_code: str, meta: Dict):
+        """Reserve one available account of the country; (id, phone, price, session_file) or None."""
+        return await self._write(
+            lambda db: self._claim(db, country_code, meta))
+
+    async def reserve_for_buyer(self, user_id: int, username: Optional[str],
+                                country_code: str, price: float,
+                                meta: Dict) -> Dict:
+        """
+        The purchase fast path in one write: refresh the user, check the balance
+        against price and claim an account. Returns {"user", "result":
+        'reserved' | 'insufficient' | 'unavailable', "account": claim_account()'s
+        tuple or None}.
+        """
+
+        async def op(db):
+            cur = await db.execute(
+                "SELECT id, username, balance, last_country FROM users WHERE id=?",
+                (user_id, ))
+            user = await self._sync_user(db, user_id, username,
+                                         await cur.fetchone())
+            if user["balance"] < price:
+                return {"user": user, "result": "insufficient", "account": None}
+            account = await self._claim(db, country_code, meta)
+            return {
+                "user": user,
+                "result": "reserved" if account else "unavailable",
+                "account": account
+            }
+
+        return await self._write(op)
+
+    async def update_reserved_metadata(self, acc_id: int, meta: Dict):
+
+        async def op(db):
+            await db.execute(
+                "UPDATE accounts SET metadata=? WHERE id=? AND status='reserved'",
+                (json.dumps(meta), acc_id))
+
+        await self._write(op)
+
+    async def reserved_accounts(self):
+        """[(id, metadata JSON)] of all reserved accounts."""
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT id, metadata FROM accounts WHERE status='reserved'")
+            rows = await cur.fetchall()
+        return [(acc_id, meta) for acc_id, meta in rows]
+
+    async def release_accounts(self, acc_ids: List[int]) -> List[tuple]:
+        """Put reserved accounts back on sale; returns (id, country_code) of those actually released."""
+
+        async def op(db):
+            released = []
+            for acc_id in acc_ids:
+                cur = await db.execute(
+                    "UPDATE accounts SET status='available', metadata=NULL WHERE id=? AND status='reserved'",
+                    (acc_id, ))
+                if cur.rowcount:
+                    cur = await db.execute(
+                        "SELECT country_code FROM accounts WHERE id=?",
+                        (acc_id, ))
+                    released.append((acc_id, (await cur.fetchone())[0]))
+            return released
+
+        return await self._write(op)
+
+    async def complete_sale(self, acc_id: int, user_id: int) -> Dict:
+        """
+        Charge user_id and mark acc_id sold in one transaction. With too little
+        balance the reservation is released instead. Returns {"result": one of
+        sale_outcome(), "balance", "account"}.
+        """
+
+        async def op(db):
+            cur = await db.execute(
+                f"SELECT {', '.join(ACCOUNT_FIELDS)} FROM accounts WHERE id=?",
+                (acc_id, ))
+            acc = account_row(await cur.fetchone())
+            cur = await db.execute("SELECT balance FROM users WHERE id=?",
+                                   (user_id, ))
+            row = await cur.fetchone()
+            balance = row[0] if row else 0.0
+            result = sale_outcome(acc, user_id, balance)
+            if result == "sold":
+                price = acc["price"] or 0.0
+                await db.execute(
+                    "UPDATE users SET balance = balance - ? WHERE id=?",
+                    (price, user_id))
+                await db.execute(
+                    "UPDATE accounts SET status='sold', metadata=NULL WHERE id=?",
+                    (acc_id, ))
+                await db.execute(
+                    "INSERT INTO transactions (user_id, account_id, amount, type) VALUES (?, ?, ?, 'purchase')",
+                    (user_id, acc_id, price))
+                await db.execute("UPDATE users SET last_country=? WHERE id=?",
+                                 (acc["country_code"], user_id))
+                balance -= price
+            elif result == "insufficient" and acc["status"] == "reserved":
+                await db.execute(
+                    "UPDATE accounts SET status='available', metadata=NULL WHERE id=?",
+                    (acc_id, ))
+            return {"result": result, "balance": balance, "account": acc}
+
+        return await self._write(op)
+
+    async def accounts_to_check(self, checked_before: str, limit: int):
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT id, session_file FROM accounts WHERE status='available' "
+                "AND (last_checked_at IS NULL OR last_checked_at < ?) "
+                "AND (cooldown_until IS NULL OR cooldown_until < ?) "
+                "ORDER BY last_checked_at LIMIT ?",
+                (checked_before, now_iso(), limit))
+            return [tuple(r) for r in await cur.fetchall()]
+
+    async def record_session_checks(self, checked_at: str, results,
+                                    dead_ids: List[int]):
+        """results: [(acc_id, result)]; dead_ids move from available to dead."""
+
+        async def op(db):
+            await db.executemany(
+                "UPDATE accounts SET last_checked_at=?, last_check_result=? WHERE id=?",
+                [(checked_at, res, acc_id) for acc_id, res in results])
+            await db.executemany(
+                "UPDATE accounts SET status='dead' WHERE id=? AND status='available'",
+                [(acc_id, ) for acc_id in dead_ids])
+
+        await self._write(op)
+
+    async def account_status_counts(self):
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT status, COUNT(*) FROM accounts GROUP BY status")
+            return await cur.fetchall()
+
+    async def available_count(self, country_code: str) -> int:
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT COUNT(*) FROM accounts WHERE country_code=? AND status='available' "
+                "AND session_file IS NOT NULL "
+                "AND (cooldown_until IS NULL OR cooldown_until < ?)",
+                (country_code, now_iso()))
+            return (await cur.fetchone())[0]
+
+    async def set_account_cooldown(self, acc_id: int, until: Optional[str]):
+        """Hold an account back from claims and sweeps until `until` (None clears it)."""
+
+        async def op(db):
+            await db.execute("UPDATE accounts SET cooldown_until=? WHERE id=?",
+                             (until, acc_id))
+
+        await self._write(op)
+
+    async def cooling_accounts(self) -> List[tuple]:
+        """[(id, country_code, phone_number, cooldown_until)] still cooling down."""
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT id, country_code, phone_number, cooldown_until FROM accounts "
+                "WHERE cooldown_until >= ? ORDER BY cooldown_until", (now_iso(), ))
+            return [tuple(r) for r in await cur.fetchall()]
+
+    # restock waitlist
+    async def waitlist_add(self, country_code: str, user_id: int) -> int:
+        """Join (or stay on) a country's waitlist; returns the 1-based position."""
+
+        async def op(db):
+            await db.execute(
+                "INSERT OR IGNORE INTO waitlist (country_code, user_id) VALUES (?, ?)",
+                (country_code, user_id))
+            cur = await db.execute(
+                "SELECT COUNT(*) FROM waitlist WHERE country_code=? AND id <= "
+                "(SELECT id FROM waitlist WHERE country_code=? AND user_id=?)",
+                (country_code, country_code, user_id))
+            return (await cur.fetchone())[0]
+
+        return await self._write(op)
+
+    async def waitlist_pop(self, country_code: str, n: int) -> List[int]:
+        """Remove and return the first n waiters for a country, oldest first."""
+
+        async def op(db):
+            cur = await db.execute(
+                "SELECT id, user_id FROM waitlist WHERE country_code=? ORDER BY id LIMIT ?",
+                (country_code, n))
+            rows = await cur.fetchall()
+            if rows:
+                await db.execute(
+                    f"DELETE FROM waitlist WHERE id IN ({','.join('?' * len(rows))})",
+                    [r[0] for r in rows])
+            return [r[1] for r in rows]
+
+        return await self._write(op)
+
+    async def waitlist_counts(self):
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT country_code, COUNT(*) FROM waitlist GROUP BY country_code ORDER BY 2 DESC")
+            return await cur.fetchall()
+
+    async def country_status_counts(self):
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT country_code, status, COUNT(*) FROM accounts GROUP BY country_code, status ORDER BY country_code, status"
+            )
+            return await cur.fetchall()
+
+    async def list_accounts(self):
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT id, country_code, phone_number, status, price FROM accounts ORDER BY status, country_code"
+            )
+            return await cur.fetchall()
+
+    # transactions
+    async def total_revenue(self) -> float:
+        """All-time purchase revenue: live rows plus archived totals."""
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT (SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE type='purchase') "
+                "+ (SELECT COALESCE(SUM(amount), 0) FROM transaction_totals WHERE type='purchase')")
+            return (await cur.fetchone())[0] or 0
+
+    async def transaction_counts(self):
+        """(live rows, archived rows)."""
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT (SELECT COUNT(*) FROM transactions), "
+                "(SELECT COALESCE(SUM(count), 0) FROM transaction_totals)")
+            return await cur.fetchone()
+
+    async def purchase_history(self, user_id: int, before_id: Optional[int],
+                               limit: int):
+        """
+        A page of user_id's purchases, newest first: (id, created_at, amount,
+        phone_number, country_code). Keyset-paged: pass the last id of the
+        previous page as before_id.
+        """
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT t.id, t.created_at, t.amount, a.phone_number, a.country_code "
+                "FROM transactions t LEFT JOIN accounts a ON a.id = t.account_id "
+                "WHERE t.user_id=? AND t.type='purchase' AND t.id < ? "
+                "ORDER BY t.id DESC LIMIT ?",
+                (user_id, before_id or 2**63 - 1, limit))
+            return await cur.fetchall()
+
+    async def archivable_transactions(self, cutoff: str, limit: int):
+        """The oldest `limit` transactions created before cutoff, in id order."""
+        sql, params = export_query("transactions", None, cutoff, None,
+                                   lambda n: "?")
+        async with self._connect() as db:
+            cur = await db.execute(sql + f" LIMIT {int(limit)}", params)
+            return await cur.fetchall()
+
+    async def fold_transactions(self, last_id: int, cutoff: str) -> int:
+        """Add transactions up to last_id before cutoff to the totals and delete them."""
+
+        async def op(db):
+            await db.execute(FOLD_TRANSACTIONS_SQL.format("?", "?"),
+                             (last_id, cutoff))
+            cur = await db.execute(
+                "DELETE FROM transactions WHERE id <= ? AND created_at < ?",
+                (last_id, cutoff))
+            return cur.rowcount
+
+        return await self._write(op)
+
+    async def iter_export(self, kind: str, since: Optional[str],
+                          until: Optional[str], country: Optional[str]):
+        """Stream export rows; the cursor fetches 500 rows at a time."""
+        sql, params = export_query(kind, since, until, country, lambda n: "?")
+        async with self._connect() as db:
+            async with db.execute(sql, params) as cur:
+                cur.iter_chunk_size = 500
+                async for row in cur:
+                    yield tuple(row)
+
+    # settings
+    async def get_setting(self, key: str) -> Optional[str]:
+        async with self._connect() as db:
+            cur = await db.execute("SELECT value FROM settings WHERE key=?",
+                                   (key, ))
+            row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def set_setting(self, key: str, value: str):
+
+        async def op(db):
+            await db.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                (key, value))
+
+        await self._write(op)
+
+    # Telethon sessions
+    async def session_get(self, name: str) -> Optional[str]:
+        async with self._connect() as db:
+            cur = await db.execute("SELECT data FROM sessions WHERE name=?",
+                                   (name, ))
+            row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def session_put(self, name: str, data: str):
+
+        async def op(db):
+            await db.execute(
+                "INSERT INTO sessions (name, data, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP) "
+                "ON CONFLICT(name) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+                (name, data))
+
+        await self._write(op)
+
+    async def session_add_many(self, rows):
+        """Insert (name, data) rows, keeping any that already exist."""
+
+        async def op(db):
+            await db.executemany(
+                "INSERT OR IGNORE INTO sessions (name, data) VALUES (?, ?)",
+                rows)
+
+        await self._write(op)
+
+    async def session_delete(self, name: str):
+
+        async def op(db):
+            await db.execute("DELETE FROM sessions WHERE name=?", (name, ))
+
+        await self._write(op)
+
+    async def session_names(self) -> set:
+        async with self._connect() as db:
+            cur = await db.execute("SELECT name FROM sessions")
+            return {r[0] for r in await cur.fetchall()}
+
+    # admin uploads (the upload state machine)
+    async def upload_create(self, admin_id: int, country_code: str,
+                            expires_at: str) -> int:
+
+        async def op(db):
+            cur = await db.execute(
+                "INSERT INTO uploads (admin_id, country_code, state, updated_at, expires_at) VALUES (?, ?, 'phone', ?, ?)",
+                (admin_id, country_code, now_iso(), expires_at))
+            return cur.lastrowid
+
+        return await self._write(op)
+
+    async def upload_get(self, upload_id: int) -> Optional[Dict]:
+        async with self._connect() as db:
+            cur = await db.execute(
+                f"SELECT {', '.join(UPLOAD_COLUMNS)} FROM uploads WHERE id=?",
+                (upload_id, ))
+            row = await cur.fetchone()
+        return dict(zip(UPLOAD_COLUMNS, row)) if row else None
+
+    async def upload_for_message(self, admin_id: int,
+                                 reply_to_id: Optional[int]) -> Optional[Dict]:
+        placeholders = ", ".join("?" for _ in ACTIVE_UPLOAD_STATES)
+        async with self._connect() as db:
+            row = None
+            if reply_to_id:
+                cur = await db.execute(
+                    f"SELECT {', '.join(UPLOAD_COLUMNS)} FROM uploads WHERE admin_id=? AND prompt_message_id=? AND state IN ({placeholders})",
+                    (admin_id, reply_to_id, *ACTIVE_UPLOAD_STATES))
+                row = await cur.fetchone()
+            if not row:
+                cur = await db.execute(
+                    f"SELECT {', '.join(UPLOAD_COLUMNS)} FROM uploads WHERE admin_id=? AND state IN ({placeholders}) ORDER BY updated_at DESC, id DESC LIMIT 1",
+                    (admin_id, *ACTIVE_UPLOAD_STATES))
+                row = await cur.fetchone()
+        return dict(zip(UPLOAD_COLUMNS, row)) if row else None
+
+    async def upload_update(self, upload_id: int, fields: Dict,
+                            from_states: Optional[tuple] = None) -> bool:
+        """Set fields, only while the upload is in one of from_states if given; False if no row matched."""
+        sql = f"UPDATE uploads SET {', '.join(f'{k}=?' for k in fields)} WHERE id=?"
+        params = [*fields.values(), upload_id]
+        if from_states is not None:
+            sql += f" AND state IN ({', '.join('?' for _ in from_states)})"
+            params += from_states
+
+        async def op(db):
+            cur = await db.execute(sql, params)
+            return cur.rowcount > 0
+
+        return await self._write(op)
+
+    async def uploads_expired(self, now: str) -> List[Dict]:
+        placeholders = ", ".join("?" for _ in ACTIVE_UPLOAD_STATES)
+        async with self._connect() as db:
+            cur = await db.execute(
+                f"SELECT {', '.join(UPLOAD_COLUMNS)} FROM uploads WHERE state IN ({placeholders}) AND expires_at < ?",
+                (*ACTIVE_UPLOAD_STATES, now))
+            return [dict(zip(UPLOAD_COLUMNS, r)) for r in await cur.fetchall()]
+
+    async def uploads_active(self, admin_id: int) -> List[tuple]:
+        """[(id, country_code, phone_number, state)] of the admin's active uploads."""
+        placeholders = ", ".join("?" for _ in ACTIVE_UPLOAD_STATES)
+        async with self._connect() as db:
+            cur = await db.execute(
+                f"SELECT id, country_code, phone_number, state FROM uploads WHERE admin_id=? AND state IN ({placeholders}) ORDER BY id",
+                (admin_id, *ACTIVE_UPLOAD_STATES))
+            return [tuple(r) for r in await cur.fetchall()]
+
+    # OTP latency traces
+    async def otp_trace_add(self, acc_id: int, country_code: Optional[str],
+                            source: Optional[str], points: tuple):
+        """points: one timestamp (or None) per TRACE_FIELDS entry."""
+
+        async def op(db):
+            await db.execute(
+                f"INSERT INTO otp_traces (account_id, country_code, source, {', '.join(TRACE_FIELDS)}) "
+                f"VALUES ({', '.join('?' * (3 + len(TRACE_FIELDS)))})",
+                (acc_id, country_code, source, *points))
+
+        await self._write(op)
+
+    async def otp_traces_prune(self, cutoff: float):
+
+        async def op(db):
+            await db.execute("DELETE FROM otp_traces WHERE sent_at < ?",
+                             (cutoff, ))
+
+        await self._write(op)
+
+    async def otp_traces_since(self, since: float,
+                               country: Optional[str] = None) -> List[tuple]:
+        """[(country_code, *TRACE_FIELDS)] of traces sent since `since`."""
+        sql = f"SELECT country_code, {', '.join(TRACE_FIELDS)} FROM otp_traces WHERE sent_at >= ?"
+        params = [since]
+        if country:
+            sql += " AND country_code=?"
+            params.append(country)
+        async with self._connect() as db:
+            cur = await db.execute(sql, params)
+            return [tuple(r) for r in await cur.fetchall()]
+
+    # user_data (UserStatePersistence)
+    async def user_state_get_many(self, user_ids) -> Dict[int, str]:
+        user_ids = list(user_ids)
+        found = {}
+        async with self._connect() as db:
+            for i in range(0, len(user_ids), 500):
+                chunk = user_ids[i:i + 500]
+                cur = await db.execute(
+                    "SELECT user_id, data FROM user_state WHERE user_id IN (%s)"
+                    % ",".join("?" * len(chunk)), chunk)
+                found.update(await cur.fetchall())
+        return found
+
+    async def user_state_put_many(self, rows):
+        """Upsert (user_id, data) rows."""
+
+        async def op(db):
+            await db.executemany(
+                "INSERT INTO user_state (user_id, data, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP) "
+                "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+                rows)
+
+        await self._write(op)
+
+    async def user_state_delete_many(self, user_ids):
+
+        async def op(db):
+            await db.executemany("DELETE FROM user_state WHERE user_id=?",
+                                 [(u, ) for u in user_ids])
+
+        await self._write(op)
+
+
+PG_NOW = "to_char(now() AT TIME ZONE 'utc', 'YYYY-MM-DD HH24:MI:SS')"
+
+PG_SCHEMA_SQL = f"""
+CREATE TABLE IF NOT EXISTS users (
+  id BIGINT PRIMARY KEY,
+  username TEXT,
+  balance DOUBLE PRECISION DEFAULT 0,
+  last_country TEXT,
+  created_at TEXT DEFAULT {PG_NOW}
+);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_country TEXT;
+
+CREATE TABLE IF NOT EXISTS bans (
+  id BIGSERIAL PRIMARY KEY,
+  user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+  reason TEXT,
+  created_at TEXT DEFAULT {PG_NOW}
+);
+
+CREATE TABLE IF NOT EXISTS accounts (
+  id BIGSERIAL PRIMARY KEY,
+  country_code TEXT NOT NULL,
+  phone_number TEXT NOT NULL,
+  session_file TEXT,
+  two_fa_password TEXT,
+  uploaded_by BIGINT,
+  status TEXT NOT NULL DEFAULT 'available',
+  price DOUBLE PRECISION,
+  metadata TEXT,
+  created_at TEXT DEFAULT {PG_NOW},
+  last_checked_at TEXT,
+  last_check_result TEXT,
+  cooldown_until TEXT
+);
+ALTER TABLE accounts ADD COLUMN IF NOT EXISTS cooldown_until TEXT;
+
+CREATE TABLE IF NOT EXISTS transactions (
+  id BIGSERIAL PRIMARY KEY,
+  user_id BIGINT REFERENCES users(id),
+  account_id BIGINT REFERENCES accounts(id),
+  amount DOUBLE PRECISION,
+  type TEXT,
+  note TEXT,
+  created_at TEXT DEFAULT {PG_NOW}
+);
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS note TEXT;
+
+CREATE TABLE IF NOT EXISTS transaction_totals (
+  day TEXT NOT NULL,
+  type TEXT NOT NULL,
+  country_code TEXT NOT NULL,
+  count BIGINT NOT NULL,
+  amount DOUBLE PRECISION NOT NULL,
+  PRIMARY KEY (day, type, country_code)
+);
+
+CREATE TABLE IF NOT EXISTS settings (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+  name TEXT PRIMARY KEY,
+  data TEXT NOT NULL,
+  updated_at TEXT DEFAULT {PG_NOW}
+);
+
+CREATE INDEX IF NOT EXISTS idx_accounts_country_status ON accounts(country_code, status, id);
+CREATE INDEX IF NOT EXISTS idx_accounts_status_checked ON accounts(status, last_checked_at);
+CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username));
+
+CREATE TABLE IF NOT EXISTS uploads (
+  id BIGSERIAL PRIMARY KEY,
+  admin_id BIGINT NOT NULL,
+  country_code TEXT NOT NULL,
+  phone_number TEXT,
+  session_file TEXT,
+  phone_code_hash TEXT,
+  state TEXT NOT NULL,
+  otp_attempts INTEGER NOT NULL DEFAULT 0,
+  twofa_attempts INTEGER NOT NULL DEFAULT 0,
+  account_id BIGINT,
+  prompt_message_id BIGINT,
+  updated_at TEXT,
+  expires_at TEXT NOT NULL,
+  created_at TEXT DEFAULT {PG_NOW}
+);
+CREATE INDEX IF NOT EXISTS idx_uploads_admin_state ON uploads(admin_id, state);
+
+CREATE TABLE IF NOT EXISTS otp_traces (
+  id BIGSERIAL PRIMARY KEY,
+  account_id BIGINT,
+  country_code TEXT,
+  source TEXT,
+  reserved_at DOUBLE PRECISION,
+  queued_at DOUBLE PRECISION,
+  admitted_at DOUBLE PRECISION,
+  connected_at DOUBLE PRECISION,
+  handler_at DOUBLE PRECISION,
+  message_at DOUBLE PRECISION,
+  extracted_at DOUBLE PRECISION,
+  sent_at DOUBLE PRECISION NOT NULL
+);
+ALTER TABLE otp_traces ADD COLUMN IF NOT EXISTS queued_at DOUBLE PRECISION;
+ALTER TABLE otp_traces ADD COLUMN IF NOT EXISTS admitted_at DOUBLE PRECISION;
+CREATE INDEX IF NOT EXISTS idx_otp_traces_sent ON otp_traces(sent_at);
+
+CREATE TABLE IF NOT EXISTS user_state (
+  user_id BIGINT PRIMARY KEY,
+  data TEXT NOT NULL,
+  updated_at TEXT DEFAULT {PG_NOW}
+);
+
+CREATE TABLE IF NOT EXISTS waitlist (
+  id BIGSERIAL PRIMARY KEY,
+  country_code TEXT NOT NULL,
+  user_id BIGINT NOT NULL,
+  created_at TEXT DEFAULT {PG_NOW},
+  UNIQUE (country_code, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_waitlist_country ON waitlist(country_code, id);
+CREATE INDEX IF NOT EXISTS idx_transactions_user_history ON transactions(user_id, type, id DESC) INCLUDE (account_id, amount, created_at);
+"""
+
+
+# DSN -> [pool, number of repositories using it]
+PG_POOLS: Dict[str, list] = {}
+
+
+async def acquire_pg_pool(dsn: str, size: int):
+    entry = PG_POOLS.get(dsn)
+    if entry is None:
+        pool = await asyncpg.create_pool(dsn, min_size=1, max_size=size)
+        entry = PG_POOLS.setdefault(dsn, [pool, 0])
+    entry[1] += 1
+    return entry[0]
+
+
+async def release_pg_pool(dsn: str):
+    entry = PG_POOLS.get(dsn)
+    if entry is None:
+        return
+    entry[1] -= 1
+    if entry[1] <= 0:
+        del PG_POOLS[dsn]
+        await entry[0].close()
+
+
+class PostgresRepository:
+    """
+    Same interface as SqliteRepository on PostgreSQL via an asyncpg pool.
+    Claims use SELECT … FOR UPDATE SKIP LOCKED, so concurrent instances never
+    hand out the same account and never wait on each other's row locks.
+    Tenants share one pool per DSN; each tenant other than the first keeps
+    its tables in its own schema, selected per connection checkout.
+    """
+
+    def __init__(self,
+                 dsn: str,
+                 pool_size: int,
+                 schema: Optional[str] = None,
+                 id_base: int = 0):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self.schema = schema
+        self.id_base = id_base
+        self.pool = None
+
+    @asynccontextmanager
+    async def _acquire(self):
+        async with self.pool.acquire() as conn:
+            if self.schema:
+                # the pool's reset (RESET ALL) drops it again on release
+                await conn.execute(f"SET search_path TO {self.schema}")
+            yield conn
+
+    async def init(self):
+        if asyncpg is None:
+            raise RuntimeError(
+                "STORAGE_BACKEND=postgres needs the asyncpg package (pip install asyncpg)")
+        if not self.dsn:
+            raise RuntimeError("STORAGE_BACKEND=postgres needs DATABASE_URL")
+        self.pool = await acquire_pg_pool(self.dsn, self.pool_size)
+        async with self.pool.acquire() as conn:
+            if self.schema:
+                await conn.execute(f"CREATE SCHEMA IF NOT EXISTS {self.schema}")
+        async with self._acquire() as conn:
+            await conn.execute(PG_SCHEMA_SQL)
+            if self.id_base:
+                for table in ("accounts", "uploads"):
+                    await conn.execute(
+                        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), $1) "
+                        f"WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE id >= $1)",
+                        self.id_base)
+
+    async def close(self):
+        if self.pool is not None:
+            await release_pg_pool(self.dsn)
+            self.pool = None
+
+    # users and bans
+    @staticmethod
+    async def _sync_user(conn, user_id: int, username: Optional[str], row):
+        if not row or row[1] != username:
+            if username is not None:
+                await conn.execute(
+                    "UPDATE users SET username=NULL WHERE lower(username)=lower($1) AND id<>$2",
+                    username, user_id)
+            await conn.execute(
+                "INSERT INTO users (id, username) VALUES ($1, $2) "
+                "ON CONFLICT (id) DO UPDATE SET username=excluded.username",
+                user_id, username)
+        return {
+            "id": user_id,
+            "username": username,
+            "balance": row[2] if row else 0.0,
+            "last_country": row[3] if row else None
+        }
+
+    async def get_or_create_user(self, user_id: int,
+                                 username: Optional[str]) -> Dict:
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT id, username, balance, last_country FROM users WHERE id=$1",
+                user_id)
+            if row and row[1] == username:
+                return dict(row)
+            async with conn.transaction():
+                return await self._sync_user(conn, user_id, username, row)
+
+    async def find_user_id(self, username: str) -> Optional[int]:
+        async with self._acquire() as conn:
+            return await conn.fetchval(
+                "SELECT id FROM users WHERE lower(username)=lower($1) LIMIT 1",
+                username)
+
+    async def get_balance(self, user_id: int) -> Optional[float]:
+        async with self._acquire() as conn:
+            return await conn.fetchval("SELECT balance FROM users WHERE id=$1",
+                                       user_id)
+
+    async def set_balance(self, user_id: int,
+                          amount: float) -> Optional[float]:
+        async with self._acquire() as conn:
+            return await conn.fetchval(
+                "UPDATE users SET balance=$1 WHERE id=$2 RETURNING balance",
+                amount, user_id)
+
+    async def adjust_balance(self, user_id: int, delta: float, tx_type: str):
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                balance = await conn.fetchval(
+                    "SELECT balance FROM users WHERE id=$1 FOR UPDATE",
+                    user_id)
+                if balance is None or balance + delta < 0:
+                    return False, balance
+                await conn.execute(
+                    "UPDATE users SET balance = balance + $1 WHERE id=$2",
+                    delta, user_id)
+                await conn.execute(
+                    "INSERT INTO transactions (user_id, amount, type) VALUES ($1, $2, $3)",
+                    user_id, delta, tx_type)
+        return True, balance + delta
+
+    async def find_user_ids(self, usernames: List[str]) -> Dict[str, int]:
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT id, username FROM users WHERE lower(username) = ANY($1::text[])",
+                list({n.lower() for n in usernames}))
+        return {r[1].lower(): r[0] for r in rows}
+
+    async def apply_balance_batch(self, rows: List[tuple]) -> List[tuple]:
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                locked = await conn.fetch(
+                    "SELECT id, balance FROM users WHERE id = ANY($1::bigint[]) "
+                    "ORDER BY id FOR UPDATE", list({r[0] for r in rows}))
+                balances = {r[0]: r[1] for r in locked}
+                results, txs = [], []
+                for user_id, delta, tx_type, note in rows:
+                    balance = balances.get(user_id)
+                    if balance is None or balance + delta < 0:
+                        results.append((False, balance))
+                        continue
+                    balances[user_id] = balance + delta
+                    txs.append((user_id, delta, tx_type, note))
+                    results.append((True, balance + delta))
+                touched = {t[0] for t in txs}
+                await conn.executemany(
+                    "UPDATE users SET balance=$1 WHERE id=$2",
+                    [(balances[u], u) for u in touched])
+                await conn.executemany(
+                    "INSERT INTO transactions (user_id, amount, type, note) VALUES ($1, $2, $3, $4)",
+                    txs)
+        return results
+
+    async def list_user_ids(self) -> List[int]:
+        async with self._acquire() as conn:
+            return [r[0] for r in await conn.fetch("SELECT id FROM users")]
+
+    async def count_users(self) -> int:
+        async with self._acquire() as conn:
+            return await conn.fetchval("SELECT COUNT(*) FROM users")
+
+    async def ban(self, user_id: int, reason: str):
+        async with self._acquire() as conn:
+            await conn.execute(
+                "INSERT INTO bans (user_id, reason) VALUES ($1, $2)", user_id,
+                reason)
+
+    async def unban(self, user_id: int):
+        async with self._acquire() as conn:
+            await conn.execute("DELETE FROM bans WHERE user_id=$1", user_id)
+
+    async def is_banned(self, user_id: int) -> bool:
+        async with self._acquire() as conn:
+            return await conn.fetchval(
+                "SELECT 1 FROM bans WHERE user_id=$1 LIMIT 1",
+                user_id) is not None
+
+    # accounts
+    async def add_account(self, country_code: str, phone: str,
+                          session_file: str, two_fa: Optional[str],
+                          uploaded_by: int, price: float) -> int:
+        async with self._acquire() as conn:
+            return await conn.fetchval(
+                "INSERT INTO accounts (country_code, phone_number, session_file, two_fa_password, uploaded_by, status, price, metadata) "
+                "VALUES ($1, $2, $3, $4, $5, 'available', $6, $7) RETURNING id",
+                country_code, phone, session_file, two_fa, uploaded_by, price,
+                json.dumps({}))
+
+    async def set_account_two_fa(self, acc_id: int,
+                                 password: Optional[str]):
+        async with self._acquire() as conn:
+            await conn.execute(
+                "UPDATE accounts SET two_fa_password=$1 WHERE id=$2", password,
+                acc_id)
+
+    async def delete_account(self, acc_id: int):
+        async with self._acquire() as conn:
+            await conn.execute("DELETE FROM accounts WHERE id=$1", acc_id)
+
+    async def get_account(self, acc_id: int) -> Optional[Dict]:
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(
+                f"SELECT {', '.join(ACCOUNT_FIELDS)} FROM accounts WHERE id=$1",
+                acc_id)
+        return account_row(row)
+
+    CLAIM_SQL = (
+        "WITH c AS (SELECT id FROM accounts "
+        "WHERE country_code=$1 AND status='available' AND session_file IS NOT NULL "
+        "AND (cooldown_until IS NULL OR cooldown_until < $3) "
+        "ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED) "
+        "UPDATE accounts a SET status='reserved', metadata=$2 FROM c WHERE a.id=c.id "
+        "RETURNING a.id, a.phone_number, a.price, a.session_file")
+
+    async def claim_account(self, country_code: str, meta: Dict):
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(self.CLAIM_SQL, country_code,
+                                      json.dumps(meta), now_iso())
+        return tuple(row) if row else None
+
+    async def reserve_for_buyer(self, user_id: int, username: Optional[str],
+                                country_code: str, price: float,
+                                meta: Dict) -> Dict:
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    "SELECT id, username, balance, last_country FROM users WHERE id=$1",
+                    user_id)
+                user = await self._sync_user(conn, user_id, username, row)
+                if user["balance"] < price:
+                    return {"user": user, "result": "insufficient", "account": None}
+                account = await conn.fetchrow(self.CLAIM_SQL, country_code,
+                                              json.dumps(meta), now_iso())
+        return {
+            "user": user,
+            "result": "reserved" if account else "unavailable",
+            "account": tuple(account) if account else None
+        }
+
+    async def update_reserved_metadata(self, acc_id: int, meta: Dict):
+        async with self._acquire() as conn:
+            await conn.execute(
+                "UPDATE accounts SET metadata=$1 WHERE id=$2 AND status='reserved'",
+                json.dumps(meta), acc_id)
+
+    async def reserved_accounts(self):
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT id, metadata FROM accounts WHERE status='reserved'")
+        return [(r[0], r[1]) for r in rows]
+
+    async def release_accounts(self, acc_ids: List[int]) -> List[tuple]:
+        if not acc_ids:
+            return []
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                "UPDATE accounts SET status='available', metadata=NULL "
+                "WHERE id = ANY($1::bigint[]) AND status='reserved' RETURNING id, country_code",
+                list(acc_ids))
+        return [(r[0], r[1]) for r in rows]
+
+    async def complete_sale(self, acc_id: int, user_id: int) -> Dict:
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                acc = account_row(await conn.fetchrow(
+                    f"SELECT {', '.join(ACCOUNT_FIELDS)} FROM accounts WHERE id=$1 FOR UPDATE",
+                    acc_id))
+                balance = await conn.fetchval(
+                    "SELECT balance FROM users WHERE id=$1 FOR UPDATE",
+                    user_id) or 0.0
+                result = sale_outcome(acc, user_id, balance)
+                if result == "sold":
+                    price = acc["price"] or 0.0
+                    await conn.execute(
+                        "UPDATE users SET balance = balance - $1 WHERE id=$2",
+                        price, user_id)
+                    await conn.execute(
+                        "UPDATE accounts SET status='sold', metadata=NULL WHERE id=$1",
+                        acc_id)
+                    await conn.execute(
+                        "INSERT INTO transactions (user_id, account_id, amount, type) VALUES ($1, $2, $3, 'purchase')",
+                        user_id, acc_id, price)
+                    await conn.execute(
+                        "UPDATE users SET last_country=$1 WHERE id=$2",
+                        acc["country_code"], user_id)
+                    balance -= price
+                elif result == "insufficient" and acc["status"] == "reserved":
+                    await conn.execute(
+                        "UPDATE accounts SET status='available', metadata=NULL WHERE id=$1",
+                        acc_id)
+        return {"result": result, "balance": balance, "account": acc}
+
+    async def accounts_to_check(self, checked_before: str, limit: int):
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT id, session_file FROM accounts WHERE status='available' "
+                "AND (last_checked_at IS NULL OR last_checked_at < $1) "
+                "AND (cooldown_until IS NULL OR cooldown_until < $3) "
+                "ORDER BY last_checked_at NULLS FIRST LIMIT $2",
+                checked_before, limit, now_iso())
+        return [tuple(r) for r in rows]
+
+    async def record_session_checks(self, checked_at: str, results,
+                                    dead_ids: List[int]):
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(
+                    "UPDATE accounts SET last_checked_at=$1, last_check_result=$2 WHERE id=$3",
+                    [(checked_at, res, acc_id) for acc_id, res in results])
+                if dead_ids:
+                    await conn.execute(
+                        "UPDATE accounts SET status='dead' WHERE id = ANY($1::bigint[]) AND status='available'",
+                        list(dead_ids))
+
+    async def account_status_counts(self):
+        async with self._acquire() as conn:
+            return [tuple(r) for r in await conn.fetch(
+                "SELECT status, COUNT(*) FROM accounts GROUP BY status")]
+
+    async def available_count(self, country_code: str) -> int:
+        async with self._acquire() as conn:
+            return await conn.fetchval(
+                "SELECT COUNT(*) FROM accounts WHERE country_code=$1 AND status='available' "
+                "AND session_file IS NOT NULL "
+                "AND (cooldown_until IS NULL OR cooldown_until < $2)",
+                country_code, now_iso())
+
+    async def set_account_cooldown(self, acc_id: int, until: Optional[str]):
+        async with self._acquire() as conn:
+            await conn.execute(
+                "UPDATE accounts SET cooldown_until=$1 WHERE id=$2", until,
+                acc_id)
+
+    async def cooling_accounts(self) -> List[tuple]:
+        async with self._acquire() as conn:
+            return [tuple(r) for r in await conn.fetch(
+                "SELECT id, country_code, phone_number, cooldown_until FROM accounts "
+                "WHERE cooldown_until >= $1 ORDER BY cooldown_until", now_iso())]
+
+    # restock waitlist
+    async def waitlist_add(self, country_code: str, user_id: int) -> int:
+        async with self._acquire() as conn:
+            await conn.execute(
+                "INSERT INTO waitlist (country_code, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+                country_code, user_id)
+            return await conn.fetchval(
+                "SELECT COUNT(*) FROM waitlist WHERE country_code=$1 AND id <= "
+                "(SELECT id FROM waitlist WHERE country_code=$1 AND user_id=$2)",
+                country_code, user_id)
+
+    async def waitlist_pop(self, country_code: str, n: int) -> List[int]:
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                "DELETE FROM waitlist WHERE id IN (SELECT id FROM waitlist WHERE country_code=$1 "
+                "ORDER BY id LIMIT $2 FOR UPDATE SKIP LOCKED) RETURNING id, user_id",
+                country_code, n)
+        return [r[1] for r in sorted(rows)]
+
+    async def waitlist_counts(self):
+        async with self._acquire() as conn:
+            return [tuple(r) for r in await conn.fetch(
+                "SELECT country_code, COUNT(*) FROM waitlist GROUP BY country_code ORDER BY 2 DESC")]
+
+    async def country_status_counts(self):
+        async with self._acquire() as conn:
+            return [tuple(r) for r in await conn.fetch(
+                "SELECT country_code, status, COUNT(*) FROM accounts GROUP BY country_code, status ORDER BY country_code, status"
+            )]
+
+    async def list_accounts(self):
+        async with self._acquire() as conn:
+            return [tuple(r) for r in await conn.fetch(
+                "SELECT id, country_code, phone_number, status, price FROM accounts ORDER BY status, country_code"
+            )]
+
+    # transactions
+    async def total_revenue(self) -> float:
+        async with self._acquire() as conn:
+            return await conn.fetchval(
+                "SELECT (SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE type='purchase') "
+                "+ (SELECT COALESCE(SUM(amount), 0) FROM transaction_totals WHERE type='purchase')"
+            ) or 0
+
+    async def transaction_counts(self):
+        async with self._acquire() as conn:
+            return tuple(await conn.fetchrow(
+                "SELECT (SELECT COUNT(*) FROM transactions), "
+                "(SELECT COALESCE(SUM(count), 0) FROM transaction_totals)"))
+
+    async def purchase_history(self, user_id: int, before_id: Optional[int],
+                               limit: int):
+        async with self._acquire() as conn:
+            return [tuple(r) for r in await conn.fetch(
+                "SELECT t.id, t.created_at, t.amount, a.phone_number, a.country_code "
+                "FROM transactions t LEFT JOIN accounts a ON a.id = t.account_id "
+                "WHERE t.user_id=$1 AND t.type='purchase' AND t.id < $2 "
+                "ORDER BY t.id DESC LIMIT $3",
+                user_id, before_id or 2**63 - 1, limit)]
+
+    async def archivable_transactions(self, cutoff: str, limit: int):
+        sql, params = export_query("transactions", None, cutoff, None,
+                                   lambda n: f"${n}")
+        async with self._acquire() as conn:
+            return [tuple(r) for r in await conn.fetch(
+                sql + f" LIMIT {int(limit)}", *params)]
+
+    async def fold_transactions(self, last_id: int, cutoff: str) -> int:
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(FOLD_TRANSACTIONS_SQL.format("$1", "$2"),
+                                   last_id, cutoff)
+                status = await conn.execute(
+                    "DELETE FROM transactions WHERE id <= $1 AND created_at < $2",
+                    last_id, cutoff)
+        return int(status.split()[-1])
+
+    async def iter_export(self, kind: str, since: Optional[str],
+                          until: Optional[str], country: Optional[str]):
+        """Stream export rows through a server-side cursor."""
+        sql, params = export_query(kind, since, until, country,
+                                   lambda n: f"${n}")
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor(sql, *params, prefetch=500):
+                    yield tuple(row)
+
+    # settings
+    async def get_setting(self, key: str) -> Optional[str]:
+        async with self._acquire() as conn:
+            return await conn.fetchval("SELECT value FROM settings WHERE key=$1",
+                                       key)
+
+    async def set_setting(self, key: str, value: str):
+        async with self._acquire() as conn:
+            await conn.execute(
+                "INSERT INTO settings (key, value) VALUES ($1, $2) "
+                "ON CONFLICT (key) DO UPDATE SET value=excluded.value", key,
+                value)
+
+    # Telethon sessions
+    async def session_get(self, name: str) -> Optional[str]:
+        async with self._acquire() as conn:
+            return await conn.fetchval("SELECT data FROM sessions WHERE name=$1",
+                                       name)
+
+    async def session_put(self, name: str, data: str):
+        async with self._acquire() as conn:
+            await conn.execute(
+                f"INSERT INTO sessions (name, data, updated_at) VALUES ($1, $2, {PG_NOW}) "
+                "ON CONFLICT (name) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+                name, data)
+
+    async def session_add_many(self, rows):
+        async with self._acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO sessions (name, data) VALUES ($1, $2) ON CONFLICT (name) DO NOTHING",
+                rows)
+
+    async def session_delete(self, name: str):
+        async with self._acquire() as conn:
+            await conn.execute("DELETE FROM sessions WHERE name=$1", name)
+
+    async def session_names(self) -> set:
+        async with self._acquire() as conn:
+            return {r[0] for r in await conn.fetch("SELECT name FROM sessions")}
+
+    # admin uploads (the upload state machine)
+    async def upload_create(self, admin_id: int, country_code: str,
+                            expires_at: str) -> int:
+        async with self._acquire() as conn:
+            return await conn.fetchval(
+                "INSERT INTO uploads (admin_id, country_code, state, updated_at, expires_at) "
+                "VALUES ($1, $2, 'phone', $3, $4) RETURNING id", admin_id,
+                country_code, now_iso(), expires_at)
+
+    async def upload_get(self, upload_id: int) -> Optional[Dict]:
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(
+                f"SELECT {', '.join(UPLOAD_COLUMNS)} FROM uploads WHERE id=$1",
+                upload_id)
+        return dict(zip(UPLOAD_COLUMNS, row)) if row else None
+
+    async def upload_for_message(self, admin_id: int,
+                                 reply_to_id: Optional[int]) -> Optional[Dict]:
+        states = list(ACTIVE_UPLOAD_STATES)
+        async with self._acquire() as conn:
+            row = None
+            if reply_to_id:
+                row = await conn.fetchrow(
+                    f"SELECT {', '.join(UPLOAD_COLUMNS)} FROM uploads "
+                    "WHERE admin_id=$1 AND prompt_message_id=$2 AND state = ANY($3::text[])",
+                    admin_id, reply_to_id, states)
+            if not row:
+                row = await conn.fetchrow(
+                    f"SELECT {', '.join(UPLOAD_COLUMNS)} FROM uploads "
+                    "WHERE admin_id=$1 AND state = ANY($2::text[]) "
+                    "ORDER BY updated_at DESC, id DESC LIMIT 1", admin_id,
+                    states)
+        return dict(zip(UPLOAD_COLUMNS, row)) if row else None
+
+    async def upload_update(self, upload_id: int, fields: Dict,
+                            from_states: Optional[tuple] = None) -> bool:
+        sets = ", ".join(f"{k}=${i}" for i, k in enumerate(fields, 1))
+        params = [*fields.values(), upload_id]
+        sql = f"UPDATE uploads SET {sets} WHERE id=${len(params)}"
+        if from_states is not None:
+            params.append(list(from_states))
+            sql += f" AND state = ANY(${len(params)}::text[])"
+        async with self._acquire() as conn:
+            return await conn.execute(sql, *params) != "UPDATE 0"
+
+    async def uploads_expired(self, now: str) -> List[Dict]:
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT {', '.join(UPLOAD_COLUMNS)} FROM uploads "
+                "WHERE state = ANY($1::text[]) AND expires_at < $2",
+                list(ACTIVE_UPLOAD_STATES), now)
+        return [dict(zip(UPLOAD_COLUMNS, r)) for r in rows]
+
+    async def uploads_active(self, admin_id: int) -> List[tuple]:
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT id, country_code, phone_number, state FROM uploads "
+                "WHERE admin_id=$1 AND state = ANY($2::text[]) ORDER BY id",
+                admin_id, list(ACTIVE_UPLOAD_STATES))
+        return [tuple(r) for r in rows]
+
+    # OTP latency traces
+    async def otp_trace_add(self, acc_id: int, country_code: Optional[str],
+                            source: Optional[str], points: tuple):
+        async with self._acquire() as conn:
+            await conn.execute(
+                f"INSERT INTO otp_traces (account_id, country_code, source, {', '.join(TRACE_FIELDS)}) "
+                f"VALUES ({', '.join(f'${i}' for i in range(1, 4 + len(TRACE_FIELDS)))})",
+                acc_id,
+                country_code, source, *points)
+
+    async def otp_traces_prune(self, cutoff: float):
+        async with self._acquire() as conn:
+            await conn.execute("DELETE FROM otp_traces WHERE sent_at < $1",
+                               cutoff)
+
+    async def otp_traces_since(self, since: float,
+                               country: Optional[str] = None) -> List[tuple]:
+        sql = f"SELECT country_code, {', '.join(TRACE_FIELDS)} FROM otp_traces WHERE sent_at >= $1"
+        params = [since]
+        if country:
+            sql += " AND country_code=$2"
+            params.append(country)
+        async with self._acquire() as conn:
+            return [tuple(r) for r in await conn.fetch(sql, *params)]
+
+    # user_data (UserStatePersistence)
+    async def user_state_get_many(self, user_ids) -> Dict[int, str]:
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT user_id, data FROM user_state WHERE user_id = ANY($1::bigint[])",
+                list(user_ids))
+        return {r[0]: r[1] for r in rows}
+
+    async def user_state_put_many(self, rows):
+        async with self._acquire() as conn:
+            await conn.executemany(
+                f"INSERT INTO user_state (user_id, data, updated_at) VALUES ($1, $2, {PG_NOW}) "
+                "ON CONFLICT (user_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+                rows)
+
+    async def user_state_delete_many(self, user_ids):
+        async with self._acquire() as conn:
+            await conn.execute(
+                "DELETE FROM user_state WHERE user_id = ANY($1::bigint[])",
+                list(user_ids))
+
+
+def make_repository(tenant: Tenant):
+    backend = CONFIG["STORAGE_BACKEND"]
+    if backend == "postgres":
+        return PostgresRepository(CONFIG["DATABASE_URL"],
+                                  CONFIG["PG_POOL_SIZE"], tenant.pg_schema,
+                                  tenant.id_base)
+    if backend != "sqlite":
+        raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}")
+    return SqliteRepository(tenant.db_path, make_writer(tenant.db_path))
+
+
+def make_writer(path: str) -> Optional[SqliteWriter]:
+    if not CONFIG["GROUP_COMMIT"]:
+        return None
+    return SqliteWriter(path, CONFIG["GROUP_COMMIT_MAX_OPS"],
+                        CONFIG["GROUP_COMMIT_MAX_DELAY_MS"],
+                        CONFIG["WRITE_DURABILITY"])
+
+
+class TenantRouter:
+    """
+    REPO: forwards every call to the repository of the current tenant, so
+    handlers and jobs use one name whichever bot they serve.
+    """
+
+    def __getattr__(self, name):
+        return getattr(current_tenant().repo, name)
+
+
+for _tenant in TENANTS:
+    _tenant.repo = make_repository(_tenant)
+REPO = TenantRouter()
+
+
+def storage_metrics_text() -> str:
+    writer = getattr(REPO, "writer", None)
+    text = f"🗄️ **Storage**: {CONFIG['STORAGE_BACKEND']}"
+    if writer is None:
+        return text + "\n"
+    s = writer.stats()
+    return text + (
+        f" | group commit ({CONFIG['WRITE_DURABILITY']})\n"
+        f"• {s['ops']} writes in {s['commits']} commits | "
+        f"avg batch {s['avg_batch']:.1f}, max {s['max_batch']} | "
+        f"failed {s['failed']} | queued {s['queued']}\n")
+
+
+# ---------- User state persistence ----------
+USER_STATE_EMPTY = "{}"
+
+
+def user_state_json(data: Dict) -> str:
+    return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+
+class UserStatePersistence(BasePersistence):
+    """
+    PTB persistence for context.user_data only, kept in the user_state table.
+    Nothing is loaded at startup: a user's data is read (batched with other
+    users of the same tick) on their first update, and dropped from memory
+    again after `idle_seconds` without updates or when more than
+    `max_resident` users are in memory, least recently seen first. Changes
+    are written behind: PTB hands over user_data every `update_interval`
+    seconds, unchanged data (compared by hash with what was last written) is
+    skipped and the rest goes to the table in one batch.
+    """
+
+    def __init__(self, repo, update_interval: float, idle_seconds: float,
+                 max_resident: int):
+        super().__init__(store_data=PersistenceInput(bot_data=False,
+                                                     chat_data=False,
+                                                     user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        self.repo = repo
+        self.application = None  # set by build_application()
+        self.idle_seconds = idle_seconds
+        self.max_resident = max(1, max_resident)
+        # user_id -> last update (monotonic), least recently seen first
+        self._resident: "OrderedDict[int, float]" = OrderedDict()
+        self._stored: Dict[int, int] = {}  # user_id -> hash of the data last written
+        self._dirty: Dict[int, str] = {}  # user_id -> JSON waiting to be written
+        self._writing: Dict[int, str] = {}  # the batch being written right now
+        # dropped from memory but not from the table; PTB reports them as
+        # dropped at its next persistence update
+        self._evicted: set = set()
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._load_task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        # one write at a time, so flush() also waits for a background flush
+        self._flush_lock = asyncio.Lock()
+        self.loads = 0
+        self.writes = 0
+        self.clean = 0
+        self.evictions = 0
+
+    # startup: nothing is loaded, see refresh_user_data()
+    async def get_user_data(self) -> Dict:
+        return {}
+
+    async def get_chat_data(self) -> Dict:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Dict):
+        pass
+
+    async def update_bot_data(self, data: Dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict):
+        """Called before every update of the user: rehydrates evicted data."""
+        if user_id not in self._resident:
+            text = self._dirty.get(user_id) or self._writing.get(user_id)
+            if text is None:
+                text = await self._load(user_id)
+            # another update of the same user may have loaded it meanwhile
+            if user_id not in self._resident:
+                if text:
+                    user_data.update(json.loads(text))
+                self._stored[user_id] = hash(text or USER_STATE_EMPTY)
+                self.loads += 1
+        self._resident[user_id] = time.monotonic()
+        self._resident.move_to_end(user_id)
+        while len(self._resident) > self.max_resident:
+            self._evict(next(iter(self._resident)))
+
+    async def update_user_data(self, user_id: int, data: Dict):
+        self._stage(user_id, data)
+
+    async def drop_user_data(self, user_id: int):
+        if user_id in self._evicted:
+            # dropped by _evict(): only the memory copy goes
+            self._evicted.discard(user_id)
+            if user_id in self._resident:
+                # back since the eviction; PTB left their changes out of this
+                # persistence update (update_ids -= delete_ids), take them now
+                data = self.application.user_data.get(user_id)
+                if data is not None:
+                    self._stage(user_id, data)
+            return
+        self._resident.pop(user_id, None)
+        self._stored.pop(user_id, None)
+        self._dirty[user_id] = USER_STATE_EMPTY
+        self._schedule_flush()
+
+    async def flush(self):
+        await self._flush()
+
+    def _stage(self, user_id: int, data: Dict):
+        try:
+            text = user_state_json(data)
+        except (TypeError, ValueError) as e:
+            logger.error("user_data of %s is not JSON serializable: %s",
+                         user_id, e)
+            return
+        digest = hash(text)
+        if self._stored.get(user_id, hash(USER_STATE_EMPTY)) == digest:
+            self.clean += 1
+            return
+        self._stored[user_id] = digest
+        self._dirty[user_id] = text
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # runs after the other update_user_data() calls of this persistence update
+        await asyncio.sleep(0)
+        self._flush_task = None
+        await self._flush()
+
+    async def _flush(self):
+        async with self._flush_lock:
+            await self._flush_dirty()
+
+    async def _flush_dirty(self):
+        if not self._dirty:
+            return
+        self._writing, self._dirty = self._dirty, {}
+        puts = [(u, t) for u, t in self._writing.items()
+                if t != USER_STATE_EMPTY]
+        drops = [u for u, t in self._writing.items() if t == USER_STATE_EMPTY]
+        try:
+            if puts:
+                await self.repo.user_state_put_many(puts)
+            if drops:
+                await self.repo.user_state_delete_many(drops)
+            self.writes += len(self._writing)
+        except Exception as e:
+            logger.error("Writing user_data of %s users failed: %s",
+                         len(self._writing), e)
+            # keep them for the next flush, unless they changed again since
+            for user_id, text in self._writing.items():
+                self._dirty.setdefault(user_id, text)
+        finally:
+            self._writing = {}
+
+    async def _load(self, user_id: int) -> Optional[str]:
+        fut = self._loading.get(user_id)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._loading[user_id] = fut
+            if self._load_task is None:
+                self._load_task = asyncio.create_task(self._load_batch())
+        return await asyncio.shield(fut)
+
+    async def _load_batch(self):
+        # let the other updates of this tick join the query
+        await asyncio.sleep(0)
+        pending, self._loading = self._loading, {}
+        self._load_task = None
+        try:
+            found = await self.repo.user_state_get_many(pending)
+        except Exception as e:
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for user_id, fut in pending.items():
+            if not fut.done():
+                fut.set_result(found.get(user_id))
+
+    def _evict(self, user_id: int):
+        data = self.application.user_data.get(user_id)
+        if data is not None:
+            # changes since the last persistence update
+            self._stage(user_id, data)
+        self.application.drop_user_data(user_id)
+        self._evicted.add(user_id)
+        self._resident.pop(user_id, None)
+        self._stored.pop(user_id, None)
+        self.evictions += 1
+
+    async def evict_idle(self) -> int:
+        """Drop users idle for idle_seconds from memory; returns how many."""
+        cutoff = time.monotonic() - self.idle_seconds
+        evicted = 0
+        while self._resident:
+            user_id, seen = next(iter(self._resident.items()))
+            if seen > cutoff:
+                break
+            self._evict(user_id)
+            evicted += 1
+        await self._flush()
+        return evicted
+
+    def stats(self) -> Dict:
+        return {
+            "resident": len(self._resident),
+            "loads": self.loads,
+            "writes": self.writes,
+            "clean": self.clean,
+            "evictions": self.evictions,
+            "dirty": len(self._dirty),
+        }
+
+
+def make_user_state_persistence(repo) -> UserStatePersistence:
+    return UserStatePersistence(repo, CONFIG["USER_STATE_FLUSH_SECONDS"],
+                                CONFIG["USER_STATE_IDLE_MINUTES"] * 60,
+                                CONFIG["USER_STATE_MAX_RESIDENT"])
+
+
+async def evict_user_state_tick():
+    persistence = current_tenant().app.persistence
+    evicted = await persistence.evict_idle()
+    if evicted:
+        logger.info("Dropped user_data of %d idle users from memory", evicted)
+
+
+def user_state_metrics_text() -> str:
+    s = current_tenant().app.persistence.stats()
+    return (f"👤 **User state**: {s['resident']} users in memory "
+            f"(max {CONFIG['USER_STATE_MAX_RESIDENT']}) | "
+            f"loaded {s['loads']} | written {s['writes']}, "
+            f"{s['clean']} unchanged skipped | evicted {s['evictions']} | "
+            f"dirty {s['dirty']}\n")
+
+
+# ---------- Exports (gzip CSV / NDJSON, streamed) ----------
+EXPORT_KINDS = tuple(EXPORT_COLUMNS)
+EXPORT_FORMATS = ("csv", "ndjson")
+EXPORT_BATCH_ROWS = 1000
+EXPORT_LOCK = asyncio.Lock()
+
+
+def encode_export_rows(fmt: str, columns: tuple, rows: List[tuple]) -> bytes:
+    if fmt == "ndjson":
+        return "".join(
+            json.dumps(dict(zip(columns, row)), default=str, ensure_ascii=False)
+            + "\n" for row in rows).encode()
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+    return out.getvalue().encode()
+
+
+class ExportPart:
+    """One gzip output file; its file I/O runs in a thread."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rows = 0
+        self._raw = open(path, "wb")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+
+    def write(self, data: bytes) -> int:
+        """Compress data; returns the compressed size written so far."""
+        self._gz.write(data)
+        return self._raw.tell()
+
+    def close(self):
+        self._gz.close()
+        self._raw.close()
+
+
+async def write_export(kind: str, fmt: str, since: Optional[str],
+                       until: Optional[str], country: Optional[str],
+                       directory: str, part_bytes: int) -> List[ExportPart]:
+    """
+    Stream rows from REPO.iter_export into gzip files under `directory`,
+    starting a new self-contained part (with its own CSV header) whenever
+    the compressed size reaches part_bytes. Only one batch of rows is held
+    in memory; compression and writes run off the event loop.
+    """
+    columns = EXPORT_COLUMNS[kind]
+    parts: List[ExportPart] = []
+    part = None
+    batch: List[tuple] = []
+
+    async def flush():
+        nonlocal part
+        if part is None:
+            path = os.path.join(directory,
+                                f"{kind}_part{len(parts) + 1}.{fmt}.gz")
+            part = await asyncio.to_thread(ExportPart, path)
+            parts.append(part)
+            if fmt == "csv":
+                await asyncio.to_thread(part.write,
+                                        encode_export_rows(fmt, (), [columns]))
+        size = await asyncio.to_thread(part.write,
+                                       encode_export_rows(fmt, columns, batch))
+        part.rows += len(batch)
+        batch.clear()
+        if size >= part_bytes:
+            await asyncio.to_thread(part.close)
+            part = None
+
+    try:
+        async for row in REPO.iter_export(kind, since, until, country):
+            batch.append(row)
+            if len(batch) >= EXPORT_BATCH_ROWS:
+                await flush()
+        if batch or not parts:
+            await flush()
+    finally:
+        if part is not None:
+            await asyncio.to_thread(part.close)
+    return parts
+
+
+# ---------- Transaction archival ----------
+# Old transactions are appended to monthly gzip NDJSON files (one gzip member
+# per batch, so files are append-only) and then folded into transaction_totals
+# and deleted in one DB transaction. A crash between the two steps re-archives
+# the batch next run; search_archive drops the duplicate ids.
+ARCHIVE_COLUMNS = EXPORT_COLUMNS["transactions"]
+ARCHIVE_LOCK = asyncio.Lock()
+
+
+def archive_files() -> List[str]:
+    directory = current_tenant().archive_dir
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if f.startswith("transactions_") and f.endswith(".ndjson.gz"))
+
+
+def append_archive(rows: List[tuple]):
+    """Append rows to their month's archive file and fsync it."""
+    by_month: Dict[str, List[tuple]] = {}
+    for row in rows:
+        by_month.setdefault(str(row[1])[:7], []).append(row)
+    directory = current_tenant().archive_dir
+    os.makedirs(directory, exist_ok=True)
+    for month, month_rows in by_month.items():
+        path = os.path.join(directory,
+                            f"transactions_{month}.ndjson.gz")
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+                gz.write(encode_export_rows("ndjson", ARCHIVE_COLUMNS,
+                                            month_rows))
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+def search_archive(field: str, value, month: Optional[str],
+                   limit: int = 50000) -> List[Dict]:
+    """Archived transactions whose `field` equals value, optionally in one month."""
+    matches, seen = [], set()
+    for path in archive_files():
+        if month and not os.path.basename(path).startswith(
+                f"transactions_{month}"):
+            continue
+        with gzip.open(path, "rt") as f:
+            for line in f:
+                rec = json.loads(line)
+                if rec.get(field) != value or rec["id"] in seen:
+                    continue
+                seen.add(rec["id"])
+                matches.append(rec)
+                if len(matches) >= limit:
+                    return matches
+    return matches
+
+
+async def archive_transactions(cutoff: str) -> int:
+    """Archive every transaction created before cutoff (UTC 'YYYY-MM-DD HH:MM:SS')."""
+    archived = 0
+    stats = current_tenant().archive_stats
+    async with ARCHIVE_LOCK:
+        try:
+            while True:
+                rows = await REPO.archivable_transactions(
+                    cutoff, CONFIG["ARCHIVE_BATCH"])
+                if not rows:
+                    break
+                await asyncio.to_thread(append_archive, rows)
+                archived += await REPO.fold_transactions(rows[-1][0], cutoff)
+            stats["last_error"] = None
+        except Exception as e:
+            stats["last_error"] = str(e)
+            raise
+        finally:
+            stats["runs"] += 1
+            stats["archived"] += archived
+            stats["last_run"] = now_iso()
+    if archived:
+        logger.info("Archived %d transactions created before %s", archived,
+                    cutoff)
+    return archived
+
+
+def archive_cutoff(days: float) -> str:
+    # created_at defaults to CURRENT_TIMESTAMP, which is UTC
+    return (datetime.now(ZoneInfo("UTC")) -
+            timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+async def archive_transactions_tick():
+    if CONFIG["ARCHIVE_AFTER_DAYS"] <= 0:
+        return
+    try:
+        await archive_transactions(archive_cutoff(CONFIG["ARCHIVE_AFTER_DAYS"]))
+    except Exception:
+        logger.exception("Transaction archival failed")
+
+
+# ---------- Backups and SQLite maintenance ----------
+# Snapshots use the online backup API a few pages at a time, so the copy only
+# ever holds a short read lock; everything runs on plain sqlite3 connections
+# in a worker thread, never on the event loop. Only the SQLite backend is
+# covered: with STORAGE_BACKEND=postgres the tenant's file holds no business
+# data and the server needs its own backups (pg_dump, base backups).
+BACKUP_LOCK = asyncio.Lock()
+BACKUP_RESTART_LIMIT = 3
+POSTGRES_BACKUP_NOTE = ("PostgreSQL storage is not snapshotted by the bot; "
+                        "back the server up with pg_dump or base backups.")
+
+
+def sqlite_backed() -> bool:
+    """Whether the current tenant's data lives in its SQLite file."""
+    return isinstance(current_tenant().repo, SqliteRepository)
+
+
+class BackupRestarted(Exception):
+    pass
+
+
+def snapshot_db(src_path: str, dst_path: str, pages: int,
+                sleep: float) -> Dict:
+    """
+    Copy src_path to dst_path in `pages`-page steps and quick_check the copy.
+    A write from another connection restarts the copy; after
+    BACKUP_RESTART_LIMIT restarts the rest is copied in a single step (one
+    read transaction, which WAL writers don't wait on).
+    """
+    stats = {"steps": 0, "restarts": 0, "pages": 0}
+    last = [None]
+
+    def progress(status, remaining, total):
+        stats["steps"] += 1
+        stats["pages"] = total
+        # every step copies `pages` pages, so no progress means it started over
+        if last[0] is not None and remaining >= last[0]:
+            stats["restarts"] += 1
+            if stats["restarts"] >= BACKUP_RESTART_LIMIT:
+                raise BackupRestarted()
+        last[0] = remaining
+        if remaining and sleep:
+            time.sleep(sleep)  # let writers in between steps
+
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
+    try:
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        except BackupRestarted:
+            src.backup(dst, pages=-1)
+        dst.execute("PRAGMA journal_mode=DELETE")
+        stats["check"] = dst.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    return stats
+
+
+def backup_files() -> List[str]:
+    directory = CONFIG["BACKUP_DIR"]
+    if not os.path.isdir(directory):
+        return []
+    stem = os.path.splitext(os.path.basename(current_tenant().db_path))[0]
+    # exact pattern: another tenant's file may be named <stem>_<tenant>.db
+    pattern = re.compile(re.escape(stem) + r"_\d{8}_\d{6}\.db")
+    return sorted((os.path.join(directory, f)
+                   for f in os.listdir(directory) if pattern.fullmatch(f)),
+                  reverse=True)
+
+
+def take_backup() -> Dict:
+    os.makedirs(CONFIG["BACKUP_DIR"], exist_ok=True)
+    db_path = current_tenant().db_path
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    path = os.path.join(CONFIG["BACKUP_DIR"],
+                        f"{stem}_{datetime.now(IST).strftime('%Y%m%d_%H%M%S')}.db")
+    partial = path + ".partial"
+    try:
+        stats = snapshot_db(db_path, partial, CONFIG["BACKUP_PAGES_PER_STEP"],
+                            CONFIG["BACKUP_STEP_SLEEP_MS"] / 1000)
+        if stats["check"] != "ok":
+            raise RuntimeError(f"snapshot failed quick_check: {stats['check']}")
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    stats["path"] = path
+    stats["size"] = os.path.getsize(path)
+    return stats
+
+
+def rotate_backups() -> int:
+    """Keep the newest BACKUP_KEEP snapshots plus the newest of each of the last BACKUP_KEEP_DAILY days."""
+    files = backup_files()
+    keep = set(files[:CONFIG["BACKUP_KEEP"]])
+    days = set()
+    for path in files:
+        day = path.rsplit("_", 2)[-2]
+        if day not in days and len(days) < CONFIG["BACKUP_KEEP_DAILY"]:
+            days.add(day)
+            keep.add(path)
+    removed = 0
+    for path in files:
+        if path not in keep:
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def sqlite_optimize() -> str:
+    db = sqlite3.connect(current_tenant().db_path, isolation_level=None)
+    try:
+        analyzed = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone()
+        if not analyzed:
+            db.execute("ANALYZE")
+            return "full ANALYZE"
+        db.execute("PRAGMA analysis_limit=1000")
+        db.execute("PRAGMA optimize")
+        return "optimize"
+    finally:
+        db.close()
+
+
+def sqlite_checkpoint() -> str:
+    """PASSIVE checkpoint, then try to truncate the WAL without waiting long on readers."""
+    db = sqlite3.connect(current_tenant().db_path, isolation_level=None)
+    try:
+        busy, log, done = db.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        if log < 0:
+            return "not in WAL mode"
+        db.execute("PRAGMA busy_timeout=100")
+        truncated = db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0] == 0
+        return f"{done}/{log} frames{', WAL truncated' if truncated else ''}"
+    finally:
+        db.close()
+
+
+def sqlite_incremental_vacuum() -> str:
+    db = sqlite3.connect(current_tenant().db_path, isolation_level=None)
+    try:
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return "skipped (auto_vacuum not incremental, see /backup vacuum)"
+        free = db.execute("PRAGMA freelist_count").fetchone()[0]
+        pages = min(free, CONFIG["VACUUM_PAGES_PER_RUN"])
+        if pages:
+            db.execute("PRAGMA busy_timeout=5000")
+            db.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+        return f"freed {pages} of {free} free pages"
+    finally:
+        db.close()
+
+
+def sqlite_convert_incremental() -> str:
+    """Switch auto_vacuum to INCREMENTAL; rebuilds the whole file (full VACUUM)."""
+    db = sqlite3.connect(current_tenant().db_path, isolation_level=None)
+    try:
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return "already incremental"
+        size = os.path.getsize(current_tenant().db_path)
+        db.execute("PRAGMA busy_timeout=30000")
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.execute("VACUUM")
+        return (f"rebuilt {size / 1024 / 1024:.1f} MB → "
+                f"{os.path.getsize(current_tenant().db_path) / 1024 / 1024:.1f} MB")
+    finally:
+        db.close()
+
+
+async def backup_and_maintain(backup: bool = True,
+                              convert: bool = False) -> Dict:
+    """
+    Snapshot, rotate, optimize, checkpoint and vacuum the tenant's SQLite
+    file, timing each step. convert: switch to incremental auto_vacuum first
+    (after the snapshot); writes wait while the file is rebuilt.
+    """
+    steps = []
+
+    async def step(name, fn):
+        started = time.monotonic()
+        detail = await asyncio.to_thread(fn)
+        steps.append((name, time.monotonic() - started, detail))
+        return detail
+
+    async with BACKUP_LOCK:
+        try:
+            if backup and CONFIG["BACKUP_KEEP"] > 0:
+                stats = await step("backup", take_backup)
+                steps[-1] = (steps[-1][0], steps[-1][1], (
+                    f"`{os.path.basename(stats['path'])}`, {stats['size'] / 1024 / 1024:.1f} MB, "
+                    f"{stats['steps']} steps, {stats['restarts']} restarts"))
+                await step("rotate", lambda: f"removed {rotate_backups()}")
+            if convert:
+                await step("convert", sqlite_convert_incremental)
+            await step("optimize", sqlite_optimize)
+            await step("checkpoint", sqlite_checkpoint)
+            await step("vacuum", sqlite_incremental_vacuum)
+            error = None
+        except Exception as e:
+            logger.exception("Backup/maintenance failed")
+            error = str(e)
+    report = current_tenant().maintenance_report
+    report.update(at=now_iso(), steps=steps, error=error)
+    logger.info("Maintenance: %s%s", ", ".join(
+        f"{name} {secs:.2f}s" for name, secs, _ in steps),
+                f" (failed: {error})" if error else "")
+    return report
+
+
+async def backup_tick():
+    if sqlite_backed():
+        await backup_and_maintain()
+
+
+def maintenance_report_text() -> str:
+    if not sqlite_backed():
+        return "💾 **Backup/maintenance**: not used with PostgreSQL\n"
+    r = current_tenant().maintenance_report
+    if not r["at"]:
+        return "💾 **Backup/maintenance**: not run yet\n"
+    text = f"💾 **Backup/maintenance** ({r['at'][:16].replace('T', ' ')})\n"
+    for name, secs, detail in r["steps"]:
+        text += f"• {name}: {secs:.2f}s — {detail}\n"
+    if r["error"]:
+        text += f"• ❌ failed: {r['error']}\n"
+    return text
+
+
+# ---------- Flood control (per-user token buckets) ----------
+class TokenBucketLimiter:
+    """
+    Token bucket per user id, kept in an LRU-ordered dict.
+    Each entry is a small list [tokens, last_seen, warned]. A bucket that has been
+    idle long enough to refill completely carries no state, so it is evicted;
+    the dict is also capped at max_entries (oldest first).
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, max_entries: int):
+        self.name = name
+        self.rate = rate
+        self.burst = float(burst)
+        self.max_entries = max_entries
+        self.idle_ttl = self.burst / rate if rate > 0 else 3600.0
+        self._buckets: "OrderedDict[int, list]" = OrderedDict()
+        self.allowed = 0
+        self.throttled = 0
+        self.evicted = 0
+
+    def _evict(self, now: float):
+        buckets = self._buckets
+        while buckets:
+            oldest = next(iter(buckets.values()))
+            if len(buckets) > self.max_entries or now - oldest[1] >= self.idle_ttl:
+                buckets.popitem(last=False)
+                self.evicted += 1
+            else:
+                break
+
+    def consume(self, key: int, cost: float = 1.0):
+        """
+        Take `cost` tokens from key's bucket.
+        Returns (wait_seconds, first_throttle): wait_seconds is 0 when allowed;
+        first_throttle is True only for the first rejection of a streak.
+        """
+        now = time.monotonic()
+        b = self._buckets.get(key)
+        if b is None:
+            b = [self.burst, now, False]
+            self._buckets[key] = b
+        else:
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+            self._buckets.move_to_end(key)
+        self._evict(now)
+        if b[0] >= cost:
+            b[0] -= cost
+            b[2] = False
+            self.allowed += 1
+            return 0.0, False
+        self.throttled += 1
+        first = not b[2]
+        b[2] = True
+        wait = (cost - b[0]) / self.rate if self.rate > 0 else 60.0
+        return wait, first
+
+    def stats(self) -> Dict:
+        return {
+            "tracked": len(self._buckets),
+            "allowed": self.allowed,
+            "throttled": self.throttled,
+            "evicted": self.evicted,
+        }
+
+
+FLOOD_UI = TokenBucketLimiter("ui", CONFIG["FLOOD_UI_RATE"],
+                              CONFIG["FLOOD_UI_BURST"],
+                              CONFIG["FLOOD_MAX_TRACKED_USERS"])
+FLOOD_HEAVY = TokenBucketLimiter("heavy", CONFIG["FLOOD_HEAVY_RATE"],
+                                 CONFIG["FLOOD_HEAVY_BURST"],
+                                 CONFIG["FLOOD_MAX_TRACKED_USERS"])
+
+# callbacks that open DB connections and Telethon clients
+HEAVY_CALLBACK_PREFIXES = ("getotp_", "country_", "done_", "notify_")
+
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs in handler group -1, before callback_router and the command handlers.
+    Throttled updates are answered with a cooldown toast and not processed further.
+    """
+    user = update.effective_user
+    if not user or user.id in tenant_config("ADMIN_IDS"):
+        return
+    q = update.callback_query
+    command = update.message.text if update.message and update.message.text else ""
+    # /start buy_<CC> deep links claim a number just like a country tap
+    if (q and (q.data or "").startswith(HEAVY_CALLBACK_PREFIXES)
+            or command.startswith("/start buy_")):
+        limiter = FLOOD_HEAVY
+    else:
+        limiter = FLOOD_UI
+    wait, first = limiter.consume(user.id)
+    if not wait:
+        return
+    current_tenant().usage["throttled"] += 1
+    text = f"⏳ Slow down! Try again in {math.ceil(wait)}s."
+    try:
+        if q:
+            await q.answer(text)
+        elif update.message and first:
+            # only reply once per throttle streak so we don't amplify the flood
+            await update.message.reply_text(text)
+    except Exception:
+        pass
+    raise ApplicationHandlerStop
+
+
+def flood_metrics_text() -> str:
+    text = "🚦 **Flood control**\n"
+    for limiter in (FLOOD_UI, FLOOD_HEAVY):
+        s = limiter.stats()
+        text += (f"• {limiter.name}: {s['tracked']} tracked | "
+                 f"allowed {s['allowed']} | throttled {s['throttled']} | "
+                 f"evicted {s['evicted']}\n")
+    return text
+
+
+# ---------- Outbound message scheduler (Bot API limits) ----------
+PRIORITY_OTP = 0
+PRIORITY_UI = 1
+PRIORITY_ADMIN = 2
+PRIORITY_BROADCAST = 3
+PRIORITY_NAMES = ("otp", "purchase UI", "admin notices", "broadcast")
+OUTBOUND_SCAN = 64  # queued requests per class looked at when their chats are throttled
+# endpoints that post or change a message, the ones Telegram's send limits
+# count; everything else (getChatMember, answerCallbackQuery, getFile, ...)
+# only waits out a RetryAfter pause
+OUTBOUND_MESSAGE_ENDPOINTS = frozenset((
+    "sendMessage", "sendPhoto", "sendDocument", "sendVideo", "sendAudio",
+    "sendAnimation", "sendVoice", "sendVideoNote", "sendSticker",
+    "sendMediaGroup", "sendLocation", "sendVenue", "sendContact", "sendPoll",
+    "sendDice", "sendInvoice", "copyMessage", "copyMessages",
+    "forwardMessage", "forwardMessages", "editMessageText",
+    "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup",
+    "editMessageLiveLocation", "stopMessageLiveLocation", "stopPoll"))
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """
+    Installed as the rate limiter of every tenant's Application, so every Bot
+    API request made through app.bot / context.bot passes through it. Requests
+    wait in one FIFO per priority class and are released highest class first,
+    spaced to stay under the global rate and per-chat token buckets (groups
+    have their own, slower bucket). Only OUTBOUND_MESSAGE_ENDPOINTS are queued
+    and spaced; other methods go straight out unless the bot is paused.
+    Telegram's limits are per bot, so spacing, buckets and RetryAfter pauses
+    are kept per bot: a RetryAfter pauses that bot's requests for the time
+    Telegram asks and the request is retried at the head of its class.
+
+    Callers pick the class with rate_limit_args={"priority": PRIORITY_...};
+    requests without it count as purchase UI.
+    """
+
+    def __init__(self,
+                 global_rate: float,
+                 chat_rate: float,
+                 chat_burst: int,
+                 group_per_minute: int,
+                 max_retries: int = 3):
+        self.interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.chats = TokenBucketLimiter("chat", chat_rate, chat_burst, 100000)
+        self.groups = TokenBucketLimiter("group", group_per_minute / 60.0,
+                                         group_per_minute, 10000)
+        self.max_retries = max_retries
+        self._queues = [deque() for _ in PRIORITY_NAMES]
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._bots = 0  # applications sharing the dispatcher
+        self._next_slot: Dict[str, float] = {}  # bot key -> next free slot
+        self.paused_until: Dict[str, float] = {}
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.sent_by_bot: Dict[str, int] = {}
+        self.max_wait = [0.0] * len(PRIORITY_NAMES)
+        self.retry_after_hits = 0
+
+    async def initialize(self):
+        self._bots += 1
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        self._bots = max(0, self._bots - 1)
+        if self._bots:
+            return  # other applications still send through it
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for queue in self._queues:
+            while queue:
+                _, _, fut, _ = queue.popleft()
+                if not fut.done():
+                    fut.cancel()
+
+    def _chat_wait(self, bot: str, chat_id) -> float:
+        if chat_id is None:
+            return 0.0
+        group = isinstance(chat_id, str) or chat_id < 0
+        wait, _ = (self.groups if group else self.chats).consume(
+            (bot, chat_id))
+        return wait
+
+    def _grant_next(self, now: float) -> Optional[float]:
+        """Release the first eligible request; otherwise return how long until a bot or chat frees up."""
+        shortest = None
+        for priority, queue in enumerate(self._queues):
+            for i, (bot, chat_id, fut, queued_at) in enumerate(
+                    itertools.islice(queue, OUTBOUND_SCAN)):
+                if fut.done():
+                    continue
+                wait = max(self.paused_until.get(bot, 0.0),
+                           self._next_slot.get(bot, 0.0)) - now
+                if wait <= 0:
+                    wait = self._chat_wait(bot, chat_id)
+                if wait > 0:
+                    shortest = wait if shortest is None else min(shortest, wait)
+                    continue
+                del queue[i]
+                self._next_slot[bot] = now + self.interval
+                self.sent[priority] += 1
+                self.sent_by_bot[bot] = self.sent_by_bot.get(bot, 0) + 1
+                self.max_wait[priority] = max(self.max_wait[priority],
+                                              now - queued_at)
+                fut.set_result(None)
+                return None
+        return shortest if shortest is not None else 0.05
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not any(self._queues):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            wait = self._grant_next(loop.time())
+            if wait is None:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _wait_turn(self, priority: int, bot: str, chat_id, retry: bool):
+        if self._task is None:
+            return  # not initialized (e.g. during shutdown): send directly
+        fut = asyncio.get_running_loop().create_future()
+        entry = (bot, chat_id, fut, asyncio.get_running_loop().time())
+        if retry:
+            self._queues[priority].appendleft(entry)
+        else:
+            self._queues[priority].append(entry)
+        self._wakeup.set()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            try:
+                self._queues[priority].remove(entry)
+            except ValueError:
+                pass
+            raise
+
+    async def _wait_pause(self, bot: str):
+        loop = asyncio.get_running_loop()
+        wait = self.paused_until.get(bot, 0.0) - loop.time()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.paused_until.get(bot, 0.0) - loop.time()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data,
+                              rate_limit_args):
+        priority = (rate_limit_args or {}).get("priority", PRIORITY_UI)
+        chat_id = data.get("chat_id")
+        # callback is the bound Bot._do_post of the tenant's bot
+        bot = getattr(callback, "__self__", None)
+        bot = bot.token.split(":", 1)[0] if bot is not None else ""
+        spaced = endpoint in OUTBOUND_MESSAGE_ENDPOINTS
+        for attempt in range(self.max_retries + 1):
+            if spaced:
+                await self._wait_turn(priority, bot, chat_id, retry=attempt > 0)
+            else:
+                await self._wait_pause(bot)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after_hits += 1
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                loop = asyncio.get_running_loop()
+                self.paused_until[bot] = max(self.paused_until.get(bot, 0.0),
+                                             loop.time() + float(retry_after))
+                logger.warning(
+                    "Bot API RetryAfter %ss on %s; pausing sends of bot %s",
+                    retry_after, endpoint, bot)
+                if attempt == self.max_retries:
+                    raise
+
+    def stats(self) -> Dict:
+        loop_time = asyncio.get_event_loop().time()
+        return {
+            "classes": [{
+                "name": name,
+                "depth": len(self._queues[i]),
+                "sent": self.sent[i],
+                "max_wait": self.max_wait[i],
+            } for i, name in enumerate(PRIORITY_NAMES)],
+            "retry_after": self.retry_after_hits,
+            "paused_for": max([0.0] + [
+                until - loop_time for until in self.paused_until.values()
+            ]),
+        }
+
+
+OUTBOUND = OutboundScheduler(CONFIG["OUTBOUND_GLOBAL_RATE"],
+                             CONFIG["OUTBOUND_CHAT_RATE"],
+                             CONFIG["OUTBOUND_CHAT_BURST"],
+                             CONFIG["OUTBOUND_GROUP_PER_MINUTE"])
+
+
+def outbound_metrics_text() -> str:
+    s = OUTBOUND.stats()
+    text = "📤 **Outbound queue**\n"
+    for c in s["classes"]:
+        text += (f"• {c['name']}: queued {c['depth']} | sent {c['sent']} | "
+                 f"max wait {c['max_wait']:.1f}s\n")
+    text += f"• RetryAfter hits {s['retry_after']}"
+    if s["paused_for"] > 0:
+        text += f" | paused {s['paused_for']:.0f}s more"
+    return text + "\n"
+
+
+def notify_admins(text: str, **kwargs):
+    """Send a notice to every admin of the current tenant in the background at admin-notice priority."""
+    app = current_tenant().app
+    if app is None:
+        return
+
+    async def _send(admin_id: int):
+        try:
+            await app.bot.send_message(
+                admin_id,
+                text,
+                rate_limit_args={"priority": PRIORITY_ADMIN},
+                **kwargs)
+        except Exception as e:
+            logger.info("Admin notice to %s failed: %s", admin_id, e)
+
+    for admin_id in tenant_config("ADMIN_IDS"):
+        app.create_task(_send(admin_id))
+
+
+# ---------- Session store (StringSession blobs in the DB) ----------
+class SessionStore:
+    """
+    Telethon sessions kept as StringSession strings in the `sessions` table,
+    keyed by accounts.session_file. Rows are loaded lazily and cached (LRU),
+    so building a client needs no per-account file I/O. One cache serves all
+    tenants; entries are keyed by (tenant, name) since names are phone numbers.
+    """
+
+    def __init__(self, max_cached: int):
+        self.max_cached = max_cached
+        self._cache: "OrderedDict[tuple, str]" = OrderedDict()
+
+    def _remember(self, key: tuple, data: str):
+        self._cache[key] = data
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    async def get(self, name: str) -> Optional[str]:
+        key = (current_tenant().name, name)
+        data = self._cache.get(key)
+        if data is not None:
+            self._cache.move_to_end(key)
+            return data
+        data = await REPO.session_get(name)
+        if data is None:
+            return None
+        self._remember(key, data)
+        return data
+
+    async def put(self, name: str, data: str):
+        key = (current_tenant().name, name)
+        if not data or self._cache.get(key) == data:
+            return
+        await REPO.session_put(name, data)
+        self._remember(key, data)
+
+    async def delete(self, name: str):
+        self._cache.pop((current_tenant().name, name), None)
+        await REPO.session_delete(name)
+
+
+SESSION_STORE = SessionStore(CONFIG["SESSION_CACHE_SIZE"])
+
+
+def use_db_sessions() -> bool:
+    return CONFIG["SESSION_BACKEND"] == "db"
+
+
+def read_session_file(path: str) -> Optional[str]:
+    """Convert a Telethon SQLite .session file to a StringSession string (sync)."""
+    if not os.path.exists(path):
+        return None
+    sess = SQLiteSession(path)
+    try:
+        if not sess.auth_key:
+            return None
+        return StringSession.save(sess)
+    finally:
+        sess.close()
+
+
+async def migrate_session_files() -> Dict[str, int]:
+    """
+    One-shot import of SESSION_DIR/*.session into the sessions table.
+    Already-imported names are skipped; the files are left in place as a backup.
+    """
+    names = await asyncio.to_thread(
+        lambda: sorted(f for f in os.listdir(current_tenant().session_dir)
+                       if f.endswith(".session")))
+    existing = await REPO.session_names()
+    report = {"migrated": 0, "skipped": 0, "failed": 0}
+    rows = []
+    for name in names:
+        if name in existing:
+            report["skipped"] += 1
+            continue
+        try:
+            data = await asyncio.to_thread(read_session_file,
+                                           os.path.join(current_tenant().session_dir, name))
+        except Exception as e:
+            logger.warning("Session migration failed for %s: %s", name, e)
+            data = None
+        if data:
+            rows.append((name, data))
+            report["migrated"] += 1
+        else:
+            report["failed"] += 1
+    if rows:
+        await REPO.session_add_many(rows)
+    await REPO.set_setting("sessions_migrated", now_iso())
+    logger.info("Session migration: %s", report)
+    return report
+
+
+async def migrate_sessions_once():
+    """Run migrate_session_files on first start with the db backend."""
+    if not use_db_sessions():
+        return
+    if await REPO.get_setting("sessions_migrated"):
+        return
+    await migrate_session_files()
+
+
+# ---------- Telethon helpers (for convenience) ----------
+async def load_session_string(session_file: str) -> str:
+    """StringSession string for session_file ("" for a brand-new session)."""
+    data = await SESSION_STORE.get(session_file)
+    if data is None:
+        # not migrated yet: import lazily from the legacy file if there is one
+        data = await asyncio.to_thread(read_session_file,
+                                       os.path.join(current_tenant().session_dir, session_file))
+        if data:
+            await SESSION_STORE.put(session_file, data)
+    return data or ""
+
+
+async def build_client(session_file: str) -> TelegramClient:
+    """TelegramClient (not yet connected) for the session named session_file."""
+    if not use_db_sessions():
+        # opening the SQLite .session file is blocking I/O
+        session = await asyncio.to_thread(
+            SQLiteSession, os.path.join(current_tenant().session_dir, session_file))
+        return TelegramClient(session, CONFIG["API_ID"], CONFIG["API_HASH"])
+    return TelegramClient(StringSession(await load_session_string(session_file)),
+                          CONFIG["API_ID"], CONFIG["API_HASH"])
+
+
+async def save_client_session(client: TelegramClient, session_file: str):
+    """Persist the client's auth key (no-op for file sessions, Telethon saves those itself)."""
+    if use_db_sessions():
+        await SESSION_STORE.put(session_file, client.session.save())
+
+
+async def close_client(client: TelegramClient,
+                       session_file: Optional[str] = None):
+    """Save (if session_file is given) and disconnect, never raising."""
+    if session_file:
+        try:
+            await save_client_session(client, session_file)
+        except Exception as e:
+            logger.warning("Failed to save session %s: %s", session_file, e)
+    try:
+        await client.disconnect()
+    except Exception:
+        pass
+
+
+async def discard_session(session_file: Optional[str]):
+    """Remove a session from the store and any legacy file."""
+    if not session_file:
+        return
+    try:
+        await SESSION_STORE.delete(session_file)
+    except Exception as e:
+        logger.warning("Failed to delete stored session %s: %s", session_file,
+                       e)
+    session_path = os.path.join(current_tenant().session_dir, session_file)
+
+    def _remove():
+        if os.path.exists(session_path):
+            os.remove(session_path)
+
+    try:
+        await asyncio.to_thread(_remove)
+    except Exception:
+        pass
+
+
+# Connected clients by session name (registered by the OTP monitor) so other
+# jobs can reuse them instead of opening a second connection.
+LIVE_CLIENTS: Dict[str, TelegramClient] = {}
+
+
+async def create_telethon_client(session_file: str):
+    client = await build_client(session_file)
+    await client.connect()
+    return client
+
+
+async def check_session_active(session_file: str) -> bool:
+    """
+    True if the session is still authorized, False if it was revoked/logged out.
+    Connection problems raise, so callers can tell a dead session from a network blip.
+    """
+    live = LIVE_CLIENTS.get(session_file)
+    if live is not None and live.is_connected():
+        return await live.is_user_authorized()
+    client = await build_client(session_file)
+    try:
+        await client.connect()
+        if not await client.is_user_authorized():
+            return False
+        me = await client.get_me()
+        return me is not None
+    finally:
+        await close_client(client)
+
+
+# ---------- Telethon admission control ----------
+class CapacityGate:
+    """
+    Global limit on concurrent Telethon clients (monitors, uploads, sweeps) with
+    a FIFO waiting queue: a released slot is handed straight to the oldest waiter.
+    Keeps a moving average of how long slots are held to estimate waits.
+    """
+
+    def __init__(self, capacity: int, shed_threshold: int):
+        self.capacity = max(1, capacity)
+        self.shed_threshold = shed_threshold
+        self.in_use = 0
+        self._waiters: deque = deque()
+        self.avg_hold = 60.0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._waiters)
+
+    def should_shed(self) -> bool:
+        """True (and counted) when the queue is too long to accept new work."""
+        if self.depth >= self.shed_threshold:
+            self.shed += 1
+            return True
+        return False
+
+    def estimate(self):
+        """(queue position, estimated wait seconds) for work arriving now; (0, 0) if a slot is free."""
+        if self.in_use < self.capacity and not self._waiters:
+            return 0, 0.0
+        position = self.depth + 1
+        return position, self.avg_hold * position / self.capacity
+
+    def try_acquire(self) -> bool:
+        if self.in_use < self.capacity and not self._waiters:
+            self.in_use += 1
+            self.admitted += 1
+            return True
+        return False
+
+    async def acquire(self) -> float:
+        """Wait for a slot in FIFO order; returns seconds spent waiting."""
+        if self.try_acquire():
+            return 0.0
+        started = time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        self.queued += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # slot was handed to us just as we were cancelled
+            else:
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def release(self, held_for: Optional[float] = None):
+        if held_for is not None:
+            self.avg_hold = 0.9 * self.avg_hold + 0.1 * held_for
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)  # slot passes to the waiter, in_use unchanged
+                return
+        self.in_use = max(0, self.in_use - 1)
+
+    @asynccontextmanager
+    async def hold(self):
+        """async with CAPACITY.hold() as waited: ... — one slot for the block."""
+        waited = await self.acquire()
+        started = time.monotonic()
+        try:
+            yield waited
+        finally:
+            held = time.monotonic() - started
+            current_tenant().usage["telethon_seconds"] += held
+            self.release(held)
+
+    def stats(self) -> Dict:
+        return {
+            "in_use": self.in_use,
+            "capacity": self.capacity,
+            "depth": self.depth,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": self.shed,
+            "avg_wait": (self.total_wait / self.queued) if self.queued else 0.0,
+            "max_wait": self.max_wait,
+            "avg_hold": self.avg_hold,
+        }
+
+
+CAPACITY = CapacityGate(CONFIG["TELETHON_MAX_CLIENTS"],
+                        CONFIG["QUEUE_SHED_THRESHOLD"])
+
+
+def capacity_metrics_text() -> str:
+    s = CAPACITY.stats()
+    return ("🚥 **Telethon capacity**\n"
+            f"• in use {s['in_use']}/{s['capacity']} | queue {s['depth']} | shed {s['shed']}\n"
+            f"• queued {s['queued']} of {s['admitted']} admitted | "
+            f"wait avg {s['avg_wait']:.1f}s, max {s['max_wait']:.1f}s | "
+            f"hold avg {s['avg_hold']:.0f}s\n")
+
+
+# ---------- Telethon circuit breakers ----------
+def flood_wait_seconds(exc: BaseException) -> Optional[float]:
+    """Seconds Telegram asked to wait for a flood error (FloodWait, PeerFlood...), else None."""
+    if not isinstance(exc, FloodError):
+        return None
+    # flood errors without a duration (PeerFlood, PhoneNumberFlood) get the longest backoff
+    return float(getattr(exc, "seconds", 0) or CONFIG["BREAKER_MAX_SECONDS"])
+
+
+class CircuitBreakers:
+    """
+    Per-session and global breakers for Telethon operations (monitors, sweeps,
+    uploads). A flood error opens the session's breaker for the time Telegram
+    asks; `failures` consecutive other errors open it for `base` seconds,
+    doubling with each further failure up to `max_backoff`. While open, the
+    session is held back instead of reconnecting, which would only extend a
+    FloodWait. `global_failures` failures of any sessions within
+    `global_window` seconds hold back every session for `global_cooldown`.
+    An account's cooldown is also written to accounts.cooldown_until, so it is
+    not handed out or swept while cooling, including after a restart.
+    """
+
+    def __init__(self, failures: int, base: float, max_backoff: float,
+                 global_failures: int, global_window: float,
+                 global_cooldown: float):
+        self.failures = max(1, failures)
+        self.base = base
+        self.max_backoff = max_backoff
+        self.global_failures = global_failures
+        self.global_window = global_window
+        self.global_cooldown = global_cooldown
+        # (tenant, session_file) -> {failures, open_until, flood_waits, last_error}
+        self._sessions: Dict[tuple, Dict] = {}
+        self._recent: deque = deque()  # monotonic times of recent failures
+        self.global_open_until = 0.0
+        self.opened = 0
+        self.flood_waits = 0
+        self.global_trips = 0
+        self.held_back = 0
+        self.failed = 0
+
+    @staticmethod
+    def _key(session_file: str) -> tuple:
+        return (current_tenant().name, session_file)
+
+    def remaining(self, session_file: Optional[str]) -> float:
+        """Seconds until operations on the session may resume (0 when closed)."""
+        now = time.monotonic()
+        entry = self._sessions.get(self._key(session_file))
+        until = max(self.global_open_until,
+                    entry["open_until"] if entry else 0.0)
+        return max(0.0, until - now)
+
+    def hold_back(self, session_file: Optional[str]) -> float:
+        """remaining(), counting the operation as held back when it is > 0."""
+        remaining = self.remaining(session_file)
+        if remaining:
+            self.held_back += 1
+        return remaining
+
+    def success(self, session_file: str):
+        entry = self._sessions.get(self._key(session_file))
+        if entry and entry["open_until"] <= time.monotonic():
+            del self._sessions[self._key(session_file)]
+
+    async def failure(self,
+                      session_file: str,
+                      exc: BaseException,
+                      acc_id: Optional[int] = None) -> float:
+        """Record a failed operation; returns the session's cooldown now in force."""
+        return await self.record(session_file, f"{type(exc).__name__}: {exc}",
+                                 flood_wait_seconds(exc), acc_id)
+
+    async def record(self,
+                     session_file: str,
+                     error: str,
+                     flood_wait: Optional[float] = None,
+                     acc_id: Optional[int] = None) -> float:
+        now = time.monotonic()
+        entry = self._sessions.setdefault(self._key(session_file), {
+            "failures": 0,
+            "open_until": 0.0,
+            "flood_waits": 0,
+            "last_error": None
+        })
+        entry["last_error"] = error[:200]
+        self.failed += 1
+        if flood_wait is not None:
+            entry["flood_waits"] += 1
+            self.flood_waits += 1
+            cooldown = flood_wait + 5
+        else:
+            entry["failures"] += 1
+            over = entry["failures"] - self.failures
+            cooldown = (min(self.base * 2**over, self.max_backoff)
+                        if over >= 0 else 0.0)
+
+        self._recent.append(now)
+        while self._recent and self._recent[0] < now - self.global_window:
+            self._recent.popleft()
+        if (self.global_failures > 0
+                and len(self._recent) >= self.global_failures
+                and self.global_open_until <= now):
+            self.global_open_until = now + self.global_cooldown
+            self.global_trips += 1
+            self._recent.clear()
+            logger.warning(
+                "Global Telethon breaker open for %.0fs (%d failures in %.0fs)",
+                self.global_cooldown, self.global_failures, self.global_window)
+
+        if cooldown:
+            entry["open_until"] = max(entry["open_until"], now + cooldown)
+            self.opened += 1
+            logger.warning("Breaker open for %s: %.0fs after %s", session_file,
+                           cooldown, entry["last_error"])
+            if acc_id is not None:
+                until = (datetime.now(IST) +
+                         timedelta(seconds=cooldown)).isoformat()
+                try:
+                    await REPO.set_account_cooldown(acc_id, until)
+                    stock_changed()
+                except Exception as e:
+                    logger.warning("Failed to store cooldown of acc %s: %s",
+                                   acc_id, e)
+        return self.remaining(session_file)
+
+    def snapshot(self) -> List[Dict]:
+        """Open or failing breakers of the current tenant, longest cooldown first."""
+        now = time.monotonic()
+        tenant = current_tenant().name
+        rows = [{
+            "session": name,
+            "remaining": max(0.0, e["open_until"] - now),
+            "failures": e["failures"],
+            "flood_waits": e["flood_waits"],
+            "last_error": e["last_error"],
+        } for (t, name), e in self._sessions.items() if t == tenant]
+        return sorted(rows, key=lambda r: -r["remaining"])
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        return {
+            "open": sum(1 for e in self._sessions.values()
+                        if e["open_until"] > now),
+            "tracked": len(self._sessions),
+            "global_remaining": max(0.0, self.global_open_until - now),
+            "opened": self.opened,
+            "flood_waits": self.flood_waits,
+            "global_trips": self.global_trips,
+            "held_back": self.held_back,
+        }
+
+
+BREAKERS = CircuitBreakers(CONFIG["BREAKER_FAILURES"],
+                           CONFIG["BREAKER_BASE_SECONDS"],
+                           CONFIG["BREAKER_MAX_SECONDS"],
+                           CONFIG["BREAKER_GLOBAL_FAILURES"],
+                           CONFIG["BREAKER_GLOBAL_WINDOW_SECONDS"],
+                           CONFIG["BREAKER_GLOBAL_COOLDOWN_SECONDS"])
+
+
+def breaker_metrics_text() -> str:
+    s = BREAKERS.stats()
+    text = (f"🧯 **Circuit breakers**: {s['open']} open of {s['tracked']} tracked | "
+            f"opened {s['opened']} ({s['flood_waits']} FloodWait) | "
+            f"held back {s['held_back']}\n")
+    if s["global_remaining"]:
+        text += f"• ⛔ global breaker open, {s['global_remaining']:.0f}s left\n"
+    elif s["global_trips"]:
+        text += f"• global breaker tripped {s['global_trips']} time(s)\n"
+    return text
+
+
+def format_wait(seconds: float) -> str:
+    if seconds < 120:
+        return f"{math.ceil(seconds)}s"
+    if seconds < 7200:
+        return f"{math.ceil(seconds / 60)} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+# ---------- Session health sweeper ----------
+SWEEP_LOCK = asyncio.Lock()
+
+
+async def _sweep_one(sem: asyncio.Semaphore, acc_id: int,
+                     session_file: Optional[str]) -> str:
+    if not session_file:
+        return "dead"
+    async with sem:
+        # jitter so a batch doesn't hit Telegram as one burst
+        await asyncio.sleep(random.uniform(0, CONFIG["SWEEP_JITTER_SECONDS"]))
+        if BREAKERS.hold_back(session_file):
+            return "breaker"
+        # a reused live client needs no slot; otherwise never queue ahead of buyers
+        slot = session_file not in LIVE_CLIENTS
+        if slot and not CAPACITY.try_acquire():
+            return "skipped"
+        try:
+            ok = await asyncio.wait_for(check_session_active(session_file),
+                                        timeout=CONFIG["SWEEP_CHECK_TIMEOUT"])
+        except Exception as e:
+            logger.info("Sweep: check failed for %s: %s", session_file, e)
+            await BREAKERS.failure(session_file, e, acc_id)
+            return "error"
+        finally:
+            if slot:
+                CAPACITY.release()
+    BREAKERS.success(session_file)
+    return "ok" if ok else "dead"
+
+
+async def sweep_sessions_tick() -> Dict:
+    """
+    Validate a batch of `available` accounts (least recently checked first).
+    Revoked sessions move to status 'dead' so country_cb never hands them out;
+    connection errors are recorded but leave the account available.
+    """
+    if SWEEP_LOCK.locked():
+        return current_tenant().sweep_report
+    async with SWEEP_LOCK:
+        started = time.monotonic()
+        recheck_before = (datetime.now(IST) - timedelta(
+            hours=CONFIG["SWEEP_RECHECK_HOURS"])).isoformat()
+        rows = await REPO.accounts_to_check(recheck_before,
+                                            CONFIG["SWEEP_BATCH_SIZE"])
+
+        sem = asyncio.Semaphore(CONFIG["SWEEP_CONCURRENCY"])
+        results = await asyncio.gather(*(_sweep_one(sem, acc_id, sf)
+                                         for acc_id, sf in rows))
+
+        checked_at = now_iso()
+        await REPO.record_session_checks(
+            checked_at, [(acc_id, res)
+                         for (acc_id, _), res in zip(rows, results)
+                         if res not in ("skipped", "breaker")],
+            [acc_id for (acc_id, _), res in zip(rows, results)
+             if res == "dead"])
+
+        skipped = results.count("skipped")
+        held_back = results.count("breaker")
+        checked = len(rows) - skipped - held_back
+        dead = results.count("dead")
+        errors = results.count("error")
+        if dead:
+            stock_changed()
+        report = {
+            "finished_at": checked_at,
+            "checked": checked,
+            "ok": results.count("ok"),
+            "dead": dead,
+            "errors": errors,
+            "skipped": skipped,
+            "breaker": held_back,
+            "duration": time.monotonic() - started,
+            "failure_rate": (dead / checked) if checked else 0.0,
+        }
+        current_tenant().sweep_report.clear()
+        current_tenant().sweep_report.update(report)
+        logger.info("Session sweep: %s", report)
+        return report
+
+
+def sweep_report_text(report: Dict) -> str:
+    if not report:
+        return "🩺 **Session sweep**\n• no sweep has run yet\n"
+    return ("🩺 **Session sweep**\n"
+            f"• finished: {report['finished_at'][:19]}\n"
+            f"• checked {report['checked']} in {report['duration']:.1f}s | "
+            f"ok {report['ok']} | dead {report['dead']} | errors {report['errors']} | "
+            f"skipped (no capacity) {report.get('skipped', 0)}\n"
+            f"• held back by circuit breakers: {report.get('breaker', 0)}\n"
+            f"• failure rate: {report['failure_rate'] * 100:.1f}%\n")
+
+
+# ---------- Restock waitlist ----------
+class RestockNotifier:
+    """
+    Buyers who find a country sold out can tap "Notify me" instead of polling.
+    Stock added by uploads and released reservations is collected per country
+    for WAITLIST_BATCH_SECONDS; then as many waiters as units are still
+    available are popped in join order and messaged once, through the
+    outbound scheduler in batches.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.pending: Dict[tuple, int] = {}  # (tenant, country) -> units
+        self._task = None
+        self.batches = 0
+        self.notified = 0
+        self.failed = 0
+
+    def note(self, country_code: str, units: int = 1):
+        key = (current_tenant(), country_code)
+        self.pending[key] = self.pending.get(key, 0) + units
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(self.delay)
+            pending, self.pending = self.pending, {}
+            for (tenant, cc), units in pending.items():
+                try:
+                    with use_tenant(tenant):
+                        await self._notify(cc, units)
+                except Exception:
+                    logger.exception("Restock notification for %s failed", cc)
+
+    async def _notify(self, cc: str, units: int):
+        # some of the new stock may already have been bought in the meantime
+        available = await REPO.available_count(cc)
+        user_ids = await REPO.waitlist_pop(cc, min(units, available))
+        if not user_ids:
+            return
+        self.batches += 1
+        text = (f"🔔 **{country_flag(cc)} {cc} numbers are back in stock!**\n\n"
+                f"{available} available right now, first come first served.")
+        kb = InlineKeyboardMarkup([[
+            InlineKeyboardButton(f"🛒 Buy {cc} now",
+                                 callback_data=f"country_{cc}")
+        ]])
+
+        bot = current_tenant().app.bot
+
+        async def _send(uid: int):
+            try:
+                await bot.send_message(
+                    uid,
+                    text,
+                    reply_markup=kb,
+                    parse_mode="Markdown",
+                    rate_limit_args={"priority": PRIORITY_UI})
+                self.notified += 1
+            except Exception:
+                self.failed += 1
+
+        for i in range(0, len(user_ids), 100):
+            await asyncio.gather(*(_send(uid) for uid in user_ids[i:i + 100]))
+        logger.info("Restock %s: %d unit(s) added, notified %d waiter(s)", cc,
+                    units, len(user_ids))
+
+    def stats(self) -> Dict:
+        tenant = current_tenant()
+        return {
+            "pending": {cc: n for (t, cc), n in self.pending.items()
+                        if t is tenant},
+            "batches": self.batches,
+            "notified": self.notified,
+            "failed": self.failed,
+        }
+
+
+RESTOCK = RestockNotifier(CONFIG["WAITLIST_BATCH_SECONDS"])
+
+
+def waitlist_metrics_text() -> str:
+    s = RESTOCK.stats()
+    pending = ", ".join(f"{cc} +{n}" for cc, n in s["pending"].items()) or "none"
+    return (f"🔔 **Restock waitlist**: {s['notified']} notified in {s['batches']} batches, "
+            f"{s['failed']} failed | pending: {pending}\n")
+
+
+async def notify_me_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    _, cc = q.data.split("_", 1)
+    position = await REPO.waitlist_add(cc, q.from_user.id)
+    await q.answer()
+    await q.edit_message_text(
+        f"🔔 **You're on the {country_flag(cc)} {cc} waitlist** (#{position})\n\n"
+        "We'll message you as soon as numbers arrive, no need to keep checking.",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("🔙 Choose Another Country",
+                                 callback_data="buy_accounts")
+        ]]),
+        parse_mode="Markdown")
+
+
+# ---------- APScheduler tick ----------
+def expired_reservations(rows) -> List[int]:
+    """Ids among (id, metadata JSON) rows whose reservation has run out (sync)."""
+    expired = []
+    now = datetime.now(IST)
+    for acc_id, meta in rows:
+        try:
+            m = json.loads(meta) if meta else {}
+            ru = m.get("reserved_until")
+            if not ru:
+                continue
+            ru_dt = datetime.fromisoformat(ru)
+            if ru_dt.tzinfo is None:
+                ru_dt = ru_dt.replace(tzinfo=IST)
+            if ru_dt < now:
+                expired.append(acc_id)
+        except Exception:
+            expired.append(acc_id)
+    return expired
+
+
+async def release_expired_reservations_tick():
+    rows = await REPO.reserved_accounts()
+    # parsing every reservation's metadata would hold up the loop at peak
+    expired = await asyncio.to_thread(expired_reservations, rows) if rows else []
+    released = await REPO.release_accounts(expired) if expired else []
+    for acc_id, cc in released:
+        MONITORS.cancel(acc_id)
+        RESTOCK.note(cc)
+    if released:
+        stock_changed()
+
+
+# ---------- Bot flows ----------
+DEEP_LINK_BUY = re.compile(r"^buy_([A-Za-z]{2})$")
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    # t.me/<bot>?start=buy_IN goes straight to the claim, skipping the menus;
+    # a country this bot doesn't sell opens the main menu instead
+    m = DEEP_LINK_BUY.match(context.args[0]) if context.args else None
+    if m and m.group(1).upper() in tenant_config("COUNTRY_PRICES"):
+
+        async def show(text, kb):
+            return await update.message.reply_text(text,
+                                                   reply_markup=kb,
+                                                   parse_mode="Markdown")
+
+        await start_purchase(context, user, m.group(1).upper(), show)
+        return
+    db_user = await get_user(user.id, user.username)
+    await show_main_menu(update, context, db_user.get("last_country"))
+
+
+async def verify_join_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    if not await check_force_join(q.from_user.id, context.application):
+        await q.edit_message_text(
+            "❌ **You haven't joined the channel yet!**\n\nPlease join and then verify.",
+            reply_markup=InlineKeyboardMarkup(
+                [[
+                    InlineKeyboardButton(
+                        "📢 Join Channel",
+                        url=f"https://t.me/{tenant_config('FORCE_JOIN_USERNAME')[1:]}"
+                    )
+                ],
+                 [
+                     InlineKeyboardButton("✅ Verify Join",
+                                          callback_data="verify_join")
+                 ]]),
+            parse_mode="Markdown")
+        return
+    await show_main_menu_cb(update, context)
+
+
+async def show_main_menu(update: Update,
+                         context: ContextTypes.DEFAULT_TYPE,
+                         last_country: Optional[str] = None):
+    user = update.effective_user
+    is_admin = user.id in tenant_config("ADMIN_IDS")
+    welcome_text = f"""
+✨ Welcome to Telegram Accounts Shop! ✨
+
+🤖 Your trusted source for premium Telegram accounts
+
+{tenant_config('DEVELOPER_CREDITS')}
+
+💎 Features:
+• Instant OTP Delivery
+• Premium Quality Accounts  
+• 24/7 Support
+• Secure & Reliable
+
+📊 Available Countries:
+🇺🇸 US - ₹40      🇪🇹 Ethiopia - ₹35
+🇻🇳 Vietnam - ₹35  🇮🇳 India - ₹40  
+🇳🇵 Nepal - ₹40    🇸🇻 El Salvador - ₹55
+🇵🇭 Philippines - ₹80  🇨🇳 China - ₹80
+    """
+    kb = []
+    if last_country:
+        kb.append([buy_again_button(last_country)])
+    kb.append(
+        [InlineKeyboardButton("🛒 Buy Accounts", callback_data="buy_accounts")])
+    kb.append([
+        InlineKeyboardButton("💰 Check Balance", callback_data="check_balance"),
+        InlineKeyboardButton("🧾 My Purchases", callback_data="purchases")
+    ])
+    if is_admin:
+        kb.append([
+            InlineKeyboardButton("⚡ Admin Panel", callback_data="admin_panel")
+        ])
+    kb.append([
+        InlineKeyboardButton("📞 Contact Support",
+                             url=f"https://t.me/{tenant_config('OWNER_HANDLE')}")
+    ])
+    if update.message:
+        await update.message.reply_text(welcome_text,
+                                        reply_markup=InlineKeyboardMarkup(kb),
+                                        parse_mode="Markdown")
+    else:
+        await update.callback_query.edit_message_text(
+            welcome_text,
+            reply_markup=InlineKeyboardMarkup(kb),
+            parse_mode="Markdown")
+
+
+async def show_main_menu_cb(update: Update,
+                            context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if q:
+        await q.answer()
+    await show_main_menu(update, context)
+
+
+async def main_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    user = q.from_user
+    is_admin = user.id in tenant_config("ADMIN_IDS")
+    welcome_text = f"""
+✨ Welcome to Telegram Accounts Shop! ✨
+
+🤖 Your trusted source for premium Telegram accounts
+
+{tenant_config('DEVELOPER_CREDITS')}
+
+💎 Features:
+• Instant OTP Delivery
+• Premium Quality Accounts  
+• 24/7 Support
+• Secure & Reliable
+
+📊 Available Countries:
+🇺🇸 US - ₹40      🇪🇹 Ethiopia - ₹35
+🇻🇳 Vietnam - ₹35  🇮🇳 India - ₹40  
+🇳🇵 Nepal - ₹40    🇸🇻 El Salvador - ₹55
+🇵🇭 Philippines - ₹80  🇨🇳 China - ₹80
+    """
+    kb = []
+    kb.append(
+        [InlineKeyboardButton("🛒 Buy Accounts", callback_data="buy_accounts")])
+    kb.append([
+        InlineKeyboardButton("💰 Check Balance", callback_data="check_balance"),
+        InlineKeyboardButton("🧾 My Purchases", callback_data="purchases")
+    ])
+    if is_admin:
+        kb.append([
+            InlineKeyboardButton("⚡ Admin Panel", callback_data="admin_panel")
+        ])
+    kb.append([
+        InlineKeyboardButton("📞 Contact Support",
+                             url=f"https://t.me/{tenant_config('OWNER_HANDLE')}")
+    ])
+    await q.edit_message_text(welcome_text,
+                              reply_markup=InlineKeyboardMarkup(kb),
+                              parse_mode="Markdown")
+
+
+async def check_balance_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    user = await get_user(q.from_user.id, q.from_user.username)
+    kb = [[InlineKeyboardButton("🔙 Back to Main", callback_data="main_menu")]]
+    owner_handle = tenant_config('OWNER_HANDLE').replace('_', '\\_')
+    await q.edit_message_text(
+        f"💰 **Your Balance**\n\n"
+        f"Current Balance: ₹{user['balance']:.2f}\n\n"
+        f"Need to add balance? Contact @{owner_handle}",
+        reply_markup=InlineKeyboardMarkup(kb),
+        parse_mode="Markdown")
+
+
+PURCHASES_PAGE_SIZE = 10
+
+
+async def purchase_history_page(user_id: int, before_id: Optional[int]):
+    """(text, rows, has_more) for one keyset page of user_id's purchases."""
+    rows = await REPO.purchase_history(user_id, before_id,
+                                       PURCHASES_PAGE_SIZE + 1)
+    has_more = len(rows) > PURCHASES_PAGE_SIZE
+    rows = rows[:PURCHASES_PAGE_SIZE]
+    text = ""
+    for tx_id, created_at, amount, phone, cc in rows:
+        when = datetime.fromisoformat(created_at).replace(
+            tzinfo=ZoneInfo("UTC")).astimezone(IST).strftime("%d %b %Y %H:%M")
+        flag = f"{country_flag(cc)} {cc}" if cc else "—"
+        text += f"• `{phone or 'unknown'}` {flag} — ₹{amount:g} — {when}\n"
+    return text, rows, has_more
+
+
+async def purchases_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """My Purchases: newest first, keyset-paged by transaction id."""
+    q = update.callback_query
+    await q.answer()
+    before_id = int(q.data.split("_", 1)[1]) if "_" in q.data else None
+    text, rows, has_more = await purchase_history_page(q.from_user.id,
+                                                       before_id)
+    if not rows:
+        text = ("No purchases yet." if before_id is None else
+                "No older purchases.") + "\n"
+    nav = []
+    if before_id is not None:
+        nav.append(InlineKeyboardButton("⏮ Newest", callback_data="purchases"))
+    if has_more:
+        nav.append(
+            InlineKeyboardButton("Older ▶",
+                                 callback_data=f"purchases_{rows[-1][0]}"))
+    kb = [nav] if nav else []
+    kb.append([InlineKeyboardButton("🔙 Back to Main", callback_data="main_menu")])
+    await q.edit_message_text(f"🧾 **My Purchases**\n\n{text}",
+                              reply_markup=InlineKeyboardMarkup(kb),
+                              parse_mode="Markdown")
+
+
+async def buy_accounts_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    countries = [("US", "United States", 40), ("ET", "Ethiopia", 35),
+                 ("VN", "Vietnam", 35), ("IN", "India", 40),
+                 ("NP", "Nepal", 40), ("SV", "El Salvador", 55),
+                 ("PH", "Philippines", 80), ("CN", "China", 80)]
+    kb = []
+    for i in range(0, len(countries), 2):
         row = []
         for j in range(2):
             if i + j < len(countries):
@@ -450,46 +4427,15 @@ async def buy_accounts_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown")
 
 
-async def country_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    _, cc = q.data.split("_", 1)
-    user = await get_user(q.from_user.id, q.from_user.username)
-    price = CONFIG["COUNTRY_PRICES"].get(cc, 40.0)
-    if user['balance'] < price:
-        owner_handle = CONFIG['OWNER_HANDLE'].replace('_', '\\_')
-        await q.edit_message_text(
-            f"❌ **Insufficient Balance**\n\nRequired: ₹{price}\nYour Balance: ₹{user['balance']}\n\nContact @{owner_handle} to add balance.",
-            parse_mode="Markdown")
-        return
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT id, phone_number, price, session_file FROM accounts WHERE country_code=? AND status='available' LIMIT 1",
-            (cc, ))
-        row = await cur.fetchone()
-    if not row:
-        await q.edit_message_text(
-            f"❌ **No {country_flag(cc)} {cc} numbers available**\n\nPlease check back later.",
-            parse_mode="Markdown")
-        return
-    acc_id, phone, price_db, session_file = row
-    if not session_file:
-        owner_handle = CONFIG['OWNER_HANDLE'].replace('_', '\\_')
-        await q.edit_message_text(
-            f"❌ **Session file missing for this account**\n\nPlease contact @{owner_handle}.",
-            parse_mode="Markdown")
-        return
-    meta = {
-        "reserved_by": q.from_user.id,
-        "reserved_at": now_iso(),
-        "reserved_until": minutes_from_now(CONFIG["RESERVE_MINUTES"])
-    }
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE accounts SET status='reserved', metadata=? WHERE id=?",
-            (json.dumps(meta), acc_id))
-        await db.commit()
-    session_path = os.path.join(SESSION_DIR, session_file)
+def buy_again_button(cc: str) -> InlineKeyboardButton:
+    """Repeat-last-purchase button; it goes through country_cb's claim directly."""
+    return InlineKeyboardButton(
+        f"🔁 Buy again: {country_flag(cc)} {cc} - ₹{tenant_config('COUNTRY_PRICES').get(cc, 40.0)}",
+        callback_data=f"country_{cc}")
+
+
+def try_login_message(acc_id: int, phone: str, queue_note: str = ""):
+    """Text and keyboard of the TRY LOGIN message shown after a reservation."""
     kb = [[
         InlineKeyboardButton("🔄 Get New OTP",
                              callback_data=f"getotp_{acc_id}"),
@@ -499,14 +4445,78 @@ async def country_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
               InlineKeyboardButton("🔙 Choose Another Country",
                                    callback_data="buy_accounts")
           ]]
-    await q.edit_message_text(
-        f"📱 **TRY LOGIN**\n\n📞 **Number:** `{phone}`\n\nInstructions:\n1. Copy the number\n2. Paste in Telegram app\n\n🔄 **Monitoring for OTP...**\n\n_When you receive OTP it will be forwarded here automatically._\n\n_WHEN YOU HAVE SUCCESSFULLY LOGGED IN TAP DONE ✅_",
-        reply_markup=InlineKeyboardMarkup(kb),
-        parse_mode="Markdown")
+    status = queue_note or "🔄 **Monitoring for OTP...**"
+    text = f"📱 **TRY LOGIN**\n\n📞 **Number:** `{phone}`\n\nInstructions:\n1. Copy the number\n2. Paste in Telegram app\n\n{status}\n\n_When you receive OTP it will be forwarded here automatically._\n\n_WHEN YOU HAVE SUCCESSFULLY LOGGED IN TAP DONE ✅_"
+    return text, InlineKeyboardMarkup(kb)
+
+
+async def start_purchase(context: ContextTypes.DEFAULT_TYPE, buyer, cc: str,
+                         show):
+    """
+    Claim a number of country cc for buyer and start its OTP monitor. Shared by
+    the country buttons, /start buy_<CC> deep links and Buy again. `show(text,
+    reply_markup)` puts a screen in front of the buyer and returns the Message
+    that later queue/OTP status updates edit.
+    """
+    if CAPACITY.should_shed():
+        # shed before any DB work or reservation
+        await show(
+            "🚦 **High demand right now**\n\nAll delivery slots are busy and the queue is full. Please try again in a few minutes.",
+            InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Choose Another Country",
+                                     callback_data="buy_accounts")
+            ]]))
+        return
+    price = tenant_config("COUNTRY_PRICES").get(cc, 40.0)
+    meta = {
+        "reserved_by": buyer.id,
+        "reserved_at": now_iso(),
+        "reserved_until": minutes_from_now(CONFIG["RESERVE_MINUTES"])
+    }
+    # user refresh, balance check and the atomic claim in one round trip, so
+    # two buyers can never get the same number
+    res = await REPO.reserve_for_buyer(buyer.id, buyer.username, cc, price,
+                                       meta)
+    user = res["user"]
+    USERNAMES.remember(buyer.id, user["username"])
+    if res["result"] == "insufficient":
+        owner_handle = tenant_config('OWNER_HANDLE').replace('_', '\\_')
+        await show(
+            f"❌ **Insufficient Balance**\n\nRequired: ₹{price}\nYour Balance: ₹{user['balance']}\n\nContact @{owner_handle} to add balance.",
+            None)
+        return
+    if res["result"] == "unavailable":
+        await show(
+            f"❌ **No {country_flag(cc)} {cc} numbers available**\n\nTap Notify me and we'll message you when they're back.",
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔔 Notify me", callback_data=f"notify_{cc}")],
+                [InlineKeyboardButton("🔙 Choose Another Country",
+                                      callback_data="buy_accounts")],
+            ]))
+        return
+    acc_id, phone, price_db, session_file = res["account"]
+    stock_changed()
+    position, eta = CAPACITY.estimate()
+    queue_note = ""
+    if position:
+        queue_note = f"⏳ **In queue: #{position}** (about {math.ceil(eta)}s). Monitoring starts automatically."
+    text, kb = try_login_message(acc_id, phone, queue_note)
+    status_message = await show(text, kb)
     # start monitor in background
-    asyncio.create_task(
-        monitor_telegram_messages(context, q.from_user.id, acc_id, phone,
-                                  session_path))
+    start_monitor(context, buyer.id, acc_id, phone, session_file,
+                  status_message)
+
+
+async def country_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    _, cc = q.data.split("_", 1)
+
+    async def show(text, kb):
+        await q.edit_message_text(text, reply_markup=kb, parse_mode="Markdown")
+        return q.message
+
+    await start_purchase(context, q.from_user, cc, show)
 
 
 # ---------- Admin panel and helpers ----------
@@ -518,6 +4528,7 @@ async def admin_panel_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = ("⚙️ **Admin Panel**\n\n"
             "Available admin commands:\n"
             "• /upload - Add new accounts (interactive upload via Telethon)\n"
+            "• /uploads - Uploads in progress (cancel)\n"
             "• /stats - View detailed statistics\n"
             "• /accounts - Manage accounts list\n"
             "• /balance - View/set user balance\n"
@@ -526,7 +4537,20 @@ async def admin_panel_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "• /unban - Unban user\n"
             "• /addcoins - Add coins to user\n"
             "• /deductcoin - Deduct coins from user\n"
-            "• /clearstats - Clear all sales statistics\n\n"
+            "• /bulkbalance - Apply balance changes from a CSV/TSV\n"
+            "• /purchases <user> - A user's purchase history\n"
+            "• /clearstats - Reset sales statistics (history is archived)\n"
+            "• /archive - Transaction archive status, run and find\n"
+            "• /backup [list|vacuum] - Snapshot the DB and run maintenance now\n"
+            "• /metrics - Throttling and runtime counters\n"
+            "• /dashboard [off] - Pin a live dashboard that updates itself\n"
+            "• /tenants - Per-bot use of the shared resources\n"
+            "• /migratesessions - Import .session files into the DB\n"
+            "• /sweep - Check available sessions now\n"
+            "• /breakers - Open circuit breakers and cooling accounts\n"
+            "• /monitors - In-flight OTP monitors\n"
+            "• /latency [hours] [CC] - OTP delivery latency\n"
+            "• /export transactions|accounts|users - Export as gzip CSV/NDJSON\n\n"
             "Tap an action below:")
     kb = [[
         InlineKeyboardButton("📥 Upload Account", callback_data="admin_upload")
@@ -592,11 +4616,153 @@ async def admin_country_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # data like admin_country_US
     parts = q.data.split("_")
     cc = parts[-1] if parts else "US"
-    context.user_data['upload_country'] = cc
-    context.user_data['upload_step'] = 'phone'
+    upload_id = await upload_create(q.from_user.id, cc)
     await q.edit_message_text(
-        f"📥 **Upload Account — {cc}**\n\nEnter the phone number (international, e.g. +911234567890) for the account. You'll receive a code in Telegram; paste it here.",
+        f"📥 **Upload Account #{upload_id} — {cc}**\n\nEnter the phone number (international, e.g. +911234567890) for the account. You'll receive a code in Telegram; paste it here.\n\n_Running several uploads? Reply to this message._",
         parse_mode="Markdown")
+    await upload_update(upload_id, prompt_message_id=q.message.message_id)
+
+
+# ---------- Upload state machine (persisted in the uploads table) ----------
+# phone -> otp -> (2fa ->) done, or otp -> note_2fa -> done; any active state can
+# end as cancelled / expired / failed. The Telethon client that sent the code is
+# held in UPLOAD_CLIENTS until sign-in finishes, so each step reuses one connection.
+UPLOAD_TRANSITIONS = {
+    "phone": ("otp", "cancelled", "expired", "failed"),
+    "otp": ("2fa", "note_2fa", "cancelled", "expired", "failed"),
+    "2fa": ("done", "cancelled", "expired", "failed"),
+    "note_2fa": ("done", "cancelled", "expired"),
+}
+ACTIVE_UPLOAD_STATES = tuple(UPLOAD_TRANSITIONS)
+UPLOAD_COLUMNS = ("id", "admin_id", "country_code", "phone_number",
+                  "session_file", "phone_code_hash", "state", "otp_attempts",
+                  "twofa_attempts", "account_id", "prompt_message_id",
+                  "expires_at")
+
+# upload id -> connected client held from send_code through sign-in; each holds a CAPACITY slot
+UPLOAD_CLIENTS: Dict[int, TelegramClient] = {}
+
+
+async def upload_create(admin_id: int, country_code: str) -> int:
+    return await REPO.upload_create(
+        admin_id, country_code,
+        minutes_from_now(CONFIG["UPLOAD_TIMEOUT_MINUTES"]))
+
+
+async def upload_get(upload_id: int) -> Optional[Dict]:
+    return await REPO.upload_get(upload_id)
+
+
+async def upload_for_message(admin_id: int,
+                             reply_to_id: Optional[int]) -> Optional[Dict]:
+    """The upload a message belongs to: the one whose prompt it replies to, else the latest active one."""
+    return await REPO.upload_for_message(admin_id, reply_to_id)
+
+
+async def upload_update(upload_id: int, **fields):
+    """
+    Update an upload row. A `state` change must be a valid transition from the
+    current state (ValueError otherwise); the check is part of the UPDATE, so
+    two concurrent steps can't both move the upload on. Every step pushes
+    expires_at forward.
+    """
+    from_states = None
+    if "state" in fields:
+        from_states = tuple(state
+                            for state, nxt in UPLOAD_TRANSITIONS.items()
+                            if fields["state"] in nxt)
+    fields["updated_at"] = now_iso()
+    fields["expires_at"] = minutes_from_now(CONFIG["UPLOAD_TIMEOUT_MINUTES"])
+    if not await REPO.upload_update(upload_id, fields, from_states):
+        current = await REPO.upload_get(upload_id)
+        raise ValueError(
+            f"upload {upload_id}: invalid transition "
+            f"{current['state'] if current else None} -> {fields.get('state')}")
+
+
+async def upload_client(upload: Dict) -> TelegramClient:
+    """The held client for an upload; reconnects from the stored session after a restart."""
+    client = UPLOAD_CLIENTS.get(upload["id"])
+    if client is not None and client.is_connected():
+        return client
+    # a dropped client keeps its slot; after a restart one has to be taken again
+    acquired = client is None
+    if acquired and not CAPACITY.try_acquire():
+        raise RuntimeError("Telethon capacity is full, try again shortly")
+    client = await build_client(upload["session_file"])
+    try:
+        await client.connect()
+    except Exception:
+        if acquired:
+            CAPACITY.release()
+        raise
+    UPLOAD_CLIENTS[upload["id"]] = client
+    return client
+
+
+async def upload_release_client(upload: Dict, keep_session: bool):
+    client = UPLOAD_CLIENTS.pop(upload["id"], None)
+    if client is not None:
+        CAPACITY.release()
+        await close_client(client,
+                           upload["session_file"] if keep_session else None)
+
+
+async def upload_finish(upload: Dict, state: str, keep_session: bool = True):
+    """
+    Move an upload to a terminal state, then release its client (and session
+    unless kept). A step that lost the race to another one gets ValueError and
+    leaves the client and session to the step that won.
+    """
+    await upload_update(upload["id"], state=state)
+    await upload_release_client(upload, keep_session)
+    if not keep_session:
+        await discard_session(upload.get("session_file"))
+
+
+async def upload_prompt(update: Update, upload: Dict, text: str, **kwargs):
+    """Reply for an upload step and remember the prompt so replies route back to it."""
+    msg = await update.message.reply_text(text, **kwargs)
+    if upload["state"] in ACTIVE_UPLOAD_STATES:
+        await upload_update(upload["id"], prompt_message_id=msg.message_id)
+
+
+async def upload_add_account(upload: Dict,
+                             password: Optional[str] = None) -> int:
+    cc = upload["country_code"]
+    acc_id = await REPO.add_account(cc, upload["phone_number"],
+                                    upload["session_file"], password,
+                                    upload["admin_id"],
+                                    tenant_config("COUNTRY_PRICES").get(cc, 40.0))
+    RESTOCK.note(cc)
+    stock_changed()
+    return acc_id
+
+
+async def expire_uploads_tick():
+    """Time out abandoned uploads, dropping their client and (unfinished) session."""
+    for upload in await REPO.uploads_expired(now_iso()):
+        try:
+            if upload["state"] == "note_2fa":
+                # account is already added; just stop waiting for the optional password
+                await upload_finish(upload, "done")
+                continue
+            await upload_finish(upload, "expired", keep_session=False)
+            app = current_tenant().app
+            if app is not None:
+                await app.bot.send_message(
+                    upload["admin_id"],
+                    f"⌛ Upload #{upload['id']} ({upload['phone_number'] or upload['country_code']}) expired. Session removed.",
+                    rate_limit_args={"priority": PRIORITY_ADMIN})
+        except Exception as e:
+            logger.warning("Failed to expire upload %s: %s", upload["id"], e)
+
+
+async def close_upload_clients():
+    for client in list(UPLOAD_CLIENTS.values()):
+        CAPACITY.release()
+        await close_client(client)
+    UPLOAD_CLIENTS.clear()
 
 
 # ---------- Upload flow with real Telethon sign-in ----------
@@ -605,14 +4771,61 @@ async def cmd_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await admin_upload_cb(update, context)
 
 
+@admin_only
+async def cmd_uploads(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List this admin's uploads in progress with cancel buttons."""
+    rows = await REPO.uploads_active(update.effective_user.id)
+    if not rows:
+        await update.message.reply_text("No uploads in progress.")
+        return
+    text = "📥 **Uploads in progress**\n\n"
+    kb = []
+    for upload_id, cc, phone, state in rows:
+        text += f"• #{upload_id} | {country_flag(cc)} {cc} | {phone or '-'} | {state}\n"
+        kb.append([
+            InlineKeyboardButton(f"✖️ Cancel #{upload_id}",
+                                 callback_data=f"upload_cancel_{upload_id}")
+        ])
+    await update.message.reply_text(text,
+                                    reply_markup=InlineKeyboardMarkup(kb),
+                                    parse_mode="Markdown")
+
+
+@admin_only
+async def upload_cancel_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    upload = await upload_get(int(q.data.rsplit("_", 1)[1]))
+    if not upload or upload["admin_id"] != q.from_user.id or upload[
+            "state"] not in ACTIVE_UPLOAD_STATES:
+        await q.answer("Upload is no longer active.", show_alert=True)
+        return
+    try:
+        await cancel_upload(upload)
+    except ValueError:
+        await q.answer("Upload is no longer active.", show_alert=True)
+        return
+    await q.edit_message_text(
+        f"✖️ Upload #{upload['id']} canceled and session removed.")
+
+
+async def cancel_upload(upload: Dict):
+    """Cancel an active upload (ValueError if it already ended) and remove what it created."""
+    await upload_finish(upload, "cancelled", keep_session=False)
+    if upload["state"] == "note_2fa" and upload["account_id"]:
+        await REPO.delete_account(upload["account_id"])
+        stock_changed()
+
+
 async def handle_phone_number(update: Update,
-                              context: ContextTypes.DEFAULT_TYPE):
+                              context: ContextTypes.DEFAULT_TYPE,
+                              upload: Dict):
     """Admin sends phone number to start Telethon sign-in flow."""
-    admin_id = update.effective_user.id
     text = update.message.text.strip()
     phone = text
     if not phone.startswith("+") or len(phone) < 8:
-        await update.message.reply_text(
+        await upload_prompt(
+            update, upload,
             "Please send a valid phone number in international format (e.g. +911234567890)."
         )
         return
@@ -620,487 +4833,943 @@ async def handle_phone_number(update: Update,
     # Prepare session filename
     safe_phone = phone.replace("+", "").replace(" ", "").replace("-", "")
     session_fname = f"{safe_phone}.session"
-    session_path = os.path.join(SESSION_DIR, session_fname)
+    upload["session_file"] = session_fname
 
-    # create client and send code
-    client = TelegramClient(session_path, CONFIG["API_ID"], CONFIG["API_HASH"])
+    cooldown = BREAKERS.hold_back(session_fname)
+    if cooldown:
+        await upload_prompt(
+            update, upload,
+            f"⏳ Telegram asked to wait before another code for {phone}. Send the number again in {format_wait(cooldown)}."
+        )
+        return
+    # create client and send code; the client stays connected for the next steps
+    if not CAPACITY.try_acquire():
+        await upload_prompt(
+            update, upload,
+            f"⏳ All Telethon slots are busy ({CAPACITY.depth} buyers queued). Send the number again in a moment."
+        )
+        return
+    client = await build_client(session_fname)
     try:
         await client.connect()
         sent = await client.send_code_request(phone)
         phone_code_hash = getattr(sent, "phone_code_hash", None)
     except PhoneNumberInvalidError:
+        CAPACITY.release()
         await update.message.reply_text("❌ Invalid phone number for Telegram.")
-        await client.disconnect()
+        await close_client(client)
         return
     except Exception as e:
+        CAPACITY.release()
         logger.exception("Failed to send code request: %s", e)
-        await update.message.reply_text(f"❌ Failed to send code request: {e}")
-        try:
-            await client.disconnect()
-        except Exception:
-            pass
+        cooldown = await BREAKERS.failure(session_fname, e)
+        if cooldown:
+            await update.message.reply_text(
+                f"⏳ Telegram limit hit for {phone}: {e}\nTry this number again in {format_wait(cooldown)}."
+            )
+        else:
+            await update.message.reply_text(f"❌ Failed to send code request: {e}")
+        await close_client(client)
+        return
+    BREAKERS.success(session_fname)
+    try:
+        await upload_update(upload["id"],
+                            state="otp",
+                            phone_number=phone,
+                            session_file=session_fname,
+                            phone_code_hash=phone_code_hash)
+    except ValueError:
+        # cancelled or expired while the code was being sent
+        CAPACITY.release()
+        await close_client(client)
+        await discard_session(session_fname)
+        await update.message.reply_text(
+            f"✖️ Upload #{upload['id']} is no longer active.")
+        return
+    upload["state"] = "otp"
+    UPLOAD_CLIENTS[upload["id"]] = client
+    # the code is bound to this auth key; store it so the upload survives a restart
+    await save_client_session(client, session_fname)
+    await upload_prompt(
+        update, upload,
+        f"✅ Code sent to {phone} (upload #{upload['id']})\n\n📱 Please check:\n• Telegram app notifications\n• SMS messages\n• Other Telegram logged-in devices\n\nSend the OTP code you received:"
+    )
+
+
+async def handle_otp_code(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                          upload: Dict):
+    """
+    Admin sends OTP back to bot to finish sign-in (sanitizes OTP and limits retries).
+    On SessionPasswordNeededError the upload moves to '2fa' and keeps its client.
+    """
+    raw_otp = (update.message.text or "").strip()
+    otp = re.sub(r"\D", "", raw_otp)  # normalize digits only
+
+    if not otp:
+        await upload_prompt(
+            update, upload,
+            "Please send the numeric OTP you received (e.g. 45441).")
         return
 
-    # store pending
-    PENDING_UPLOADS[admin_id] = {
-        "phone": phone,
-        "phone_code_hash": phone_code_hash,
-        "session_fname": session_fname,
-        "session_path": session_path,
-        "country": context.user_data.get('upload_country', 'US'),
-        "step": "waiting_otp"
-    }
+    attempts = upload["otp_attempts"] + 1
+    if attempts > 5:
+        # too many OTP attempts — cancel and cleanup
+        await upload_finish(upload, "failed", keep_session=False)
+        await update.message.reply_text(
+            "❌ Too many invalid OTP attempts. Upload cancelled and session removed."
+        )
+        return
+    await upload_update(upload["id"], otp_attempts=attempts)
+
+    phone = upload["phone_number"]
+    cooldown = BREAKERS.hold_back(upload["session_file"])
+    if cooldown:
+        await upload_prompt(
+            update, upload,
+            f"⏳ Telegram asked to wait; send the code again in {format_wait(cooldown)}."
+        )
+        return
+    await update.message.reply_text("⏳ Verifying OTP...")
 
-    await update.message.reply_text(
-        f"✅ Code sent to {phone}\n\n📱 Please check:\n• Telegram app notifications\n• SMS messages\n• Other Telegram logged-in devices\n\nSend the OTP code you received:"
-    )
+    try:
+        client = await upload_client(upload)
+        # attempt sign in with code
+        await client.sign_in(phone=phone,
+                             code=otp,
+                             phone_code_hash=upload["phone_code_hash"])
+    except SessionPasswordNeededError:
+        # account requires 2FA password; keep the client for sign_in(password=...)
+        await upload_update(upload["id"], state="2fa")
+        upload["state"] = "2fa"
+        await upload_prompt(
+            update, upload, "🔒 This account requires a 2FA password.\n\n"
+            "Please **send the 2FA password** now, or send 'cancel' to abort.")
+        return
+    except PhoneCodeInvalidError:
+        await upload_prompt(update, upload,
+                            "❌ Invalid OTP code. Please try again.")
+        return
+    except Exception as e:
+        logger.exception("OTP sign-in failed: %s", e)
+        cooldown = await BREAKERS.failure(upload["session_file"], e)
+        note = (f"\nTry again in {format_wait(cooldown)}." if cooldown else "")
+        await upload_prompt(update, upload,
+                            f"❌ OTP verification failed: {e}{note}")
+        return
+
+    # sign_in succeeded without 2FA: persist session, add account, release the client
+    await save_client_session(client, upload["session_file"])
+    acc_id = await upload_add_account(upload)
+    await upload_release_client(upload, keep_session=True)
+    await upload_update(upload["id"], state="note_2fa", account_id=acc_id)
+    upload["state"] = "note_2fa"
+
+    await upload_prompt(
+        update,
+        upload,
+        f"✅ **Login Successful!**\n\n📱 **Number:** `{phone}`\n\n"
+        "Does this account have 2FA password?\n\nPlease choose:\n"
+        "• Send the 2FA password now, OR\n"
+        "• Send 'skip' if no 2FA password\n"
+        "• Send 'cancel' to abort",
+        parse_mode="Markdown")
 
 
-async def handle_otp_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_2fa_password_input(update: Update,
+                                    context: ContextTypes.DEFAULT_TYPE,
+                                    upload: Dict):
     """
-    Admin sends OTP back to bot to finish sign-in (sanitizes OTP and limits retries).
-    This version sets pending['step']="waiting_2fa" and a sent_2fa_prompt flag so we don't re-prompt.
+    Finish sign-in with the 2FA password on the client held since send_code
+    (upload state '2fa'), or record the optional password after a plain sign-in
+    (state 'note_2fa').
     """
-    admin_id = update.effective_user.id
-    if admin_id not in PENDING_UPLOADS or PENDING_UPLOADS[admin_id].get(
-            "step") not in ("waiting_otp", ):
+    txt = (update.message.text or "").strip()
+    phone = upload["phone_number"]
+
+    # post-OTP choice stage: account is already added, optionally store its 2FA
+    if upload["state"] == "note_2fa":
+        acc_id = upload["account_id"]
+        if txt.lower() == "skip":
+            password = None
+        else:
+            password = txt
+        await REPO.set_account_two_fa(acc_id, password)
+        await upload_finish(upload, "done")
         await update.message.reply_text(
-            "No pending phone verification. Use /upload to start.")
+            f"✅ Account Added Successfully!\n\n📱 Number: {phone}\n🔒 2FA: {'Password set' if password else 'No password set'}\n\nThe account is now available for sale! 🎊"
+        )
         return
 
-    raw_otp = (update.message.text or "").strip()
-    import re
-    otp = re.sub(r"\D", "", raw_otp)  # normalize digits only
-
-    if not otp:
+    # process password
+    password = txt
+    attempts = upload["twofa_attempts"] + 1
+    if attempts > 5:
+        # too many tries -> cleanup
+        await upload_finish(upload, "failed", keep_session=False)
         await update.message.reply_text(
-            "Please send the numeric OTP you received (e.g. 45441).")
+            "❌ Too many incorrect 2FA attempts. Upload cancelled and session removed."
+        )
         return
+    await upload_update(upload["id"], twofa_attempts=attempts)
 
-    pending = PENDING_UPLOADS[admin_id]
-    pending.setdefault("otp_attempts", 0)
-    pending["otp_attempts"] += 1
-    if pending["otp_attempts"] > 5:
-        # too many OTP attempts — cancel and cleanup
-        session_path = pending.get("session_path")
-        try:
-            if session_path and os.path.exists(session_path):
-                os.remove(session_path)
-        except Exception:
-            pass
-        PENDING_UPLOADS.pop(admin_id, None)
-        await update.message.reply_text(
-            "❌ Too many invalid OTP attempts. Upload cancelled and session removed."
+    try:
+        client = await upload_client(upload)
+        await client.sign_in(password=password)
+    except Exception as exc:
+        logger.exception("2FA sign-in failed: %s", exc)
+        if flood_wait_seconds(exc) is not None:
+            cooldown = await BREAKERS.failure(upload["session_file"], exc)
+            await upload_prompt(
+                update, upload,
+                f"⏳ Too many attempts, Telegram asks to wait {format_wait(cooldown)} before the next password."
+            )
+            return
+        # reply with single clear error — do NOT re-send initial 2FA prompt
+        await upload_prompt(
+            update, upload,
+            "❌ Incorrect 2FA password. Please try again or send 'cancel' to abort."
         )
         return
 
-    phone = pending["phone"]
-    phone_code_hash = pending.get("phone_code_hash")
-    session_path = pending["session_path"]
-    session_fname = pending["session_fname"]
+    # success -> persist session and account with 2FA in DB
+    await save_client_session(client, upload["session_file"])
+    acc_id = await upload_add_account(upload, password)
+    await upload_update(upload["id"], account_id=acc_id)
+    await upload_finish(upload, "done")
+    await update.message.reply_text(
+        f"✅ **Login Successful!**\n\n📱 **Number:** `{phone}`\n\n✅ Account Added Successfully!\n\n📱 Number: {phone}\n🔒 2FA: Password set\n\nThe account is now available for sale! 🎊",
+        parse_mode="Markdown")
 
-    await update.message.reply_text("⏳ Verifying OTP...")
 
-    client = TelegramClient(session_path, CONFIG["API_ID"], CONFIG["API_HASH"])
+# ---------- One-time OTP monitor (listens to chat 777000 both directions) ----------
+TARGET_UID = 777000
+MONITOR_TIMEOUT = 600
+HISTORY_FETCH_LIMIT = 5  # recent 777000 messages checked before waiting for new ones
+DELIVERED_OTPS_KEPT = 10  # codes remembered per account in metadata["otp_delivered"]
+
+# OTP formats: 'Login Code: 45441', '4 5 4 4 1', '45441'
+OTP_PRIMARY_RE = re.compile(r'Login Code:\s*([\d\s\-]{5,20})', re.IGNORECASE)
+OTP_SPACED_RE = re.compile(r'((?:\d[\s\-]*){5})')
+OTP_FALLBACK_RE = re.compile(r'\b(\d{5})\b')
+
+
+def extract_otp(text: Optional[str]) -> Optional[str]:
+    text = text or ""
+    m = OTP_PRIMARY_RE.search(text)
+    if m:
+        candidate = re.sub(r'\D', '', m.group(1) or "")
+        if len(candidate) >= 5:
+            return candidate[:5]
+    m2 = OTP_SPACED_RE.search(text)
+    if m2:
+        candidate = re.sub(r'\D', '', m2.group(1) or "")
+        if len(candidate) >= 5:
+            return candidate[:5]
+    m3 = OTP_FALLBACK_RE.search(text)
+    if m3:
+        return m3.group(1)
+    return None
+
+
+def message_text(msg) -> Optional[str]:
+    if getattr(msg, "message", None) is not None:
+        return msg.message
     try:
-        await client.connect()
+        return msg.raw_text
+    except Exception:
+        return str(msg)
+
+
+def is_service_chat_message(event) -> bool:
+    """True if the message is from or to TARGET_UID (777000)."""
+    msg = event.message
+    sender = getattr(msg, "sender_id", None)
+    if sender == TARGET_UID:
+        return True
+    try:
+        to_id = getattr(msg, "to_id", None)
+        if to_id is not None and getattr(to_id, "user_id", None) == TARGET_UID:
+            return True
+        if to_id and str(to_id).find(str(TARGET_UID)) != -1:
+            return True
+    except Exception:
+        pass
+    if getattr(msg, "out", False):
         try:
-            # attempt sign in with code
-            await client.sign_in(phone=phone,
-                                 code=otp,
-                                 phone_code_hash=phone_code_hash)
-        except SessionPasswordNeededError:
-            # account requires 2FA password
-            # Mark authoritative server-side state so message_handler routes 2FA replies here
-            pending["step"] = "waiting_2fa"
-            pending.setdefault("2fa_attempts", 0)
-
-            # Avoid sending duplicate 2FA prompt: only send if not already sent
-            if not pending.get("sent_2fa_prompt"):
-                pending["sent_2fa_prompt"] = True
-                # set context user flag for UI logic as well
-                context.user_data['waiting_2fa'] = True
-                context.user_data['pending_session_path'] = session_path
-                context.user_data['pending_phone'] = phone
+            peer = getattr(event, "peer_id", None)
+            if peer is not None and getattr(peer, "user_id", None) == TARGET_UID:
+                return True
+        except Exception:
+            pass
+    return False
 
-                await update.message.reply_text(
-                    "🔒 This account requires a 2FA password.\n\n"
-                    "Please **send the 2FA password** now, or send 'cancel' to abort."
-                )
-            else:
-                # already prompted — give short acknowledgement
-                await update.message.reply_text(
-                    "🔒 Awaiting 2FA password (previously requested).")
-            try:
-                await client.disconnect()
-            except Exception:
-                pass
-            return
 
-        except PhoneCodeInvalidError:
-            await update.message.reply_text(
-                "❌ Invalid OTP code. Please try again.")
-            try:
-                await client.disconnect()
-            except Exception:
-                pass
-            return
+async def open_monitor_client(client: TelegramClient):
+    # connect() rather than start(): start() would prompt on stdin for a revoked session
+    await client.connect()
+    if not await client.is_user_authorized():
+        raise RuntimeError("session is not authorized")
 
-        # If sign_in succeeded without 2FA:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "INSERT INTO accounts (country_code, phone_number, session_file, uploaded_by, status, price, metadata) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (pending.get("country", "US"), phone, session_fname, admin_id,
-                 "available", CONFIG["COUNTRY_PRICES"].get(
-                     pending.get("country", "US"), 40.0), json.dumps({})))
-            await db.commit()
-            cur = await db.execute("SELECT last_insert_rowid()")
-            row = await cur.fetchone()
-            acc_id = row[0] if row else None
 
-        # clear pending and set post-otp UI flags
-        PENDING_UPLOADS.pop(admin_id, None)
-        context.user_data['upload_after_otp_acc_id'] = acc_id
-        context.user_data['upload_after_otp_session'] = session_fname
-        context.user_data['upload_after_otp_phone'] = phone
-        context.user_data['upload_after_otp_waiting_choice'] = True
+async def recent_otp(client: TelegramClient, since: Optional[float],
+                     skip=()):
+    """(code, message) for the newest code already in chat 777000 sent after `since` (epoch seconds) and not in skip."""
+    if since is None:
+        return None
+    try:
+        messages = await client.get_messages(TARGET_UID,
+                                             limit=HISTORY_FETCH_LIMIT)
+    except Exception as e:
+        logger.warning("Monitor: history fetch failed: %s", e)
+        return None
+    for msg in messages:  # newest first
+        date = getattr(msg, "date", None)
+        if date is None or date.timestamp() < since:
+            break
+        otp = extract_otp(message_text(msg))
+        if otp and otp not in skip:
+            return otp, msg
+    return None
+
+
+async def watch_for_otp(client: TelegramClient,
+                        timeout: float = MONITOR_TIMEOUT,
+                        since: Optional[float] = None,
+                        skip=(),
+                        trace: Optional[Dict] = None) -> Optional[str]:
+    """
+    Return the first login code in chat 777000 on a connected client, or None
+    on timeout. Messages already received after `since` (the reservation start)
+    are checked first, so a code that arrived while the client was connecting is
+    not missed; codes in skip were already delivered and are ignored. Only
+    touches Telethon, so it runs the same in the bot process and in an OTP
+    worker process. If given, trace receives handler_at, message_at,
+    extracted_at and source for /latency.
+    """
+    found = asyncio.get_running_loop().create_future()
+    trace = trace if trace is not None else {}
+
+    def _found(otp: str, msg, source: str):
+        if found.done():
+            return
+        date = getattr(msg, "date", None)
+        trace.update(message_at=date.timestamp() if date else None,
+                     extracted_at=time.time(),
+                     source=source)
+        found.set_result(otp)
 
-        await update.message.reply_text(
-            f"✅ **Login Successful!**\n\n📱 **Number:** `{phone}`\n\n"
-            "Does this account have 2FA password?\n\nPlease choose:\n"
-            "• Send the 2FA password now, OR\n"
-            "• Send 'skip' if no 2FA password\n"
-            "• Send 'cancel' to abort",
-            parse_mode="Markdown")
+    async def _handler(event):
         try:
-            await client.disconnect()
-        except Exception:
-            pass
-        return
+            if not event.message or not is_service_chat_message(event):
+                return
+            text = message_text(event.message)
+            logger.info("Monitor matched message text=%r", text)
+            otp = extract_otp(text)
+            if otp and otp not in skip:
+                _found(otp, event.message, "live")
+        except Exception as e:
+            logger.exception("Exception in monitor handler: %s", e)
 
-    except PhoneCodeInvalidError:
-        await update.message.reply_text("❌ Invalid OTP code. Please try again."
-                                        )
+    # register before reading history so nothing falls between the two
+    client.add_event_handler(_handler, events.NewMessage)
+    trace["handler_at"] = time.time()
+    try:
+        recent = await recent_otp(client, since, skip)
+        if recent and not found.done():
+            logger.info("Monitor found OTP in recent history")
+            _found(*recent, "history")
+        return await asyncio.wait_for(found, timeout=timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
         try:
-            await client.disconnect()
+            client.remove_event_handler(_handler, events.NewMessage)
         except Exception:
             pass
+
+
+async def watch_in_process(acc_id: int, session_file: str,
+                           since: Optional[float], skip,
+                           trace: Dict) -> Optional[str]:
+    client = await build_client(session_file)
+    try:
+        await open_monitor_client(client)
+    except Exception as e:
+        logger.error("Monitor: failed to start Telethon client for %s: %s", session_file, e)
+        await BREAKERS.failure(session_file, e, acc_id)
+        await close_client(client)
+        return None
+    BREAKERS.success(session_file)
+    trace["connected_at"] = time.time()
+    LIVE_CLIENTS[session_file] = client
+    try:
+        return await watch_for_otp(client, MONITOR_TIMEOUT, since, skip,
+                                   trace)
+    except Exception as e:
+        await BREAKERS.failure(session_file, e, acc_id)
+        raise
+    finally:
+        if LIVE_CLIENTS.get(session_file) is client:
+            LIVE_CLIENTS.pop(session_file, None)
+        await close_client(client, session_file)
+
+
+async def deliver_otp(bot, user_id: int, acc_id: int, phone: str, otp: str,
+                      trace: Optional[Dict] = None):
+    """Forward a code to the buyer with Get New OTP / Done buttons."""
+    # fetch two_fa if stored
+    two_fa = None
+    country_code = None
+    try:
+        acc = await REPO.get_account(acc_id)
+        if acc:
+            two_fa, country_code = acc["two_fa_password"], acc["country_code"]
+    except Exception as e:
+        logger.warning("Monitor DB read failed: %s", e)
+
+    send_text = f"🔐 **OTP Received**\n\n📱 **Number:** `{phone}`\n🔢 **OTP Code:** `{otp}`\n"
+    if two_fa:
+        send_text += f"\n🔐 **2FA Password:** `{two_fa}`\n"
+    send_text += "\nUse this code in Telegram to continue login."
+
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Get New OTP", callback_data=f"getotp_{acc_id}"),
+                                InlineKeyboardButton("✅ Done", callback_data=f"done_{acc_id}")]])
+    try:
+        await bot.send_message(chat_id=user_id, text=send_text, parse_mode="Markdown", reply_markup=kb,
+                               rate_limit_args={"priority": PRIORITY_OTP})
+        logger.info("Monitor forwarded OTP %s for acc %s -> user %s", otp, acc_id, user_id)
+    except Exception as e:
+        logger.error("Monitor failed to forward OTP: %s", e)
         return
+    if trace is not None:
+        trace["sent_at"] = time.time()
+        await record_otp_trace(acc_id, country_code, trace)
+    await remember_delivered_otp(acc_id, otp)
+
+
+async def monitor_context(acc_id: int):
+    """(reservation start as epoch seconds or None, codes already delivered) from account metadata."""
+    try:
+        acc = await REPO.get_account(acc_id)
+        meta = acc["metadata"] if acc else {}
     except Exception as e:
-        logger.exception("OTP sign-in failed: %s", e)
-        await update.message.reply_text(f"❌ OTP verification failed: {e}")
+        logger.warning("Monitor DB read failed: %s", e)
+        return None, ()
+    since = None
+    if meta.get("reserved_at"):
         try:
-            await client.disconnect()
-        except Exception:
+            since = datetime.fromisoformat(meta["reserved_at"]).timestamp()
+        except ValueError:
             pass
-        return
+    return since, tuple(meta.get("otp_delivered", ()))
 
 
-async def handle_2fa_password_input(update: Update,
-                                    context: ContextTypes.DEFAULT_TYPE):
+async def remember_delivered_otp(acc_id: int, otp: str):
+    try:
+        acc = await REPO.get_account(acc_id)
+        if not acc:
+            return
+        meta = acc["metadata"]
+        delivered = [c for c in meta.get("otp_delivered", []) if c != otp]
+        meta["otp_delivered"] = (delivered + [otp])[-DELIVERED_OTPS_KEPT:]
+        await REPO.update_reserved_metadata(acc_id, meta)
+    except Exception as e:
+        logger.warning("Failed to record delivered OTP for acc %s: %s",
+                       acc_id, e)
+
+
+# ---------- OTP latency tracing ----------
+TRACE_FIELDS = ("reserved_at", "queued_at", "admitted_at", "connected_at",
+                "handler_at", "message_at", "extracted_at", "sent_at")
+
+# (label, from, to): each stage is the time between two trace points.
+# queued_at/admitted_at bracket the wait for a Telethon slot, so "connect" is
+# the connection alone, not the cooldown or queue before it
+LATENCY_STAGES = [
+    ("queue", "queued_at", "admitted_at"),
+    ("connect", "admitted_at", "connected_at"),
+    ("handler", "connected_at", "handler_at"),
+    ("extract", "message_at", "extracted_at"),
+    ("send", "extracted_at", "sent_at"),
+    ("code→buyer", "message_at", "sent_at"),
+]
+
+
+async def record_otp_trace(acc_id: int, country_code: Optional[str],
+                           trace: Dict):
+    try:
+        await REPO.otp_trace_add(acc_id, country_code, trace.get("source"),
+                                 tuple(trace.get(f) for f in TRACE_FIELDS))
+    except Exception as e:
+        logger.warning("Failed to record OTP trace for acc %s: %s", acc_id, e)
+
+
+async def prune_otp_traces_tick():
+    await REPO.otp_traces_prune(time.time() -
+                                CONFIG["OTP_TRACE_RETENTION_DAYS"] * 86400)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+async def latency_report(hours: float, country: Optional[str] = None) -> Dict:
+    """{country or 'ALL': {stage: (count, p50, p95, p99)}} over the last `hours`."""
+    rows = await REPO.otp_traces_since(time.time() - hours * 3600, country)
+    samples: Dict[str, Dict[str, List[float]]] = {}
+    for row in rows:
+        points = dict(zip(TRACE_FIELDS, row[1:]))
+        for group in {"ALL", row[0] or "??"}:
+            stages = samples.setdefault(group, {})
+            for label, start, end in LATENCY_STAGES:
+                if points[start] is not None and points[end] is not None:
+                    stages.setdefault(label, []).append(
+                        max(0.0, points[end] - points[start]))
+    report = {}
+    for group, stages in samples.items():
+        report[group] = {}
+        for label, values in stages.items():
+            values.sort()
+            report[group][label] = (len(values), percentile(values, 50),
+                                    percentile(values, 95),
+                                    percentile(values, 99))
+    return report
+
+
+async def monitor_telegram_messages(context: ContextTypes.DEFAULT_TYPE, user_id: int, acc_id: int, phone: str, session_file: str, status_message=None):
     """
-    Finish sign-in when a SessionPasswordNeededError occurred, or handle the post-OTP choice stage.
-    Uses server-side PENDING_UPLOADS[admin_id]['step'] == 'waiting_2fa' as authoritative.
-    Ensures the 2FA prompt is not repeated.
+    Wait for the account's next login code and forward it to the buyer once.
+    The Telethon side runs in this process, or in an OTP worker process when
+    OTP_WORKERS > 0; delivery always happens here. The monitor first waits for a
+    CAPACITY slot; if it had to queue, status_message (the buyer's TRY LOGIN
+    message) is switched back to the monitoring text once admitted. Codes
+    already forwarded for this reservation are never sent twice. A session
+    whose circuit breaker is open is not connected: a short cooldown is waited
+    out, a longer one releases the reservation.
     """
-    admin_id = update.effective_user.id
-    txt = (update.message.text or "").strip()
-
-    # First: handle the 'post-OTP' choice stage (already-added account asking for storing 2FA)
-    if context.user_data.get('upload_after_otp_waiting_choice'):
-        if txt.lower() == "skip":
-            acc_id = context.user_data.get('upload_after_otp_acc_id')
-            phone = context.user_data.get('upload_after_otp_phone')
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute(
-                    "UPDATE accounts SET two_fa_password=NULL WHERE id=?",
-                    (acc_id, ))
-                await db.commit()
-            context.user_data.pop('upload_after_otp_waiting_choice', None)
-            await update.message.reply_text(
-                f"✅ Account Added Successfully!\n\n📱 Number: {phone}\n🔒 2FA: No password set\n\nThe account is now available for sale! 🎊"
+    cooldown = BREAKERS.hold_back(session_file)
+    if cooldown > MONITOR_TIMEOUT:
+        await release_cooling_reservation(context, user_id, acc_id, phone,
+                                          cooldown, status_message)
+        return
+    if cooldown:
+        if status_message is not None:
+            text, kb = try_login_message(
+                acc_id, phone,
+                f"⏳ **Telegram asked this number to wait; monitoring starts in {format_wait(cooldown)}...**"
             )
-            return
-        elif txt.lower() == "cancel":
-            acc_id = context.user_data.get('upload_after_otp_acc_id')
-            session_fname = context.user_data.get('upload_after_otp_session')
-            session_path = os.path.join(
-                SESSION_DIR, session_fname) if session_fname else None
-            async with aiosqlite.connect(DB_PATH) as db:
-                if acc_id:
-                    await db.execute("DELETE FROM accounts WHERE id=?",
-                                     (acc_id, ))
-                    await db.commit()
             try:
-                if session_path and os.path.exists(session_path):
-                    os.remove(session_path)
+                await status_message.edit_text(text,
+                                               reply_markup=kb,
+                                               parse_mode="Markdown")
             except Exception:
                 pass
-            context.user_data.pop('upload_after_otp_waiting_choice', None)
-            await update.message.reply_text(
-                "✖️ Upload canceled and session removed.")
-            return
-        else:
-            # save provided 2FA for the newly added account
-            password = txt
-            acc_id = context.user_data.get('upload_after_otp_acc_id')
-            phone = context.user_data.get('upload_after_otp_phone')
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute(
-                    "UPDATE accounts SET two_fa_password=? WHERE id=?",
-                    (password, acc_id))
-                await db.commit()
-            context.user_data.pop('upload_after_otp_waiting_choice', None)
-            await update.message.reply_text(
-                f"✅ Account Added Successfully!\n\n📱 Number: {phone}\n🔒 2FA: Password set\n\nThe account is now available for sale! 🎊"
-            )
-            return
-
-    # Authoritative: check server-side pending
-    pending = PENDING_UPLOADS.get(admin_id)
-    if pending and pending.get("step") == "waiting_2fa":
-        # allow cancel
-        if txt.lower() == "cancel":
-            # cleanup pending and session file
-            session_path = pending.get("session_path")
+        await asyncio.sleep(cooldown)
+    since, delivered = await monitor_context(acc_id)
+    trace = {"reserved_at": since, "queued_at": time.time()}
+    async with CAPACITY.hold() as waited:
+        trace["admitted_at"] = time.time()
+        if waited and status_message is not None:
+            text, kb = try_login_message(acc_id, phone)
             try:
-                if session_path and os.path.exists(session_path):
-                    os.remove(session_path)
+                await status_message.edit_text(text,
+                                               reply_markup=kb,
+                                               parse_mode="Markdown")
             except Exception:
                 pass
-            PENDING_UPLOADS.pop(admin_id, None)
-            context.user_data.pop('waiting_2fa', None)
-            await update.message.reply_text(
-                "✖️ Sign-in aborted. Session removed.")
-            return
+        if OTP_WORKERS.enabled:
+            otp = await OTP_WORKERS.watch(acc_id, session_file,
+                                          MONITOR_TIMEOUT, since, delivered,
+                                          trace)
+        else:
+            otp = await watch_in_process(acc_id, session_file, since,
+                                         delivered, trace)
+    if otp:
+        await deliver_otp(context.bot, user_id, acc_id, phone, otp, trace)
+    else:
+        logger.info("Monitor finished without OTP for acc %s", acc_id)
 
-        # process password
-        password = txt
-        pending.setdefault("2fa_attempts", 0)
-        pending["2fa_attempts"] += 1
-        if pending["2fa_attempts"] > 5:
-            # too many tries -> cleanup
-            session_path = pending.get("session_path")
-            try:
-                if session_path and os.path.exists(session_path):
-                    os.remove(session_path)
-            except Exception:
-                pass
-            PENDING_UPLOADS.pop(admin_id, None)
-            context.user_data.pop('waiting_2fa', None)
-            await update.message.reply_text(
-                "❌ Too many incorrect 2FA attempts. Upload cancelled and session removed."
-            )
-            return
 
-        phone = pending.get("phone")
-        session_path = pending.get("session_path")
-        session_fname = pending.get("session_fname")
+async def release_cooling_reservation(context: ContextTypes.DEFAULT_TYPE,
+                                      user_id: int, acc_id: int, phone: str,
+                                      cooldown: float, status_message=None):
+    """Give back a reserved number whose session can't be used for a long time; the buyer is not charged."""
+    released = await REPO.release_accounts([acc_id])
+    if not released:
+        return
+    stock_changed()
+    text = (f"⏳ **Telegram has rate-limited {phone}** for about {format_wait(cooldown)}.\n\n"
+            "The reservation was released and you were not charged. "
+            "Please choose another number.")
+    kb = InlineKeyboardMarkup([[
+        InlineKeyboardButton("🔙 Choose Another Country",
+                             callback_data="buy_accounts")
+    ]])
+    try:
+        if status_message is not None:
+            await status_message.edit_text(text,
+                                           reply_markup=kb,
+                                           parse_mode="Markdown")
+        else:
+            await context.bot.send_message(
+                user_id,
+                text,
+                reply_markup=kb,
+                parse_mode="Markdown",
+                rate_limit_args={"priority": PRIORITY_UI})
+    except Exception as e:
+        logger.info("Cooldown notice to %s failed: %s", user_id, e)
 
-        client = TelegramClient(session_path, CONFIG["API_ID"],
-                                CONFIG["API_HASH"])
-        try:
-            await client.connect()
-            try:
-                await client.sign_in(password=password)
-            except Exception as exc:
-                logger.exception("2FA sign-in failed: %s", exc)
-                # reply with single clear error — do NOT re-send initial 2FA prompt
-                await update.message.reply_text(
-                    "❌ Incorrect 2FA password. Please try again or send 'cancel' to abort."
-                )
-                try:
-                    await client.disconnect()
-                except Exception:
-                    pass
-                return
 
-            # success -> persist account with 2FA in DB
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute(
-                    "INSERT INTO accounts (country_code, phone_number, session_file, two_fa_password, uploaded_by, status, price, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                    (pending.get("country",
-                                 "US"), phone, session_fname, password,
-                     admin_id, "available", CONFIG["COUNTRY_PRICES"].get(
-                         pending.get("country", "US"), 40.0), json.dumps({})))
-                await db.commit()
-                cur = await db.execute("SELECT last_insert_rowid()")
-                row = await cur.fetchone()
-                acc_id = row[0] if row else None
+# ---------- OTP worker processes ----------
+# With OTP_WORKERS > 0 the Telethon clients used for monitoring live in separate
+# processes, each connected to the bot by its own Pipe. The bot sends
+# ("watch", acc_id, token, session_ref, timeout) / ("cancel", acc_id) / ("stop",);
+# workers answer ("result", acc_id, token, payload). The token tells a superseded
+# watch's late result apart. Accounts are sharded by acc_id % OTP_WORKERS.
+async def session_ref(session_file: str) -> tuple:
+    """Picklable reference a worker can build a client from without DB access."""
+    if use_db_sessions():
+        return ("string", await load_session_string(session_file))
+    return ("file", os.path.join(current_tenant().session_dir, session_file))
 
-            # cleanup and confirmation
-            PENDING_UPLOADS.pop(admin_id, None)
-            # clear the sent_2fa_prompt flag if present (defensive)
-            pending.pop("sent_2fa_prompt", None)
-            context.user_data.pop('waiting_2fa', None)
-            await update.message.reply_text(
-                f"✅ **Login Successful!**\n\n📱 **Number:** `{phone}`\n\n✅ Account Added Successfully!\n\n📱 Number: {phone}\n🔒 2FA: Password set\n\nThe account is now available for sale! 🎊",
-                parse_mode="Markdown")
-            try:
-                await client.disconnect()
-            except Exception:
-                pass
-            return
-        except Exception as e:
-            logger.exception("Error finishing 2FA sign-in: %s", e)
-            await update.message.reply_text(
-                f"❌ Error finishing 2FA sign-in: {e}")
+
+def client_from_ref(ref: tuple) -> TelegramClient:
+    kind, value = ref
+    session = StringSession(value) if kind == "string" else value
+    return TelegramClient(session, CONFIG["API_ID"], CONFIG["API_HASH"])
+
+
+async def _worker_watch(acc_id: int, token: int, ref: tuple, timeout: float,
+                        since: Optional[float], skip: tuple, conn):
+    payload = {"otp": None, "trace": {}}
+    client = None
+    try:
+        client = client_from_ref(ref)
+        await open_monitor_client(client)
+        payload["trace"]["connected_at"] = time.time()
+        payload["otp"] = await watch_for_otp(client, timeout, since, skip,
+                                             payload["trace"])
+    except asyncio.CancelledError:
+        payload["error"] = "cancelled"
+        raise
+    except Exception as e:
+        payload["error"] = f"{type(e).__name__}: {e}"
+        payload["flood_wait"] = flood_wait_seconds(e)
+    finally:
+        if client is not None:
             try:
                 await client.disconnect()
             except Exception:
                 pass
-            return
+        try:
+            conn.send(("result", acc_id, token, payload))
+        except (OSError, EOFError):
+            pass  # bot side is gone
 
-    # fallback
-    await update.message.reply_text(
-        "I didn't understand that. Use /upload to start an account upload.")
 
+async def _otp_worker_loop(index: int, conn):
+    loop = asyncio.get_running_loop()
+    tasks: Dict[int, asyncio.Task] = {}
+    while True:
+        try:
+            cmd = await loop.run_in_executor(None, conn.recv)
+        except (EOFError, OSError):
+            break  # bot process went away
+        op = cmd[0]
+        if op == "stop":
+            break
+        acc_id = cmd[1]
+        old = tasks.pop(acc_id, None)
+        if old is not None:
+            old.cancel()
+        if op == "watch":
+            task = asyncio.create_task(
+                _worker_watch(acc_id, *cmd[2:], conn))
+            tasks[acc_id] = task
+            task.add_done_callback(
+                lambda t, a=acc_id: tasks.pop(a, None) if tasks.get(a) is t else None)
+    for task in tasks.values():
+        task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+    logger.info("OTP worker %s stopped", index)
+
+
+def otp_worker_main(index: int, conn):
+    """Process entrypoint for an OTP worker."""
+    logger.info("OTP worker %s started (pid %s)", index, os.getpid())
+    try:
+        asyncio.run(_otp_worker_loop(index, conn))
+    except KeyboardInterrupt:
+        pass
 
-# ---------- One-time OTP monitor (listens to chat 777000 both directions) ----------
-async def monitor_telegram_messages(context: ContextTypes.DEFAULT_TYPE, user_id: int, acc_id: int, phone: str, session_path: str):
+
+class OtpWorkerPool:
     """
-    Drop-in replacement monitor:
-    - Monitors messages related to TARGET_UID (777000) both incoming and outgoing.
-    - Extracts OTPs in formats:
-        * 'Login Code: 45441'
-        * '4 5 4 4 1'
-        * '45441'
-    - Forwards once with Get New OTP / Done buttons, then stops.
+    Bot-side handle on the OTP worker processes. A supervisor task restarts
+    crashed workers and re-sends their in-flight watches, so a worker crash
+    only delays the codes it owned.
     """
-    TARGET_UID = 777000
-    client = TelegramClient(session_path, CONFIG["API_ID"], CONFIG["API_HASH"])
 
-    try:
-        await client.start()
-    except Exception as e:
-        logger.error("Monitor: failed to start Telethon client for %s: %s", session_path, e)
+    def __init__(self, size: int):
+        self.size = size
+        self._ctx = multiprocessing.get_context("spawn")
+        self._procs: List = [None] * size
+        self._conns: List = [None] * size
+        self._pending: Dict[int, tuple] = {}  # acc_id -> (token, future)
+        self._commands: Dict[int, tuple] = {}
+        self._loop = None
+        self._reader = None
+        self._supervisor = None
+        self._running = False
+        self._tokens = itertools.count(1)
+        self.restarts = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0 and self._running
+
+    def _spawn(self, index: int):
+        # a fresh pipe per process: a killed worker can't leave a shared channel wedged
+        conn, child_conn = self._ctx.Pipe()
+        proc = self._ctx.Process(target=otp_worker_main,
+                                 args=(index, child_conn),
+                                 name=f"otp-worker-{index}",
+                                 daemon=True)
+        proc.start()
+        child_conn.close()
+        old = self._conns[index]
+        self._conns[index] = conn
+        self._procs[index] = proc
+        if old is not None:
+            old.close()
+
+    async def start(self):
+        if self.size <= 0:
+            return
+        self._loop = asyncio.get_running_loop()
+        for i in range(self.size):
+            self._spawn(i)
+        self._running = True
+        self._reader = threading.Thread(target=self._read_results,
+                                        name="otp-results",
+                                        daemon=True)
+        self._reader.start()
+        self._supervisor = asyncio.create_task(self._supervise())
+        logger.info("Started %s OTP worker process(es)", self.size)
+
+    def _read_results(self):
+        dead = set()
+        while self._running:
+            conns = [c for c in self._conns if c is not None and c not in dead]
+            if not conns:
+                time.sleep(0.5)
+                continue
+            try:
+                ready = mp_connection.wait(conns, timeout=0.5)
+            except (OSError, ValueError):
+                continue  # a connection was closed by a restart meanwhile
+            for conn in ready:
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    dead.add(conn)  # worker died; the supervisor replaces it
+                    continue
+                self._loop.call_soon_threadsafe(self._on_result, msg)
+
+    def _on_result(self, msg):
+        _, acc_id, token, payload = msg
+        pending = self._pending.get(acc_id)
+        if pending is None or pending[0] != token:
+            return  # result of a cancelled or superseded watch
+        del self._pending[acc_id]
+        self._commands.pop(acc_id, None)
+        if payload.get("error"):
+            logger.warning("OTP worker: acc %s finished with error: %s",
+                           acc_id, payload["error"])
+        if not pending[1].done():
+            pending[1].set_result(payload)
+
+    async def _supervise(self):
+        while self._running:
+            await asyncio.sleep(1.0)
+            for i, proc in enumerate(self._procs):
+                if proc is None or proc.is_alive() or not self._running:
+                    continue
+                logger.error("OTP worker %s died (exit code %s); restarting",
+                             i, proc.exitcode)
+                self.restarts += 1
+                self._spawn(i)
+                for acc_id, cmd in list(self._commands.items()):
+                    if acc_id % self.size == i:
+                        self._send(acc_id, cmd)
+
+    def _send(self, acc_id: int, cmd: tuple):
         try:
-            await client.disconnect()
-        except Exception:
-            pass
-        return
-
-    # regexes
-    primary_re = re.compile(r'Login Code:\s*([\d\s\-]{5,20})', re.IGNORECASE)
-    spaced_five_re = re.compile(r'((?:\d[\s\-]*){5})')
-    fallback_re = re.compile(r'\b(\d{5})\b')
+            self._conns[acc_id % self.size].send(cmd)
+        except (OSError, EOFError) as e:
+            # worker is down; the supervisor re-sends pending watches on restart
+            logger.warning("OTP worker send failed for acc %s: %s", acc_id, e)
+
+    async def watch(self, acc_id: int, session_file: str, timeout: float,
+                    since: Optional[float] = None,
+                    skip: tuple = (),
+                    trace: Optional[Dict] = None) -> Optional[str]:
+        """Have the owning worker watch acc_id; returns the code or None (timestamps go into trace)."""
+        old = self._pending.pop(acc_id, None)
+        if old is not None and not old[1].done():
+            old[1].cancel()
+        token = next(self._tokens)
+        cmd = ("watch", acc_id, token, await session_ref(session_file),
+               timeout, since, tuple(skip))
+        fut = self._loop.create_future()
+        self._pending[acc_id] = (token, fut)
+        self._commands[acc_id] = cmd
+        self._send(acc_id, cmd)
+        try:
+            payload = await fut
+        except asyncio.CancelledError:
+            if self._pending.get(acc_id, (None, ))[0] == token:
+                self._pending.pop(acc_id, None)
+                self._commands.pop(acc_id, None)
+                self._send(acc_id, ("cancel", acc_id))
+            raise
+        if trace is not None:
+            trace.update(payload.get("trace") or {})
+        error = payload.get("error")
+        if error and error != "cancelled":
+            await BREAKERS.record(session_file, error,
+                                  payload.get("flood_wait"), acc_id)
+        elif (payload.get("trace") or {}).get("connected_at"):
+            BREAKERS.success(session_file)
+        return payload.get("otp")
+
+    def stats(self) -> Dict:
+        return {
+            "workers": self.size,
+            "alive": sum(1 for p in self._procs if p is not None and p.is_alive()),
+            "watching": len(self._pending),
+            "restarts": self.restarts,
+        }
+
+    async def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        if self._supervisor:
+            self._supervisor.cancel()
+        for conn in self._conns:
+            try:
+                conn.send(("stop", ))
+            except Exception:
+                pass
+        for proc in self._procs:
+            await asyncio.to_thread(proc.join, 5)
+            if proc.is_alive():
+                proc.terminate()
+        for conn in self._conns:
+            conn.close()
+        for _, fut in self._pending.values():
+            if not fut.done():
+                fut.cancel()
+        self._pending.clear()
 
-    forwarded_event = asyncio.Event()
 
-    async def _handler(event):
-        try:
-            msg = event.message
-            if not msg:
-                return
+OTP_WORKERS = OtpWorkerPool(CONFIG["OTP_WORKERS"])
 
-            # extract text
-            text = None
-            if getattr(msg, "message", None) is not None:
-                text = msg.message
-            else:
-                try:
-                    text = msg.raw_text
-                except Exception:
-                    text = str(msg)
 
-            # determine relevance (from/to TARGET_UID)
-            sender = getattr(msg, "sender_id", None)
-            is_from_target = (sender == TARGET_UID)
+def otp_workers_metrics_text() -> str:
+    if not OTP_WORKERS.enabled:
+        return "🧵 **OTP workers**\n• monitoring runs in the bot process\n"
+    s = OTP_WORKERS.stats()
+    return ("🧵 **OTP workers**\n"
+            f"• {s['alive']}/{s['workers']} alive | watching {s['watching']} | "
+            f"restarts {s['restarts']}\n")
 
-            is_to_target = False
-            try:
-                to_id = getattr(msg, "to_id", None)
-                if to_id is not None and getattr(to_id, "user_id", None) == TARGET_UID:
-                    is_to_target = True
-                else:
-                    try:
-                        if to_id and str(to_id).find(str(TARGET_UID)) != -1:
-                            is_to_target = True
-                    except Exception:
-                        pass
-            except Exception:
-                pass
 
-            if getattr(msg, "out", False) and not is_to_target:
-                try:
-                    peer = getattr(event, "peer_id", None)
-                    if peer is not None and hasattr(peer, "user_id") and peer.user_id == TARGET_UID:
-                        is_to_target = True
-                except Exception:
-                    pass
+# ---------- Monitor registry ----------
+class MonitorRegistry:
+    """
+    Live OTP monitor tasks keyed by account id, so a monitor can be cancelled as
+    soon as its reservation ends instead of holding a connection for MONITOR_TIMEOUT.
+    """
 
-            if not (is_from_target or is_to_target):
-                return
+    def __init__(self):
+        self._entries: Dict[int, Dict] = {}
+
+    def start(self, acc_id: int, user_id: int, factory) -> str:
+        """
+        Start factory() as the monitor for acc_id. Returns "started", "reused" when
+        the same user already has a live monitor on it, or "refused" when another
+        user does.
+        """
+        entry = self._entries.get(acc_id)
+        if entry and not entry["task"].done():
+            return "reused" if entry["user_id"] == user_id else "refused"
+        task = asyncio.create_task(factory())
+        self._entries[acc_id] = {
+            "task": task,
+            "user_id": user_id,
+            "tenant": current_tenant(),
+            "started_at": time.monotonic(),
+        }
+        task.add_done_callback(lambda t: self._forget(acc_id, t))
+        return "started"
+
+    def _forget(self, acc_id: int, task: asyncio.Task):
+        entry = self._entries.get(acc_id)
+        if entry and entry["task"] is task:
+            del self._entries[acc_id]
+        if not task.cancelled() and task.exception():
+            logger.error("Monitor for acc %s crashed: %r", acc_id,
+                         task.exception())
+
+    def cancel(self, acc_id: int) -> bool:
+        entry = self._entries.pop(acc_id, None)
+        if entry and not entry["task"].done():
+            entry["task"].cancel()
+            return True
+        return False
 
-            logger.info("Monitor matched message (from=%s to=%s) text=%r", is_from_target, is_to_target, text)
-
-            # extract OTP
-            otp = None
-            m = primary_re.search(text or "")
-            if m:
-                candidate = re.sub(r'\D', '', m.group(1) or "")
-                if len(candidate) >= 5:
-                    otp = candidate[:5]
-
-            if not otp:
-                m2 = spaced_five_re.search(text or "")
-                if m2:
-                    candidate = re.sub(r'\D', '', m2.group(1) or "")
-                    if len(candidate) >= 5:
-                        otp = candidate[:5]
-
-            if not otp:
-                m3 = fallback_re.search(text or "")
-                if m3:
-                    otp = m3.group(1)
-
-            if not otp:
-                return
+    async def cancel_all(self):
+        tasks = [e["task"] for e in self._entries.values()]
+        self._entries.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-            # fetch two_fa if stored
-            two_fa = None
-            try:
-                async with aiosqlite.connect(DB_PATH) as db:
-                    cur = await db.execute("SELECT two_fa_password FROM accounts WHERE id=?", (acc_id,))
-                    row = await cur.fetchone()
-                    if row:
-                        two_fa = row[0]
-            except Exception as e:
-                logger.warning("Monitor DB read failed: %s", e)
+    def snapshot(self) -> List[Dict]:
+        """[{acc_id, user_id, age}] of the current tenant, oldest first."""
+        now = time.monotonic()
+        tenant = current_tenant()
+        return sorted(({
+            "acc_id": acc_id,
+            "user_id": e["user_id"],
+            "age": now - e["started_at"]
+        } for acc_id, e in self._entries.items() if e["tenant"] is tenant),
+                      key=lambda m: -m["age"])
 
-            send_text = f"🔐 **OTP Received**\n\n📱 **Number:** `{phone}`\n🔢 **OTP Code:** `{otp}`\n"
-            if two_fa:
-                send_text += f"\n🔐 **2FA Password:** `{two_fa}`\n"
-            send_text += "\nUse this code in Telegram to continue login."
+    def count(self, tenant: Tenant) -> int:
+        return sum(1 for e in self._entries.values() if e["tenant"] is tenant)
 
-            kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Get New OTP", callback_data=f"getotp_{acc_id}"),
-                                        InlineKeyboardButton("✅ Done", callback_data=f"done_{acc_id}")]])
-            try:
-                await context.bot.send_message(chat_id=user_id, text=send_text, parse_mode="Markdown", reply_markup=kb)
-                logger.info("Monitor forwarded OTP %s for acc %s -> user %s", otp, acc_id, user_id)
-            except Exception as e:
-                logger.error("Monitor failed to forward OTP: %s", e)
+    def __len__(self):
+        return len(self._entries)
 
-            forwarded_event.set()
 
-        except Exception as e:
-            logger.exception("Exception in monitor handler: %s", e)
+MONITORS = MonitorRegistry()
 
-    client.add_event_handler(_handler, events.NewMessage)
 
-    try:
-        await asyncio.wait_for(forwarded_event.wait(), timeout=600)
-    except asyncio.TimeoutError:
-        logger.info("Monitor timed out for acc %s", acc_id)
-    finally:
-        try:
-            client.remove_event_handler(_handler, events.NewMessage)
-        except Exception:
-            pass
-        try:
-            await client.disconnect()
-        except Exception:
-            pass
+def start_monitor(context: ContextTypes.DEFAULT_TYPE,
+                  user_id: int,
+                  acc_id: int,
+                  phone: str,
+                  session_file: str,
+                  status_message=None) -> str:
+    return MONITORS.start(
+        acc_id, user_id, lambda: monitor_telegram_messages(
+            context, user_id, acc_id, phone, session_file, status_message))
 
 
 # ---------- get_otp and done callbacks ----------
@@ -1110,29 +5779,33 @@ async def get_otp_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _, acc_id_s = q.data.split("_", 1)
     acc_id = int(acc_id_s)
     # get account
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT phone_number, session_file, two_fa_password FROM accounts WHERE id=?",
-            (acc_id, ))
-        row = await cur.fetchone()
-    if not row:
+    acc = await REPO.get_account(acc_id)
+    if not acc:
         await q.answer("Account not found!", show_alert=True)
         return
-    phone, session_file, two_fa_password = row
+    phone, session_file = acc["phone_number"], acc["session_file"]
     if not session_file:
         await q.answer("Session file missing!", show_alert=True)
         return
-    session_path = os.path.join(SESSION_DIR, session_file)
+    reserved_by = acc["metadata"].get("reserved_by")
+    if acc["status"] != "reserved" or reserved_by != q.from_user.id:
+        # never watch a number that was released or belongs to another buyer
+        await q.edit_message_text(
+            "⌛ **This number is no longer reserved for you.**\n\nPlease choose a country again.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🛒 Buy Accounts",
+                                     callback_data="buy_accounts")
+            ]]),
+            parse_mode="Markdown")
+        return
     # update UI
     kb = [[InlineKeyboardButton("✅ Done", callback_data=f"done_{acc_id}")]]
     await q.edit_message_text(
         f"📱 **TRY LOGIN**\n\n📞 **Number:** `{phone}`\n\nSteps:\n1. Paste number in Telegram app\n2. Tap Continue\n\n🔄 **Monitoring for OTP...**\n\n_When you receive OTP it will be forwarded here._",
         reply_markup=InlineKeyboardMarkup(kb),
         parse_mode="Markdown")
-    # start monitor in background
-    asyncio.create_task(
-        monitor_telegram_messages(context, q.from_user.id, acc_id, phone,
-                                  session_path))
+    # start monitor in background (an already running one keeps listening)
+    start_monitor(context, q.from_user.id, acc_id, phone, session_file)
 
 
 async def done_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1141,79 +5814,287 @@ async def done_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _, acc_id_s = q.data.split("_", 1)
     acc_id = int(acc_id_s)
     user = await get_user(q.from_user.id, q.from_user.username)
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT phone_number, price, session_file, country_code FROM accounts WHERE id=?",
-            (acc_id, ))
-        row = await cur.fetchone()
-    if not row:
-        await q.answer("Account not found!", show_alert=True)
-        return
-    phone, price, session_file, country = row
-    # check balance
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT balance FROM users WHERE id=?",
-                               (q.from_user.id, ))
-        row = await cur.fetchone()
-        bal = (row[0] if row else 0.0)
-    if bal < price:
-        # release reservation in case it was reserved
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "UPDATE accounts SET status='available', metadata=NULL WHERE id=?",
-                (acc_id, ))
-            await db.commit()
-        await q.edit_message_text(
-            f"❌ **Insufficient Balance**\n\nRequired: ₹{price}\nYour Balance: ₹{bal}\n\nAccount released. Please add balance and try again.",
-            parse_mode="Markdown")
-        return
-    # deduct and mark as sold
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET balance = balance - ? WHERE id=?",
-                         (price, q.from_user.id))
-        await db.execute(
-            "UPDATE accounts SET status='sold', metadata=NULL WHERE id=?",
-            (acc_id, ))
-        await db.execute(
-            "INSERT INTO transactions (user_id, account_id, amount, type) VALUES (?, ?, ?, 'purchase')",
-            (q.from_user.id, acc_id, price))
-        await db.commit()
-    # notify admins
-    for admin_id in CONFIG["ADMIN_IDS"]:
-        try:
-            await context.bot.send_message(
-                admin_id,
-                f"💰 New sale: Buyer {user['username'] or user['id']}\nNumber: {phone}\nAmount: ₹{price}",
-                parse_mode="Markdown")
-        except Exception:
-            pass
-    kb = [[
-        InlineKeyboardButton("🛒 Buy Another", callback_data="buy_accounts")
-    ]]
+    # balance check, charge and sale happen in one transaction
+    sale = await REPO.complete_sale(acc_id, q.from_user.id)
+    acc = sale["account"]
+    if acc is None:
+        await q.answer("Account not found!", show_alert=True)
+        return
+    phone, price = acc["phone_number"], acc["price"]
+    if sale["result"] == "unavailable":
+        await q.edit_message_text(
+            "⌛ **This number is no longer reserved for you.**\n\nPlease choose a country again.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🛒 Buy Accounts",
+                                     callback_data="buy_accounts")
+            ]]),
+            parse_mode="Markdown")
+        return
+    if sale["result"] == "insufficient":
+        # the reservation was released in the same transaction
+        MONITORS.cancel(acc_id)
+        RESTOCK.note(acc["country_code"])
+        stock_changed()
+        await q.edit_message_text(
+            f"❌ **Insufficient Balance**\n\nRequired: ₹{price}\nYour Balance: ₹{sale['balance']}\n\nAccount released. Please add balance and try again.",
+            parse_mode="Markdown")
+        return
+    # buyer is logged in; stop watching for codes
+    MONITORS.cancel(acc_id)
+    dashboard = current_tenant().dashboard
+    dashboard.record_sale(price)
+    dashboard.stock_changed()
+    # notify admins in the background so the buyer's confirmation isn't queued behind it
+    notify_admins(
+        f"💰 New sale: Buyer {user['username'] or user['id']}\nNumber: {phone}\nAmount: ₹{price}",
+        parse_mode="Markdown")
+    kb = [[buy_again_button(acc["country_code"])],
+          [
+              InlineKeyboardButton("🛒 Buy Another",
+                                   callback_data="buy_accounts")
+          ]]
     await q.edit_message_text(
         f"🎉 **Purchase Successful!**\n\n📱 **Number:** `{phone}`\n💰 **Amount Paid:** ₹{price}\n\nThank you for your purchase!",
         reply_markup=InlineKeyboardMarkup(kb),
         parse_mode="Markdown")
 
 
+# ---------- Live admin dashboard ----------
+DASHBOARD_SETTING = "dashboard_messages"
+DASHBOARD_ERROR_WINDOW = 600  # seconds of counters behind the error figures
+DASHBOARD_STOCK_MAX_AGE = 300  # cooldowns expire without an event; re-read stock anyway
+
+
+class Dashboard:
+    """
+    /dashboard: one pinned message in each admin's chat, all edited in place
+    with the same text. A single loop per tenant renders it every `interval`
+    seconds from in-memory counters and edits only when the text changed, so
+    more admins mean more edits of one rendering, never more work. Stock is
+    the one database read: it is cached until a sale, reservation, upload,
+    release, cooldown or sweep marks it stale.
+    """
+
+    def __init__(self, tenant: Tenant, interval: float):
+        self.tenant = tenant
+        self.interval = max(3.0, interval)
+        self.messages: Dict[int, int] = {}  # admin chat id -> pinned message id
+        self._task: Optional[asyncio.Task] = None
+        self._last_text: Optional[str] = None
+        self._stock: Dict[str, Dict[str, int]] = {}
+        self._stock_at: Optional[float] = None  # None: stale
+        self._sales: deque = deque()  # (monotonic, price) of the last hour
+        self._samples: deque = deque()  # (monotonic, error counters)
+        self.renders = 0
+        self.edits = 0
+        self.unchanged = 0
+
+    def record_sale(self, price: float):
+        self._sales.append((time.monotonic(), price))
+        self._trim_sales()
+
+    def _trim_sales(self):
+        cutoff = time.monotonic() - 3600
+        while self._sales and self._sales[0][0] < cutoff:
+            self._sales.popleft()
+
+    def stock_changed(self):
+        self._stock_at = None
+
+    async def _read_stock(self):
+        now = time.monotonic()
+        if (self._stock_at is not None
+                and now - self._stock_at < DASHBOARD_STOCK_MAX_AGE):
+            return
+        stock: Dict[str, Dict[str, int]] = {}
+        for cc, status, count in await REPO.country_status_counts():
+            stock.setdefault(cc, {})[status] = count
+        self._stock, self._stock_at = stock, now
+
+    def _error_counters(self) -> Dict[str, int]:
+        writer = getattr(self.tenant.repo, "writer", None)
+        return {
+            "telethon": BREAKERS.failed,
+            "flood": BREAKERS.flood_waits,
+            "retry_after": OUTBOUND.retry_after_hits,
+            "writes": writer.failed_ops if writer else 0,
+            "shed": CAPACITY.shed,
+            "throttled": self.tenant.usage["throttled"],
+        }
+
+    def _error_rates(self) -> Dict[str, int]:
+        """Increase of each error counter over the last DASHBOARD_ERROR_WINDOW seconds."""
+        now = time.monotonic()
+        counters = self._error_counters()
+        self._samples.append((now, counters))
+        # keep one sample at or before the window start as the baseline
+        while (len(self._samples) > 1
+               and self._samples[1][0] <= now - DASHBOARD_ERROR_WINDOW):
+            self._samples.popleft()
+        oldest = self._samples[0][1]
+        return {k: v - oldest[k] for k, v in counters.items()}
+
+    async def render(self) -> str:
+        await self._read_stock()
+        self.renders += 1
+        text = "📟 **Live Dashboard**\n\n📦 **Stock** (available / reserved)\n"
+        if not self._stock:
+            text += "• no accounts\n"
+        for cc, counts in sorted(self._stock.items()):
+            text += (f"• {country_flag(cc)} {cc}: {counts.get('available', 0)} / "
+                     f"{counts.get('reserved', 0)}\n")
+
+        self._trim_sales()
+        revenue = sum(price for _, price in self._sales)
+        text += (f"\n💰 **Last hour**: {len(self._sales)} sale(s), "
+                 f"₹{round(revenue, 2)}\n")
+        text += f"📡 **OTP monitors**: {MONITORS.count(self.tenant)} running\n"
+
+        cap = CAPACITY.stats()
+        outbound = OUTBOUND.stats()
+        writer = getattr(self.tenant.repo, "writer", None)
+        text += (f"\n🚥 **Queues**\n"
+                 f"• Telethon: {cap['in_use']}/{cap['capacity']} in use, "
+                 f"{cap['depth']} waiting\n"
+                 "• outbound: " + ", ".join(
+                     f"{c['name']} {c['depth']}" for c in outbound["classes"]) +
+                 "\n")
+        if writer is not None:
+            text += f"• writes: {writer.stats()['queued']} queued\n"
+        p99 = WATCHDOG.percentile(0.99)
+        text += (f"• event loop lag p99: "
+                 f"{f'≤{p99}' if p99 is not None else f'>{LAG_BUCKETS_MS[-1]}'} ms, "
+                 f"{WATCHDOG.stalls} stall(s)\n")
+
+        errors = self._error_rates()
+        text += (f"\n⚠️ **Errors, last {DASHBOARD_ERROR_WINDOW // 60} min**\n"
+                 f"• Telethon failures {errors['telethon']} "
+                 f"({errors['flood']} FloodWait), "
+                 f"{BREAKERS.stats()['open']} breakers open\n"
+                 f"• RetryAfter {errors['retry_after']} | failed writes "
+                 f"{errors['writes']} | shed {errors['shed']} | "
+                 f"throttled {errors['throttled']}\n")
+        return text
+
+    async def add(self, chat_id: int):
+        """Send and pin a dashboard in the chat, replacing one already there."""
+        bot = self.tenant.app.bot
+        if chat_id in self.messages:
+            await self.remove(chat_id)
+        text = await self.render()
+        msg = await bot.send_message(chat_id,
+                                     self._stamped(text),
+                                     parse_mode="Markdown",
+                                     rate_limit_args={"priority": PRIORITY_ADMIN})
+        try:
+            await bot.pin_chat_message(chat_id,
+                                       msg.message_id,
+                                       disable_notification=True)
+        except Exception as e:
+            logger.warning("Could not pin the dashboard in %s: %s", chat_id, e)
+        self.messages[chat_id] = msg.message_id
+        # the new message starts from the current text; the others catch up on the next tick
+        self._last_text = None
+        await self._save()
+        self._ensure_running()
+
+    async def remove(self, chat_id: int) -> bool:
+        message_id = self.messages.pop(chat_id, None)
+        if message_id is None:
+            return False
+        try:
+            await self.tenant.app.bot.unpin_chat_message(chat_id, message_id)
+        except Exception as e:
+            logger.info("Could not unpin the dashboard in %s: %s", chat_id, e)
+        await self._save()
+        return True
+
+    async def restore(self):
+        """Pick up the dashboards pinned before a restart."""
+        raw = await REPO.get_setting(DASHBOARD_SETTING)
+        if raw:
+            self.messages = {int(c): m for c, m in json.loads(raw).items()}
+            self._ensure_running()
+
+    async def _save(self):
+        await REPO.set_setting(DASHBOARD_SETTING, json.dumps(self.messages))
+
+    @staticmethod
+    def _stamped(text: str) -> str:
+        return f"{text}\n_Updated {datetime.now(IST).strftime('%H:%M:%S')}_"
+
+    def _ensure_running(self):
+        if self.messages and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        with use_tenant(self.tenant):
+            while self.messages:
+                await asyncio.sleep(self.interval)
+                try:
+                    await self._refresh()
+                except Exception:
+                    logger.exception("Dashboard refresh failed")
+
+    async def _refresh(self):
+        text = await self.render()
+        if text == self._last_text:
+            self.unchanged += 1
+            return
+        self._last_text = text
+        stamped = self._stamped(text)
+        gone = []
+        for chat_id, message_id in list(self.messages.items()):
+            try:
+                await self.tenant.app.bot.edit_message_text(
+                    stamped,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    parse_mode="Markdown",
+                    rate_limit_args={"priority": PRIORITY_ADMIN})
+                self.edits += 1
+            except BadRequest as e:
+                if "not modified" in str(e):
+                    continue
+                # deleted by the admin, or the chat is gone
+                logger.info("Dropping dashboard in %s: %s", chat_id, e)
+                gone.append(chat_id)
+            except Exception as e:
+                logger.warning("Dashboard edit in %s failed: %s", chat_id, e)
+        if gone:
+            for chat_id in gone:
+                self.messages.pop(chat_id, None)
+            await self._save()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+def stock_changed():
+    """Mark the dashboard's cached stock of the current tenant stale."""
+    dashboard = current_tenant().dashboard
+    if dashboard is not None:
+        dashboard.stock_changed()
+
+
 # ---------- Admin commands (complete) ----------
 @admin_only
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT status, COUNT(*) FROM accounts GROUP BY status")
-        status_rows = await cur.fetchall()
-        cur = await db.execute(
-            "SELECT country_code, status, COUNT(*) FROM accounts GROUP BY country_code, status ORDER BY country_code, status"
-        )
-        country_rows = await cur.fetchall()
-        cur = await db.execute("SELECT COUNT(*) FROM users")
-        user_count = (await cur.fetchone())[0]
-        cur = await db.execute(
-            "SELECT SUM(amount) FROM transactions WHERE type='purchase'")
-        revenue = (await cur.fetchone())[0] or 0
+    status_rows = await REPO.account_status_counts()
+    country_rows = await REPO.country_status_counts()
+    user_count = await REPO.count_users()
+    revenue = await REPO.total_revenue()
+    # /clearstats restarts the revenue counter without deleting history
+    base = float(await REPO.get_setting("stats_revenue_base") or 0)
+    reset_at = await REPO.get_setting("stats_reset_at")
     text = "📊 **Bot Statistics**\n\n"
-    text += f"👥 **Total Users:** {user_count}\n💰 **Total Revenue:** ₹{revenue}\n\n**Account Status:**\n"
+    text += f"👥 **Total Users:** {user_count}\n💰 **Total Revenue:** ₹{round(revenue - base, 2)}\n"
+    if reset_at:
+        text += f"_(since {reset_at[:16].replace('T', ' ')}; all-time ₹{round(revenue, 2)})_\n"
+    text += "\n**Account Status:**\n"
     for status, count in status_rows:
         text += f"• {status.title()}: {count}\n"
     text += "\n**Country-wise:**\n"
@@ -1233,11 +6114,7 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @admin_only
 async def cmd_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT id, country_code, phone_number, status, price FROM accounts ORDER BY status, country_code"
-        )
-        rows = await cur.fetchall()
+    rows = await REPO.list_accounts()
     if not rows:
         if update.callback_query:
             kb = [[InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_panel")]]
@@ -1257,12 +6134,13 @@ async def cmd_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(res, parse_mode="Markdown")
 
 
-_owner_escaped = CONFIG['OWNER_HANDLE'].replace('_', '\\_')
-FOOTER = f"\n\n{CONFIG['DEVELOPER_CREDITS']} • @{_owner_escaped}"
+def footer() -> str:
+    owner_escaped = tenant_config('OWNER_HANDLE').replace('_', '\\_')
+    return f"\n\n{tenant_config('DEVELOPER_CREDITS')} • @{owner_escaped}"
 
 
 async def send_admin_reply(update: Update, text: str):
-    text_with_footer = f"{text}{FOOTER}"
+    text_with_footer = f"{text}{footer()}"
     if update.callback_query:
         try:
             await update.callback_query.edit_message_text(
@@ -1299,50 +6177,24 @@ async def cmd_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             await send_admin_reply(update, "Invalid amount.")
             return
-        user_id = None
-        if target.isdigit():
-            user_id = int(target)
-        else:
-            username = target.lstrip("@")
-            async with aiosqlite.connect(DB_PATH) as db:
-                cur = await db.execute("SELECT id FROM users WHERE username=?",
-                                       (username, ))
-                r = await cur.fetchone()
-                if r:
-                    user_id = r[0]
+        user_id = await USERNAMES.resolve(target)
         if not user_id:
             await send_admin_reply(update, f"User not found: {target}")
             return
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE users SET balance=? WHERE id=?",
-                             (amt, user_id))
-            await db.commit()
-            cur = await db.execute("SELECT balance FROM users WHERE id=?",
-                                   (user_id, ))
-            new = (await cur.fetchone())[0]
+        new = await REPO.set_balance(user_id, amt)
+        if new is None:
+            await send_admin_reply(update, f"User not found: {target}")
+            return
         await send_admin_reply(update,
                                f"✅ Balance set for user {user_id}: ₹{new}")
         return
     # show balance
     target = args[0]
-    user_id = None
-    if target.isdigit():
-        user_id = int(target)
-    else:
-        username = target.lstrip("@")
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT id FROM users WHERE username=?",
-                                   (username, ))
-            r = await cur.fetchone()
-            if r: user_id = r[0]
+    user_id = await USERNAMES.resolve(target)
     if not user_id:
         await send_admin_reply(update, f"User not found: {target}")
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT balance FROM users WHERE id=?",
-                               (user_id, ))
-        row = await cur.fetchone()
-        bal = (row[0] if row else 0.0)
+    bal = await REPO.get_balance(user_id) or 0.0
     await send_admin_reply(update, f"💳 Balance for user {user_id}: ₹{bal}")
 
 
@@ -1353,23 +6205,42 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_admin_reply(update, "Usage: /broadcast <message>")
         return
     msg = " ".join(args)
+    user_ids = await REPO.list_user_ids()
+    await send_admin_reply(
+        update, f"📣 Broadcasting to {len(user_ids)} users in the background...")
+    # runs as a task at the lowest priority: OTPs and purchase UI are sent first
+    context.application.create_task(
+        run_broadcast(context.bot, update.effective_chat.id, user_ids,
+                      f"{msg}{footer()}"))
+
+
+async def run_broadcast(bot, admin_chat_id: int, user_ids: List[int],
+                        text: str):
     sent = 0
     failed = 0
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id FROM users")
-        rows = await cur.fetchall()
-    user_ids = [r[0] for r in rows]
-    for uid in user_ids:
+
+    async def _send(uid: int):
+        nonlocal sent, failed
         try:
-            await context.bot.send_message(uid,
-                                           f"{msg}{FOOTER}",
-                                           parse_mode="Markdown")
+            await bot.send_message(
+                uid,
+                text,
+                parse_mode="Markdown",
+                rate_limit_args={"priority": PRIORITY_BROADCAST})
             sent += 1
-            await asyncio.sleep(0.05)
         except Exception:
             failed += 1
-    await send_admin_reply(update,
-                           f"Broadcast done. Sent: {sent}, Failed: {failed}")
+
+    # a batch at a time keeps the queue (and memory) bounded for large user lists
+    for i in range(0, len(user_ids), 100):
+        await asyncio.gather(*(_send(uid) for uid in user_ids[i:i + 100]))
+    try:
+        await bot.send_message(
+            admin_chat_id,
+            f"Broadcast done. Sent: {sent}, Failed: {failed}",
+            rate_limit_args={"priority": PRIORITY_ADMIN})
+    except Exception as e:
+        logger.warning("Failed to report broadcast result: %s", e)
 
 
 @admin_only
@@ -1378,23 +6249,11 @@ async def cmd_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /ban <username_or_userid>")
         return
     target = context.args[0]
-    user_id = None
-    if target.isdigit():
-        user_id = int(target)
-    else:
-        username = target.lstrip("@")
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT id FROM users WHERE username=?",
-                                   (username, ))
-            r = await cur.fetchone()
-            if r: user_id = r[0]
+    user_id = await USERNAMES.resolve(target)
     if not user_id:
         await update.message.reply_text("User not found.")
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO bans (user_id, reason) VALUES (?, ?)",
-                         (user_id, "Admin ban"))
-        await db.commit()
+    await REPO.ban(user_id, "Admin ban")
     await update.message.reply_text(f"✅ User {target} banned.")
 
 
@@ -1404,21 +6263,11 @@ async def cmd_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /unban <username_or_userid>")
         return
     target = context.args[0]
-    user_id = None
-    if target.isdigit(): user_id = int(target)
-    else:
-        username = target.lstrip("@")
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT id FROM users WHERE username=?",
-                                   (username, ))
-            r = await cur.fetchone()
-            if r: user_id = r[0]
+    user_id = await USERNAMES.resolve(target)
     if not user_id:
         await update.message.reply_text("User not found.")
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM bans WHERE user_id=?", (user_id, ))
-        await db.commit()
+    await REPO.unban(user_id)
     await update.message.reply_text(f"✅ User {target} unbanned.")
 
 
@@ -1434,28 +6283,14 @@ async def cmd_addcoins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         await update.message.reply_text("Invalid amount.")
         return
-    user_id = None
-    if target.isdigit(): user_id = int(target)
-    else:
-        username = target.lstrip("@")
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT id FROM users WHERE username=?",
-                                   (username, ))
-            r = await cur.fetchone()
-            if r: user_id = r[0]
+    user_id = await USERNAMES.resolve(target)
     if not user_id:
         await update.message.reply_text("User not found.")
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET balance = balance + ? WHERE id=?",
-                         (amount, user_id))
-        await db.execute(
-            "INSERT INTO transactions (user_id, amount, type) VALUES (?, ?, 'admin_topup')",
-            (user_id, amount))
-        await db.commit()
-        cur = await db.execute("SELECT balance FROM users WHERE id=?",
-                               (user_id, ))
-        new = (await cur.fetchone())[0]
+    ok, new = await REPO.adjust_balance(user_id, amount, "admin_topup")
+    if not ok:
+        await update.message.reply_text("User not found.")
+        return
     await update.message.reply_text(
         f"✅ Added ₹{amount} to user {target}\nNew balance: ₹{new}")
 
@@ -1472,93 +6307,591 @@ async def cmd_deductcoin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         await update.message.reply_text("Invalid amount.")
         return
-    user_id = None
-    if target.isdigit(): user_id = int(target)
-    else:
-        username = target.lstrip("@")
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT id FROM users WHERE username=?",
-                                   (username, ))
-            r = await cur.fetchone()
-            if r: user_id = r[0]
+    user_id = await USERNAMES.resolve(target)
     if not user_id:
         await update.message.reply_text("User not found.")
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT balance FROM users WHERE id=?",
-                               (user_id, ))
-        current = (await cur.fetchone())[0]
-        if current < amount:
+    ok, new = await REPO.adjust_balance(user_id, -amount, "admin_deduction")
+    if not ok:
+        if new is None:
+            await update.message.reply_text("User not found.")
+        else:
             await update.message.reply_text(
-                f"User has only ₹{current}, cannot deduct ₹{amount}.")
-            return
-        await db.execute("UPDATE users SET balance = balance - ? WHERE id=?",
-                         (amount, user_id))
-        await db.execute(
-            "INSERT INTO transactions (user_id, amount, type) VALUES (?, ?, 'admin_deduction')",
-            (user_id, -amount))
-        await db.commit()
-        cur = await db.execute("SELECT balance FROM users WHERE id=?",
-                               (user_id, ))
-        new = (await cur.fetchone())[0]
+                f"User has only ₹{new}, cannot deduct ₹{amount}.")
+        return
     await update.message.reply_text(
         f"✅ Deducted ₹{amount} from {target}\nNew balance: ₹{new}")
 
 
+@admin_only
+async def cmd_purchases(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """A user's purchases, newest first: /purchases <user> [before_id] (admin only)"""
+    if not context.args:
+        await send_admin_reply(update, "Usage: /purchases <user_id_or_username> [before_id]")
+        return
+    target = context.args[0]
+    user_id = await USERNAMES.resolve(target)
+    if not user_id:
+        await send_admin_reply(update, f"User not found: {target}")
+        return
+    before_id = None
+    if len(context.args) > 1 and context.args[1].isdigit():
+        before_id = int(context.args[1])
+    text, rows, has_more = await purchase_history_page(user_id, before_id)
+    if not rows:
+        await send_admin_reply(update, f"No purchases for user {user_id}.")
+        return
+    if has_more:
+        text += f"\nOlder: /purchases {user_id} {rows[-1][0]}\n"
+    await send_admin_reply(update, f"🧾 **Purchases of {user_id}**\n\n{text}")
+
+
+BULK_BALANCE_MAX_BYTES = 2 * 1024 * 1024
+BULK_USERNAME_RE = re.compile(r"^@?[A-Za-z0-9_]{3,32}$")
+BULK_HEADER_CELLS = {"user", "user_id", "userid", "id", "username", "target"}
+
+
+def parse_balance_rows(text: str):
+    """
+    Parse "user,amount[,note]" lines (comma, semicolon or tab separated; an
+    optional header row is skipped). Returns (rows, rejected): rows are dicts
+    with line/target/amount/note, rejected are (line, cells, reason).
+    """
+    lines = text.splitlines()
+    first = next((l for l in lines if l.strip()), "")
+    delimiter = "\t" if "\t" in first else (";" if ";" in first
+                                             and "," not in first else ",")
+    rows, rejected = [], []
+    for line_no, cells in enumerate(csv.reader(lines, delimiter=delimiter),
+                                    start=1):
+        cells = [c.strip() for c in cells]
+        if not any(cells) or cells[0].startswith("#"):
+            continue
+        if not rows and not rejected and cells[0].lower() in BULK_HEADER_CELLS:
+            continue
+        if len(cells) < 2:
+            rejected.append((line_no, cells, "missing amount"))
+            continue
+        target, amount = cells[0], cells[1]
+        note = ", ".join(cells[2:]).strip()[:200] or None
+        if not (target.isdigit() or BULK_USERNAME_RE.match(target)):
+            rejected.append((line_no, cells, "invalid user"))
+            continue
+        try:
+            amt = round(float(amount), 2)
+        except ValueError:
+            rejected.append((line_no, cells, "invalid amount"))
+            continue
+        if not math.isfinite(amt) or amt == 0:
+            rejected.append((line_no, cells, "invalid amount"))
+            continue
+        rows.append({
+            "line": line_no,
+            "target": target,
+            "amount": amt,
+            "note": note
+        })
+    return rows, rejected
+
+
+@admin_only
+async def cmd_bulkbalance(update: Update,
+                          context: ContextTypes.DEFAULT_TYPE):
+    """
+    Apply a CSV/TSV of balance changes (user id or @username, amount, note).
+    Send the file with /bulkbalance as its caption, or reply /bulkbalance to it.
+    Usernames are resolved in one query and every row commits in one transaction.
+    """
+    msg = update.message
+    doc = msg.document or (msg.reply_to_message.document
+                           if msg.reply_to_message else None)
+    if doc is None:
+        await send_admin_reply(
+            update, "Usage: send a CSV/TSV with caption /bulkbalance, or reply "
+            "/bulkbalance to one.\nColumns: user id or @username, amount "
+            "(negative to deduct), optional note.")
+        return
+    if doc.file_size and doc.file_size > BULK_BALANCE_MAX_BYTES:
+        await send_admin_reply(update, "File too large (max 2 MB).")
+        return
+    tg_file = await doc.get_file()
+    data = bytes(await tg_file.download_as_bytearray())
+    rows, rejected = parse_balance_rows(data.decode("utf-8-sig",
+                                                    errors="replace"))
+    if len(rows) + len(rejected) > CONFIG["BULK_BALANCE_MAX_ROWS"]:
+        await send_admin_reply(
+            update,
+            f"Too many rows (max {CONFIG['BULK_BALANCE_MAX_ROWS']}). Split the file."
+        )
+        return
+
+    names = [r["target"].lstrip("@") for r in rows if not r["target"].isdigit()]
+    found = await REPO.find_user_ids(names) if names else {}
+    for name, uid in found.items():
+        USERNAMES.remember(uid, name)
+    batch, pending = [], []
+    for r in rows:
+        if r["target"].isdigit():
+            r["user_id"] = int(r["target"])
+        else:
+            r["user_id"] = found.get(r["target"].lstrip("@").lower())
+        if r["user_id"] is None:
+            rejected.append((r["line"], [r["target"], str(r["amount"])],
+                             "unknown user"))
+            continue
+        tx_type = "admin_topup" if r["amount"] > 0 else "admin_deduction"
+        batch.append((r["user_id"], r["amount"], tx_type, r["note"]))
+        pending.append(r)
+    results = await REPO.apply_balance_batch(batch) if batch else []
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["line", "user", "user_id", "amount", "note", "status",
+                     "detail"])
+    report, applied, net = [], 0, 0.0
+    for r, (ok, balance) in zip(pending, results):
+        if ok:
+            applied += 1
+            net += r["amount"]
+            report.append((r["line"], [r["target"], r["user_id"], r["amount"],
+                                       r["note"] or "", "applied",
+                                       f"balance {balance:.2f}"]))
+        else:
+            reason = ("unknown user" if balance is None else
+                      f"insufficient balance ({balance:.2f})")
+            report.append((r["line"], [r["target"], r["user_id"], r["amount"],
+                                       r["note"] or "", "rejected", reason]))
+    for line_no, cells, reason in rejected:
+        cells = cells + [""] * 3
+        report.append((line_no, [cells[0], "", cells[1], cells[2], "rejected",
+                                 reason]))
+    for line_no, cells in sorted(report, key=lambda x: x[0]):
+        writer.writerow([line_no] + cells)
+
+    summary = (f"✅ Bulk balance: {applied} applied (net ₹{net:.2f}), "
+               f"{len(report) - applied} rejected.")
+    await msg.reply_document(document=io.BytesIO(out.getvalue().encode()),
+                             filename="bulk_balance_result.csv",
+                             caption=summary)
+    logger.info("Bulk balance by %s: %d applied, %d rejected, net %.2f",
+                update.effective_user.id, applied, len(report) - applied, net)
+
+
 @admin_only
 async def cmd_clearstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Clear all transaction records and sales statistics (admin only)"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Get count before deletion
-        cur = await db.execute("SELECT COUNT(*) FROM transactions")
-        count = (await cur.fetchone())[0]
-        
-        # Delete all transactions
-        await db.execute("DELETE FROM transactions")
-        await db.commit()
-    
+    """Reset sales statistics; transactions are archived, not deleted (admin only)"""
+    revenue = await REPO.total_revenue()
+    await REPO.set_setting("stats_revenue_base", repr(float(revenue)))
+    await REPO.set_setting("stats_reset_at", now_iso())
+    chat_id = update.effective_chat.id
+
+    async def _run():
+        try:
+            count = await archive_transactions(archive_cutoff(0))
+        except Exception as e:
+            logger.exception("Archiving on /clearstats failed")
+            await context.bot.send_message(chat_id, f"❌ Archiving failed: {e}")
+            return
+        await context.bot.send_message(
+            chat_id, f"📦 Archived {count} transaction records.")
+
+    context.application.create_task(_run())
     await send_admin_reply(
         update,
-        f"🗑️ **Statistics Cleared**\n\n✅ Deleted {count} transaction records\n💰 Revenue stats reset to zero\n\n_Note: User balances and accounts remain unchanged._"
+        "🗑️ **Statistics Cleared**\n\n💰 Revenue stats reset to zero\n📦 Transaction records are being moved to the archive (see /archive; all-time totals are kept)\n\n_Note: User balances and accounts remain unchanged._"
     )
 
 
-# ---------- Message handler: coordinate flows ----------
-async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """
-    Central message handler. Order here is important:
-      1) If admin has a server-side pending upload waiting_2fa -> handle 2FA input.
-      2) If admin has a post-OTP 'choice' stage -> handle that.
-      3) If admin has pending upload waiting_otp -> handle OTP input (normalize).
-      4) If admin is in interactive phone step (upload_step == 'phone') -> handle phone.
-      5) Otherwise fallback.
-    """
-    uid = update.effective_user.id
-    txt = (update.message.text or "").strip()
+ARCHIVE_USAGE = ("Usage: /archive | /archive run [days] | "
+                 "/archive find <user_id|CC> [YYYY-MM]")
+
+
+@admin_only
+async def cmd_archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Transaction archive status, manual runs and lookups (admin only)"""
+    args = context.args or []
+    chat_id = update.effective_chat.id
+    if not args:
+        live, archived = await REPO.transaction_counts()
+
+        def _files():
+            files = archive_files()
+            return len(files), sum(os.path.getsize(f) for f in files)
+
+        nfiles, size = await asyncio.to_thread(_files)
+        s = current_tenant().archive_stats
+        text = (f"📦 **Transaction Archive**\n\n"
+                f"• Live rows: {live}\n• Archived rows: {archived}\n"
+                f"• Files: {nfiles} ({size / 1024 / 1024:.1f} MB) in `{CONFIG['ARCHIVE_DIR']}`\n"
+                f"• Retention: {CONFIG['ARCHIVE_AFTER_DAYS']} days\n"
+                f"• Runs: {s['runs']}, archived this process: {s['archived']}\n"
+                f"• Last run: {s['last_run'] or 'never'}\n")
+        if s["last_error"]:
+            text += f"• Last error: {s['last_error']}\n"
+        await send_admin_reply(update, text)
+        return
+    if args[0] == "run":
+        try:
+            days = float(args[1]) if len(args) > 1 else CONFIG["ARCHIVE_AFTER_DAYS"]
+        except ValueError:
+            await send_admin_reply(update, ARCHIVE_USAGE)
+            return
+        if days < 0:
+            await send_admin_reply(update, ARCHIVE_USAGE)
+            return
 
-    # 1) authoritative server-side waiting_2fa (finish Telethon sign_in)
-    pending = PENDING_UPLOADS.get(uid)
-    if pending and pending.get("step") == "waiting_2fa":
-        # forward to our 2FA handler
-        await handle_2fa_password_input(update, context)
+        async def _run():
+            try:
+                count = await archive_transactions(archive_cutoff(days))
+            except Exception as e:
+                logger.exception("Manual archival failed")
+                await context.bot.send_message(chat_id, f"❌ Archiving failed: {e}")
+                return
+            await context.bot.send_message(
+                chat_id, f"📦 Archived {count} transactions older than {days:g} days.")
+
+        context.application.create_task(_run())
+        await send_admin_reply(update, f"📦 Archiving transactions older than {days:g} days in the background...")
+        return
+    if args[0] == "find" and len(args) >= 2:
+        target = args[1]
+        month = args[2] if len(args) > 2 else None
+        if month and not re.fullmatch(r"\d{4}-\d{2}", month):
+            await send_admin_reply(update, ARCHIVE_USAGE)
+            return
+        if target.isdigit():
+            field, value = "user_id", int(target)
+        elif re.fullmatch(r"[A-Za-z]{2}", target):
+            field, value = "country_code", target.upper()
+        else:
+            await send_admin_reply(update, ARCHIVE_USAGE)
+            return
+        matches = await asyncio.to_thread(search_archive, field, value, month)
+        if not matches:
+            await send_admin_reply(update, f"No archived transactions for {value}.")
+            return
+        total = sum(m.get("amount") or 0 for m in matches)
+        data = await asyncio.to_thread(
+            gzip.compress,
+            "".join(json.dumps(m, ensure_ascii=False) + "\n"
+                    for m in matches).encode())
+        await update.message.reply_document(
+            document=io.BytesIO(data),
+            filename=f"archive_{value}{'_' + month if month else ''}.ndjson.gz",
+            caption=f"📦 {len(matches)} archived transactions for {value}, total ₹{round(total, 2)}")
+        return
+    await send_admin_reply(update, ARCHIVE_USAGE)
+
+
+@admin_only
+async def cmd_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Take a snapshot and run SQLite maintenance now, or list snapshots (admin only)"""
+    if not sqlite_backed():
+        await send_admin_reply(update, f"💾 {POSTGRES_BACKUP_NOTE}")
+        return
+    if context.args and context.args[0] == "list":
+
+        def _list():
+            return [(os.path.basename(f), os.path.getsize(f))
+                    for f in backup_files()]
+
+        files = await asyncio.to_thread(_list)
+        if not files:
+            await send_admin_reply(update, "💾 No snapshots yet.")
+            return
+        text = f"💾 **Snapshots** in `{CONFIG['BACKUP_DIR']}`\n\n"
+        for name, size in files:
+            text += f"• `{name}` ({size / 1024 / 1024:.1f} MB)\n"
+        await send_admin_reply(update, text)
+        return
+    convert = bool(context.args) and context.args[0] == "vacuum"
+    if BACKUP_LOCK.locked():
+        await send_admin_reply(update, "⏳ A backup is already running.")
+        return
+    chat_id = update.effective_chat.id
+    await send_admin_reply(
+        update, "💾 Backup and maintenance started in the background..." +
+        ("\nThe database is rebuilt for incremental vacuum; writes wait until it is done."
+         if convert else ""))
+
+    async def _run():
+        await backup_and_maintain(convert=convert)
+        await context.bot.send_message(chat_id,
+                                       maintenance_report_text(),
+                                       parse_mode="Markdown")
+
+    context.application.create_task(_run())
+
+
+@admin_only
+async def cmd_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runtime counters (admin only)"""
+    text = "📈 **Runtime Metrics**\n\n"
+    text += flood_metrics_text()
+    text += f"\n📡 **OTP monitors**: {len(MONITORS)} running\n"
+    text += "\n" + loop_lag_metrics_text()
+    text += "\n" + capacity_metrics_text()
+    text += "\n" + breaker_metrics_text()
+    text += "\n" + outbound_metrics_text()
+    text += "\n" + storage_metrics_text()
+    text += "\n" + user_state_metrics_text()
+    text += "\n" + waitlist_metrics_text()
+    text += "\n" + otp_workers_metrics_text()
+    text += "\n" + sweep_report_text(current_tenant().sweep_report)
+    text += "\n" + maintenance_report_text()
+    await send_admin_reply(update, text)
+
+
+@admin_only
+async def cmd_dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pin a live dashboard in this chat; /dashboard off removes it (admin only)"""
+    dashboard = current_tenant().dashboard
+    chat_id = update.effective_chat.id
+    if context.args and context.args[0].lower() == "off":
+        removed = await dashboard.remove(chat_id)
+        await send_admin_reply(
+            update, "📟 Dashboard removed." if removed else "No dashboard is pinned here.")
         return
+    await dashboard.add(chat_id)
 
-    # 2) post-OTP choice stage (save 2FA / skip / cancel)
-    if context.user_data.get('upload_after_otp_waiting_choice'):
-        await handle_2fa_password_input(update, context)
+
+def tenant_usage_text(tenant: Tenant) -> str:
+    u = tenant.usage
+    name = tenant.name.replace("_", "\\_")
+    text = (f"• **{name}** (bot {tenant.bot_key}): {u['updates']} updates, "
+            f"{u['throttled']} throttled | sent {OUTBOUND.sent_by_bot.get(tenant.bot_key, 0)} | "
+            f"monitors {MONITORS.count(tenant)}, "
+            f"{u['telethon_seconds'] / 60:.0f} Telethon min")
+    writer = getattr(tenant.repo, "writer", None)
+    if writer is not None:
+        s = writer.stats()
+        text += f" | {s['ops']} writes in {s['commits']} commits"
+    return text + "\n"
+
+
+@admin_only
+async def cmd_tenants(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Per-tenant use of the shared resources; operators (ADMIN_IDS) see every bot (admin only)"""
+    operator = update.effective_user.id in CONFIG["ADMIN_IDS"]
+    tenants = TENANTS if operator else [current_tenant()]
+    text = f"🏢 **Tenants**: {len(TENANTS)} bot(s) in this process\n\n"
+    text += "".join(tenant_usage_text(t) for t in tenants)
+    await send_admin_reply(update, text)
+
+
+@admin_only
+async def cmd_migratesessions(update: Update,
+                              context: ContextTypes.DEFAULT_TYPE):
+    """Import legacy .session files into the sessions table (admin only)"""
+    if not use_db_sessions():
+        await send_admin_reply(
+            update, "SESSION\\_BACKEND is 'file'; nothing to migrate.")
+        return
+    report = await migrate_session_files()
+    await send_admin_reply(
+        update, f"🗂️ **Session Migration**\n\n"
+        f"✅ Migrated: {report['migrated']}\n"
+        f"⏭️ Already stored: {report['skipped']}\n"
+        f"⚠️ Unreadable/unauthorized: {report['failed']}")
+
+
+@admin_only
+async def cmd_sweep(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Run a session health sweep now and report (admin only)"""
+    if SWEEP_LOCK.locked():
+        await send_admin_reply(update, "⏳ A sweep is already running.")
+        return
+    await send_admin_reply(update, "🩺 Sweeping available sessions...")
+    report = await sweep_sessions_tick()
+    await send_admin_reply(update, sweep_report_text(report))
+
+
+@admin_only
+async def cmd_breakers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Open circuit breakers and cooling accounts (admin only)"""
+    text = breaker_metrics_text() + "\n"
+    rows = BREAKERS.snapshot()[:20]
+    if rows:
+        text += "**Sessions**\n"
+        for r in rows:
+            state = (f"open {format_wait(r['remaining'])}"
+                     if r["remaining"] else "closed")
+            error = (r["last_error"] or "").replace("_", "\\_")[:80]
+            text += (f"• `{r['session']}`: {state} | {r['failures']} fail, "
+                     f"{r['flood_waits']} flood | {error}\n")
+    cooling = await REPO.cooling_accounts()
+    if cooling:
+        text += f"\n**Cooling accounts** ({len(cooling)})\n"
+        for acc_id, cc, phone, until in cooling[:20]:
+            text += f"• #{acc_id} {cc} {phone} until {until[:19]}\n"
+    if not rows and not cooling:
+        text += "No session is failing or cooling down."
+    await send_admin_reply(update, text)
+
+
+@admin_only
+async def cmd_monitors(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """In-flight OTP monitors and their age (admin only)"""
+    monitors = MONITORS.snapshot()
+    if not monitors:
+        await send_admin_reply(update, "📡 No OTP monitors running.")
+        return
+    text = f"📡 **OTP Monitors** ({len(monitors)} running)\n\n{capacity_metrics_text()}\n"
+    for m in monitors[:100]:
+        age = int(m["age"])
+        text += f"• Acc {m['acc_id']} | user {m['user_id']} | {age // 60}m {age % 60:02d}s\n"
+    if len(monitors) > 100:
+        text += f"… and {len(monitors) - 100} more\n"
+    await send_admin_reply(update, text)
+
+
+@admin_only
+async def cmd_latency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """OTP delivery latency percentiles per stage and country (admin only)"""
+    hours = 24.0
+    country = None
+    for arg in context.args or []:
+        try:
+            hours = float(arg)
+        except ValueError:
+            country = arg.upper()
+    if hours <= 0:
+        await send_admin_reply(update, "Usage: /latency [hours] [country code]")
+        return
+    report = await latency_report(hours, country)
+    if not report:
+        await send_admin_reply(
+            update, f"⏱️ No OTP deliveries traced in the last {hours:g}h.")
         return
+    text = f"⏱️ **OTP Latency** (last {hours:g}h, seconds: p50 / p95 / p99)\n"
+    groups = sorted(report, key=lambda g: (g != "ALL", g))
+    for group in groups[:21]:
+        flag = "" if group == "ALL" else country_flag(group) + " "
+        stages = report[group]
+        count = max(n for n, *_ in stages.values())
+        text += f"\n{flag}**{group}** ({count} delivered)\n"
+        for label, _, _ in LATENCY_STAGES:
+            if label in stages:
+                _, p50, p95, p99 = stages[label]
+                text += f"• {label}: {p50:.2f} / {p95:.2f} / {p99:.2f}\n"
+    if len(groups) > 21:
+        text += f"\n… and {len(groups) - 21} more countries (use /latency <hours> <CC>)\n"
+    await send_admin_reply(update, text)
+
+
+EXPORT_USAGE = ("Usage: /export transactions|accounts|users [from YYYY-MM-DD] "
+                "[to YYYY-MM-DD] [CC] [csv|ndjson]")
 
-    # 3) if admin has pending upload and step waiting_otp -> handle OTP (normalize)
-    if uid in PENDING_UPLOADS and PENDING_UPLOADS[uid].get(
-            "step") == "waiting_otp":
-        await handle_otp_code(update, context)
+
+@admin_only
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Export a table as gzip CSV/NDJSON documents, streamed in the background (admin only)"""
+    args = [a.lower() for a in context.args or []]
+    if not args or args[0] not in EXPORT_KINDS:
+        await send_admin_reply(update, EXPORT_USAGE)
+        return
+    kind, fmt, country = args[0], "csv", None
+    dates = {}
+    bound = "from"  # a bare date is a start date, a second one the end
+    for arg in args[1:]:
+        if arg in ("from", "to"):
+            bound = arg
+        elif arg in EXPORT_FORMATS:
+            fmt = arg
+        elif re.fullmatch(r"\d{4}-\d{2}-\d{2}", arg) and bound not in dates:
+            try:
+                dates[bound] = datetime.strptime(arg, "%Y-%m-%d").date()
+            except ValueError:
+                await send_admin_reply(update, EXPORT_USAGE)
+                return
+            bound = "to"
+        elif re.fullmatch(r"[a-z]{2}", arg):
+            country = arg.upper()
+        else:
+            await send_admin_reply(update, EXPORT_USAGE)
+            return
+    since = dates["from"].isoformat() if "from" in dates else None
+    # "to" is inclusive for the admin, exclusive in the query
+    until = (dates["to"] + timedelta(days=1)).isoformat() if "to" in dates else None
+    if EXPORT_LOCK.locked():
+        await send_admin_reply(update, "⏳ An export is already running, try again when it finishes.")
         return
+    chat_id = update.effective_chat.id
+    label = " ".join(p for p in (kind, since and f"from {since}",
+                                 until and f"to {dates['to']}", country, fmt)
+                     if p)
+    await send_admin_reply(update, f"📦 Exporting {label} in the background...")
+
+    async def _run():
+        async with EXPORT_LOCK:
+            directory = await asyncio.to_thread(tempfile.mkdtemp,
+                                                prefix="export_")
+            try:
+                started = time.monotonic()
+                parts = await write_export(kind, fmt, since, until, country,
+                                           directory,
+                                           CONFIG["EXPORT_PART_MB"] * 1024 * 1024)
+                rows = sum(p.rows for p in parts)
+                stamp = datetime.now().strftime("%Y%m%d_%H%M")
+                for i, part in enumerate(parts, start=1):
+                    suffix = f"_part{i}of{len(parts)}" if len(parts) > 1 else ""
+                    fh = await asyncio.to_thread(open, part.path, "rb")
+                    try:
+                        await context.bot.send_document(
+                            chat_id,
+                            document=fh,
+                            filename=f"{kind}_{stamp}{suffix}.{fmt}.gz",
+                            caption=f"📦 {label}: part {i}/{len(parts)}, {part.rows} rows",
+                            read_timeout=120,
+                            write_timeout=120)
+                    finally:
+                        fh.close()
+                logger.info("Export %s: %d rows in %d part(s), %.1fs", label,
+                            rows, len(parts), time.monotonic() - started)
+            except Exception as e:
+                logger.exception("Export %s failed", label)
+                await context.bot.send_message(chat_id, f"❌ Export failed: {e}")
+            finally:
+                await asyncio.to_thread(shutil.rmtree, directory, True)
+
+    context.application.create_task(_run())
+
+
+# ---------- Message handler: coordinate flows ----------
+UPLOAD_STEP_HANDLERS = {
+    "phone": handle_phone_number,
+    "otp": handle_otp_code,
+    "2fa": handle_2fa_password_input,
+    "note_2fa": handle_2fa_password_input,
+}
+
+
+async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Central message handler. Admin text belongs to an upload in progress: the one
+    whose prompt it replies to, otherwise the admin's most recent active upload.
+    It is dispatched on that upload's persisted state; anything else falls back.
+    """
+    uid = update.effective_user.id
+    txt = (update.message.text or "").strip()
 
-    # 4) phone entry step for admin upload
-    if uid in CONFIG["ADMIN_IDS"] and context.user_data.get(
-            'upload_step') == 'phone':
-        await handle_phone_number(update, context)
-        context.user_data.pop('upload_step', None)
+    upload = None
+    if uid in tenant_config("ADMIN_IDS"):
+        reply_to = update.message.reply_to_message
+        upload = await upload_for_message(
+            uid, reply_to.message_id if reply_to else None)
+    if upload:
+        if txt.lower() == "cancel":
+            try:
+                await cancel_upload(upload)
+            except ValueError:
+                await update.message.reply_text(
+                    f"✖️ Upload #{upload['id']} is no longer active.")
+                return
+            await update.message.reply_text(
+                f"✖️ Upload #{upload['id']} canceled and session removed.")
+            return
+        await UPLOAD_STEP_HANDLERS[upload["state"]](update, context, upload)
         return
 
     # default fallback
@@ -1576,12 +6909,16 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await buy_accounts_cb(update, context)
         elif data == "check_balance":
             await check_balance_cb(update, context)
+        elif data == "purchases" or data.startswith("purchases_"):
+            await purchases_cb(update, context)
         elif data == "main_menu":
             await show_main_menu_cb(update, context)
         elif data == "admin_panel":
             await admin_panel_cb(update, context)
         elif data.startswith("country_"):
             await country_cb(update, context)
+        elif data.startswith("notify_"):
+            await notify_me_cb(update, context)
         elif data.startswith("getotp_"):
             await get_otp_cb(update, context)
         elif data.startswith("done_"):
@@ -1590,6 +6927,8 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await admin_upload_cb(update, context)
         elif data.startswith("admin_country_"):
             await admin_country_cb(update, context)
+        elif data.startswith("upload_cancel_"):
+            await upload_cancel_cb(update, context)
         elif data == "admin_stats":
             await cmd_stats(update, context)
         elif data == "admin_accounts":
@@ -1611,20 +6950,182 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 
+# ---------- Event loop lag watchdog ----------
+LAG_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class LoopWatchdog:
+    """
+    Measures event loop lag: a task sleeps `interval` seconds at a time and
+    records how late it wakes up in a histogram. A thread watches the task's
+    heartbeat; when the loop has not come back for `threshold` seconds past
+    its wake-up, it captures the loop thread's current stack, i.e. the code
+    blocking the loop, and logs it once per stall.
+    """
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval = max(0.01, interval)
+        self.threshold = threshold
+        self.buckets = [0] * (len(LAG_BUCKETS_MS) + 1)  # last: above the largest
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.last_stall: Optional[Dict] = None
+        self._beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._measure())
+        self._thread = threading.Thread(target=self._watch,
+                                        name="loop-watchdog",
+                                        daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await asyncio.to_thread(self._thread.join, 1.0)
+        self._thread = None
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self._beat = time.monotonic()
+            self.record(max(0.0, loop.time() - started - self.interval))
+
+    def record(self, lag: float):
+        self.buckets[bisect.bisect_left(LAG_BUCKETS_MS, lag * 1000)] += 1
+        self.samples += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def _watch(self):
+        # a blocked loop thread still lets this thread run: C calls release the
+        # GIL, and Python code hands it over every switch interval
+        reported = None
+        while not self._stopping.wait(self.interval):
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            self.stalls += 1
+            self.last_stall = {
+                "at": now_iso(),
+                "blocked": blocked,
+                "where": self._attribute(stack),
+            }
+            logger.warning(
+                "Event loop blocked for %.0f ms so far, in %s. Loop thread stack:\n%s",
+                blocked * 1000, self.last_stall["where"],
+                "".join(traceback.format_list(stack)))
+
+    @staticmethod
+    def _attribute(stack) -> str:
+        """The innermost frame in this file (the bot's own blocking call), else the innermost one."""
+        ours = [f for f in stack if f.filename == __file__]
+        frame = (ours or list(stack))[-1]
+        return f"{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}"
+
+    def percentile(self, q: float) -> Optional[int]:
+        """Upper bound (ms) of the bucket holding the q-th lag quantile; None above the largest."""
+        if not self.samples:
+            return 0
+        target = q * self.samples
+        seen = 0
+        for bound, count in zip(LAG_BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+    def stats(self) -> Dict:
+        return {
+            "samples": self.samples,
+            "avg_ms": (self.total_lag / self.samples * 1000) if self.samples else 0.0,
+            "max_ms": self.max_lag * 1000,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "buckets": list(self.buckets),
+            "stalls": self.stalls,
+            "last_stall": self.last_stall,
+        }
+
+
+WATCHDOG = LoopWatchdog(CONFIG["LOOP_LAG_INTERVAL_MS"] / 1000,
+                        CONFIG["LOOP_LAG_THRESHOLD_MS"] / 1000)
+
+
+def enable_loop_debug():
+    """asyncio debug mode: logs every callback that holds the loop longer than LOOP_SLOW_CALLBACK_MS."""
+    loop = asyncio.get_running_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = CONFIG["LOOP_SLOW_CALLBACK_MS"] / 1000
+    logging.getLogger("asyncio").setLevel(logging.WARNING)
+    logger.warning("asyncio debug mode on: slow callbacks over %s ms are logged",
+                   CONFIG["LOOP_SLOW_CALLBACK_MS"])
+
+
+def loop_lag_metrics_text() -> str:
+    s = WATCHDOG.stats()
+
+    def bound(ms):
+        return f"{ms} ms" if ms is not None else f">{LAG_BUCKETS_MS[-1]} ms"
+
+    labels = [f"≤{b}" for b in LAG_BUCKETS_MS] + [f">{LAG_BUCKETS_MS[-1]}"]
+    text = (f"🐢 **Event loop lag**: avg {s['avg_ms']:.1f} ms, p50 {bound(s['p50'])}, "
+            f"p99 {bound(s['p99'])}, max {s['max_ms']:.0f} ms "
+            f"({s['samples']} samples) | stalls {s['stalls']}\n"
+            "• " + ", ".join(f"{label}: {n}" for label, n in zip(labels, s["buckets"])
+                             if n) + "\n")
+    stall = s["last_stall"]
+    if stall:
+        text += (f"• last stall {stall['blocked'] * 1000:.0f} ms at "
+                 f"{stall['at'][11:19]} in `{stall['where']}`\n")
+    return text
+
+
 # ---------- Main entrypoint ----------
-async def main():
-    await init_db()
+def build_application(tenant: Tenant):
     http_request = HTTPXRequest(
         connect_timeout=CONFIG["HTTP_CONNECT_TIMEOUT"],
         read_timeout=CONFIG["HTTP_READ_TIMEOUT"],
         write_timeout=CONFIG["HTTP_WRITE_TIMEOUT"],
         pool_timeout=CONFIG["HTTP_POOL_TIMEOUT"],
     )
-    global app
-    app = ApplicationBuilder().token(
-        CONFIG["BOT_TOKEN"]).request(http_request).build()
+    # every tenant's bot sends through the one shared OUTBOUND scheduler
+    persistence = make_user_state_persistence(tenant.repo)
+    app = ApplicationBuilder().token(tenant.config["BOT_TOKEN"]).request(
+        http_request).rate_limiter(OUTBOUND).persistence(persistence).build()
+    persistence.application = app
+    app.bot_data["tenant"] = tenant
+    tenant.app = app
+    tenant.dashboard = Dashboard(tenant, CONFIG["DASHBOARD_INTERVAL_SECONDS"])
 
     # Register handlers
+    # the tenant is bound first (group -2); flood control (group -1) stops throttled updates
+    app.add_handler(TypeHandler(Update, bind_tenant), group=-2)
+    app.add_handler(TypeHandler(Update, flood_guard), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(callback_router))
     app.add_handler(
@@ -1632,6 +7133,7 @@ async def main():
 
     # Admin commands (registered as commands too)
     app.add_handler(CommandHandler("upload", cmd_upload))
+    app.add_handler(CommandHandler("uploads", cmd_uploads))
     app.add_handler(CommandHandler("stats", cmd_stats))
     app.add_handler(CommandHandler("accounts", cmd_accounts))
     app.add_handler(CommandHandler("balance", cmd_balance))
@@ -1640,44 +7142,127 @@ async def main():
     app.add_handler(CommandHandler("unban", cmd_unban))
     app.add_handler(CommandHandler("addcoins", cmd_addcoins))
     app.add_handler(CommandHandler("deductcoin", cmd_deductcoin))
+    app.add_handler(CommandHandler("bulkbalance", cmd_bulkbalance))
+    app.add_handler(CommandHandler("purchases", cmd_purchases))
+    app.add_handler(CommandHandler("export", cmd_export))
+    app.add_handler(
+        MessageHandler(
+            filters.Document.ALL
+            & filters.CaptionRegex(r"^/bulkbalance(@\w+)?(\s|$)"),
+            cmd_bulkbalance))
     app.add_handler(CommandHandler("clearstats", cmd_clearstats))
+    app.add_handler(CommandHandler("archive", cmd_archive))
+    app.add_handler(CommandHandler("backup", cmd_backup))
+    app.add_handler(CommandHandler("metrics", cmd_metrics))
+    app.add_handler(CommandHandler("tenants", cmd_tenants))
+    app.add_handler(CommandHandler("dashboard", cmd_dashboard))
+    app.add_handler(CommandHandler("breakers", cmd_breakers))
+    app.add_handler(CommandHandler("migratesessions", cmd_migratesessions))
+    app.add_handler(CommandHandler("sweep", cmd_sweep))
+    app.add_handler(CommandHandler("monitors", cmd_monitors))
+    app.add_handler(CommandHandler("latency", cmd_latency))
+
+    return app
+
+
+async def main():
+    if CONFIG["LOOP_DEBUG"]:
+        enable_loop_debug()
+    WATCHDOG.start()
+    for tenant in TENANTS:
+        with use_tenant(tenant):
+            await asyncio.to_thread(os.makedirs, tenant.session_dir,
+                                    exist_ok=True)
+            await init_db()
+            await REPO.init()
+            await migrate_sessions_once()
+    await OTP_WORKERS.start()
+    apps = [build_application(tenant) for tenant in TENANTS]
 
     # Scheduler
     scheduler = AsyncIOScheduler(timezone=IST)
-    scheduler.add_job(release_expired_reservations_tick,
+    scheduler.add_job(for_each_tenant(release_expired_reservations_tick),
+                      "interval",
+                      minutes=1,
+                      coalesce=True,
+                      max_instances=1)
+    scheduler.add_job(for_each_tenant(expire_uploads_tick),
+                      "interval",
+                      minutes=1,
+                      coalesce=True,
+                      max_instances=1)
+    scheduler.add_job(for_each_tenant(evict_user_state_tick),
                       "interval",
                       minutes=1,
                       coalesce=True,
                       max_instances=1)
+    scheduler.add_job(for_each_tenant(sweep_sessions_tick),
+                      "interval",
+                      minutes=CONFIG["SWEEP_INTERVAL_MINUTES"],
+                      coalesce=True,
+                      max_instances=1,
+                      next_run_time=datetime.now(IST) + timedelta(minutes=2))
+    scheduler.add_job(for_each_tenant(prune_otp_traces_tick),
+                      "interval",
+                      hours=6,
+                      coalesce=True,
+                      max_instances=1)
+    if CONFIG["BACKUP_INTERVAL_HOURS"] > 0:
+        scheduler.add_job(for_each_tenant(backup_tick),
+                          "interval",
+                          hours=CONFIG["BACKUP_INTERVAL_HOURS"],
+                          coalesce=True,
+                          max_instances=1,
+                          next_run_time=datetime.now(IST) + timedelta(minutes=10))
+    scheduler.add_job(for_each_tenant(archive_transactions_tick),
+                      "interval",
+                      hours=6,
+                      coalesce=True,
+                      max_instances=1,
+                      next_run_time=datetime.now(IST) + timedelta(minutes=5))
     scheduler.start()
 
-    # Start bot
-    await app.initialize()
-    await app.start()
+    # Start bots
+    for tenant, app in zip(TENANTS, apps):
+        with use_tenant(tenant):
+            await app.initialize()
+            await app.start()
 
-    # Delete webhook to prevent conflicts with polling
-    try:
-        await app.bot.delete_webhook(drop_pending_updates=True)
-        logger.info("Webhook deleted successfully")
-    except Exception as e:
-        logger.warning("Failed to delete webhook: %s", e)
+            # Delete webhook to prevent conflicts with polling
+            try:
+                await app.bot.delete_webhook(drop_pending_updates=True)
+                logger.info("Webhook deleted successfully")
+            except Exception as e:
+                logger.warning("Failed to delete webhook: %s", e)
 
-    logger.info("Bot started")
-    await app.updater.start_polling()
+            await app.updater.start_polling()
+            await tenant.dashboard.restore()
+            logger.info("Bot started (tenant %s)", tenant.name)
 
     try:
         await asyncio.Future()
     except asyncio.CancelledError:
         pass
     finally:
-        try:
-            stop = getattr(app.updater, "stop", None)
-            if callable(stop):
-                await stop()
-        except Exception:
-            pass
-        await app.stop()
-        await app.shutdown()
+        for app in apps:
+            try:
+                stop = getattr(app.updater, "stop", None)
+                if callable(stop):
+                    await stop()
+            except Exception:
+                pass
+        await MONITORS.cancel_all()
+        for tenant in TENANTS:
+            await tenant.dashboard.stop()
+        await close_upload_clients()
+        await OTP_WORKERS.stop()
+        # stopping an application flushes its user_data, so repositories close last
+        for app in apps:
+            await app.stop()
+            await app.shutdown()
+        for tenant in TENANTS:
+            await tenant.repo.close()
+        await WATCHDOG.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,48 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py reads its configuration at import time; keep the tests off the real
+# database, session folder and token.
+_TMP = tempfile.mkdtemp(prefix="shop-tests-")
+os.environ.setdefault("BOT_TOKEN", "123:test")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "test")
+os.environ["DATABASE_PATH"] = os.path.join(_TMP, "shop.db")
+os.environ["SESSION_DIR"] = os.path.join(_TMP, "sessions")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def shop(tmp_path):
+    """
+    run(body, group_commit=True): await body(tenant) against a fresh SQLite
+    database, with the tenant current, on a new event loop.
+    """
+
+    def run(body, group_commit: bool = True):
+        path = str(tmp_path / "shop.db")
+        tenant = main.Tenant("test", 0, dict(main.TENANTS[0].config), path,
+                             None)
+        writer = (main.SqliteWriter(path, 64, 5, "normal")
+                  if group_commit else None)
+        tenant.repo = main.SqliteRepository(path, writer)
+
+        async def runner():
+            with main.use_tenant(tenant):
+                await main.init_db()
+                await tenant.repo.init()
+                try:
+                    return await body(tenant)
+                finally:
+                    await tenant.repo.close()
+
+        return asyncio.run(runner())
+
+    return run
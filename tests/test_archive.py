@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+import aiosqlite
+import pytest
+
+import main
+
+ADMIN = main.CONFIG["ADMIN_IDS"][0]
+
+
+@pytest.fixture(autouse=True)
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(main.CONFIG, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setitem(main.CONFIG, "ARCHIVE_BATCH", 2)
+
+
+async def _seed(tenant):
+    """Two old purchases, an old deposit and a recent purchase."""
+    repo = tenant.repo
+    us = await repo.add_account("US", "+15550001", "us.session", None, 1, 2.0)
+    gb = await repo.add_account("GB", "+44770001", "gb.session", None, 1, 3.0)
+    async with aiosqlite.connect(tenant.db_path) as db:
+        await db.executemany(
+            "INSERT INTO transactions (user_id, account_id, amount, type, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(7, us, 2.0, "purchase", "2026-01-05 10:00:00"),
+             (8, gb, 3.0, "purchase", "2026-01-05 11:00:00"),
+             (7, None, 10.0, "deposit", "2026-02-01 09:00:00"),
+             (8, us, 2.0, "purchase", main.archive_cutoff(0.01))])
+        await db.commit()
+
+
+def _admin_update(replies):
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    return SimpleNamespace(effective_user=SimpleNamespace(id=ADMIN),
+                           effective_chat=SimpleNamespace(id=ADMIN),
+                           callback_query=None,
+                           message=SimpleNamespace(reply_text=reply_text))
+
+
+def _context(tasks, sent):
+
+    async def send_message(chat_id, text, **kwargs):
+        sent.append(text)
+
+    return SimpleNamespace(
+        args=[],
+        bot=SimpleNamespace(send_message=send_message),
+        application=SimpleNamespace(
+            create_task=lambda coro: tasks.append(asyncio.create_task(coro))))
+
+
+def test_archiving_keeps_all_time_totals(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        await _seed(tenant)
+        revenue = await repo.total_revenue()
+        assert revenue == pytest.approx(7.0)
+        assert await main.archive_transactions("2026-03-01 00:00:00") == 3
+        assert await repo.transaction_counts() == (1, 3)
+        assert await repo.total_revenue() == pytest.approx(revenue)
+        async with aiosqlite.connect(tenant.db_path) as db:
+            cur = await db.execute(
+                "SELECT day, type, country_code, count, amount "
+                "FROM transaction_totals ORDER BY day, type, country_code")
+            totals = await cur.fetchall()
+        assert totals == [("2026-01-05", "purchase", "GB", 1, 3.0),
+                          ("2026-01-05", "purchase", "US", 1, 2.0),
+                          ("2026-02-01", "deposit", "", 1, 10.0)]
+        # the archive files hold the rows themselves
+        assert [r["amount"] for r in main.search_archive("user_id", 7, None)
+                ] == [2.0, 10.0]
+        assert main.search_archive("user_id", 7, "2026-02")[0]["type"] == \
+            "deposit"
+        assert await main.archive_transactions("2026-03-01 00:00:00") == 0
+
+    shop(body)
+
+
+def test_clearstats_archives_instead_of_deleting(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        await _seed(tenant)
+        replies, sent, tasks = [], [], []
+        await main.cmd_clearstats(_admin_update(replies),
+                                  _context(tasks, sent))
+        await asyncio.gather(*tasks)
+        assert sent == ["📦 Archived 4 transaction records."]
+        assert await repo.transaction_counts() == (0, 4)
+        assert await repo.total_revenue() == pytest.approx(7.0)
+        assert float(await repo.get_setting("stats_revenue_base")) == 7.0
+        await main.cmd_stats(_admin_update(replies), _context(tasks, sent))
+        assert "Total Revenue:** ₹0.0" in replies[-1]
+        assert "all-time ₹7.0" in replies[-1]
+
+    shop(body)
@@ -0,0 +1,85 @@
+import os
+import sqlite3
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def backup_dir(tmp_path, monkeypatch):
+    path = str(tmp_path / "backups")
+    monkeypatch.setitem(main.CONFIG, "BACKUP_DIR", path)
+    return path
+
+
+def test_snapshot_copies_in_steps(tmp_path):
+    src = str(tmp_path / "src.db")
+    db = sqlite3.connect(src)
+    db.execute("CREATE TABLE t (v TEXT)")
+    db.executemany("INSERT INTO t VALUES (?)", [("x" * 500, )] * 200)
+    db.commit()
+    db.close()
+    dst = str(tmp_path / "dst.db")
+    stats = main.snapshot_db(src, dst, 4, 0)
+    assert stats["check"] == "ok"
+    assert stats["steps"] > 1 and stats["restarts"] == 0
+    db = sqlite3.connect(dst)
+    assert db.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 200
+    db.close()
+
+
+def test_backup_and_maintain_reports_every_step(shop, backup_dir):
+
+    async def body(tenant):
+        await tenant.repo.get_or_create_user(7, "buyer")
+        report = await main.backup_and_maintain()
+        assert report["error"] is None
+        assert [name for name, _, _ in report["steps"]] == [
+            "backup", "rotate", "optimize", "checkpoint", "vacuum"]
+        [path] = main.backup_files()
+        assert os.path.dirname(path) == backup_dir
+        db = sqlite3.connect(path)
+        assert db.execute("SELECT username FROM users").fetchall() == [
+            ("buyer", )]
+        db.close()
+        report = await main.backup_and_maintain(backup=False)
+        assert report["steps"][0][0] == "optimize"
+
+    shop(body)
+
+
+def test_rotation_keeps_newest_and_one_per_day(shop, backup_dir,
+                                               monkeypatch):
+    monkeypatch.setitem(main.CONFIG, "BACKUP_KEEP", 2)
+    monkeypatch.setitem(main.CONFIG, "BACKUP_KEEP_DAILY", 3)
+    os.makedirs(backup_dir)
+    names = [f"shop_202601{day:02d}_{hour:02d}0000.db"
+             for day in (1, 2, 3, 4) for hour in (8, 20)]
+    for name in names:
+        open(os.path.join(backup_dir, name), "w").close()
+
+    async def body(tenant):
+        assert main.rotate_backups() == 4
+        kept = sorted(os.listdir(backup_dir))
+        # newest two, plus the newest of each of the last three days
+        assert kept == ["shop_20260102_200000.db", "shop_20260103_200000.db",
+                        "shop_20260104_080000.db", "shop_20260104_200000.db"]
+
+    shop(body)
+
+
+def test_postgres_tenants_are_not_snapshotted(shop, backup_dir):
+
+    async def body(tenant):
+        sqlite_repo = tenant.repo
+        tenant.repo = object()  # anything but SqliteRepository
+        try:
+            await main.backup_tick()
+            assert "PostgreSQL" in main.maintenance_report_text()
+        finally:
+            tenant.repo = sqlite_repo
+        assert tenant.maintenance_report["at"] is None
+        assert not os.path.exists(backup_dir)
+
+    shop(body)
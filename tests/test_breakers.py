@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+
+def breakers(**kwargs):
+    settings = dict(failures=2, base=10.0, max_backoff=40.0,
+                    global_failures=0, global_window=60.0,
+                    global_cooldown=100.0)
+    settings.update(kwargs)
+    return main.CircuitBreakers(**settings)
+
+
+def record(b, session="a.session", **kwargs):
+    return asyncio.run(b.record(session, "ConnectionError: boom", **kwargs))
+
+
+def test_opens_after_consecutive_failures_with_doubling_backoff(clock):
+    b = breakers()
+    assert record(b) == 0.0  # below the threshold
+    assert record(b) == pytest.approx(10.0)
+    assert b.hold_back("a.session") == pytest.approx(10.0)
+    assert b.remaining("b.session") == 0.0
+    clock.now += 10
+    # half-open: one attempt may go through; failing it reopens for longer
+    assert b.remaining("a.session") == 0.0
+    assert record(b) == pytest.approx(20.0)
+    clock.now += 20
+    assert record(b) == pytest.approx(40.0)
+    clock.now += 40
+    assert record(b) == pytest.approx(40.0)  # capped at max_backoff
+    assert (b.opened, b.held_back, b.failed) == (4, 1, 5)
+
+
+def test_success_closes_only_after_the_cooldown(clock):
+    b = breakers()
+    record(b)
+    record(b)
+    b.success("a.session")  # still open: kept
+    assert b.remaining("a.session") > 0
+    clock.now += 10
+    b.success("a.session")
+    assert record(b) == 0.0  # the failure count started over
+
+
+def test_flood_wait_opens_for_the_time_asked(clock):
+    b = breakers()
+    assert record(b, flood_wait=30) == pytest.approx(35.0)
+    assert b.flood_waits == 1
+
+
+def test_global_breaker_holds_back_every_session(clock):
+    b = breakers(failures=5, global_failures=3)
+    for session in ("a", "b"):
+        record(b, session)
+    clock.now += 61  # outside the window: forgotten
+    for session in ("c", "d", "e"):
+        record(b, session)
+    assert b.global_trips == 1
+    assert b.remaining("untouched") == pytest.approx(100.0)
+    clock.now += 100
+    assert b.remaining("untouched") == 0.0
+
+
+def test_cooldown_is_written_to_the_account(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        acc_id = await repo.add_account("US", "+15550000001", "a.session",
+                                        None, 1, 1.0)
+        b = breakers(failures=1)
+        remaining = await b.record("a.session", "ConnectionError: boom",
+                                   acc_id=acc_id)
+        assert remaining == pytest.approx(10.0, abs=1)
+        assert [r[0] for r in await repo.cooling_accounts()] == [acc_id]
+        assert await repo.claim_account("US", {"reserved_by": 5}) is None
+        await repo.set_account_cooldown(acc_id, None)
+        assert (await repo.claim_account("US", {"reserved_by": 5}))[0] == acc_id
+
+    shop(body, group_commit=False)
@@ -0,0 +1,71 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("text", [
+    "user,amount,note\n123,5,refund\n@alice,-2.5,\n",
+    "user;amount;note\n123;5;refund\n@alice;-2.5;\n",
+    "user\tamount\tnote\n123\t5\trefund\n@alice\t-2.5\t\n",
+])
+def test_delimiter_is_detected_and_header_skipped(text):
+    rows, rejected = main.parse_balance_rows(text)
+    assert rejected == []
+    assert [(r["line"], r["target"], r["amount"], r["note"])
+            for r in rows] == [(2, "123", 5.0, "refund"),
+                               (3, "@alice", -2.5, None)]
+
+
+def test_semicolons_inside_a_comma_file_stay_in_the_note():
+    rows, _ = main.parse_balance_rows('123,1,"a;b"\n')
+    assert rows[0]["note"] == "a;b"
+
+
+def test_header_only_counts_on_the_first_row():
+    # further down, "user" is just a username
+    rows, rejected = main.parse_balance_rows("123,1\nuser,2\n")
+    assert [r["target"] for r in rows] == ["123", "user"]
+    assert rejected == []
+
+
+def test_rejects_carry_their_line_and_reason():
+    text = ("# comment\n"
+            "\n"
+            "123\n"
+            "bad user!,5\n"
+            "123,abc\n"
+            "123,0\n"
+            "123,nan\n"
+            "123,1.005,note, with comma\n")
+    rows, rejected = main.parse_balance_rows(text)
+    assert [(line, reason) for line, _, reason in rejected] == [
+        (3, "missing amount"),
+        (4, "invalid user"),
+        (5, "invalid amount"),
+        (6, "invalid amount"),
+        (7, "invalid amount"),
+    ]
+    assert [(r["line"], r["amount"], r["note"]) for r in rows] == [
+        (8, 1.0, "note, with comma")
+    ]
+
+
+def test_batch_skips_an_insufficient_row(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        for user_id in (1, 2):
+            await repo.get_or_create_user(user_id, None)
+        await repo.set_balance(1, 5.0)
+        results = await repo.apply_balance_batch([
+            (1, 3.0, "deposit", "a"),
+            (2, -1.0, "admin_deduct", "b"),
+            (1, -7.0, "admin_deduct", "c"),
+            (99, 1.0, "deposit", "d"),
+        ])
+        assert results == [(True, 8.0), (False, 0.0), (True, 1.0),
+                           (False, None)]
+        assert await repo.get_balance(1) == pytest.approx(1.0)
+        assert await repo.get_balance(2) == pytest.approx(0.0)
+
+    shop(body)
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_waiters_are_admitted_in_fifo_order():
+
+    async def body():
+        gate = main.CapacityGate(2, shed_threshold=10)
+        order = []
+
+        async def worker(name, hold):
+            async with gate.hold():
+                order.append(name)
+                await hold.wait()
+
+        holds = {name: asyncio.Event() for name in "abcde"}
+        tasks = []
+        for name in "abcde":
+            tasks.append(asyncio.create_task(worker(name, holds[name])))
+            await asyncio.sleep(0)
+        assert order == ["a", "b"]
+        assert (gate.in_use, gate.depth) == (2, 3)
+        for name in "bacde":
+            holds[name].set()
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        assert order == list("abcde")
+        assert (gate.in_use, gate.depth) == (0, 0)
+        assert (gate.admitted, gate.queued) == (5, 3)
+
+    asyncio.run(body())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+
+    async def body():
+        gate = main.CapacityGate(1, shed_threshold=10)
+        assert gate.try_acquire()
+        first = asyncio.create_task(gate.acquire())
+        second = asyncio.create_task(gate.acquire())
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        assert gate.depth == 1
+        gate.release()
+        await second  # the slot went to the remaining waiter
+        assert gate.in_use == 1
+        gate.release()
+        assert gate.in_use == 0
+
+    asyncio.run(body())
+
+
+def test_should_shed_at_the_threshold():
+
+    async def body():
+        gate = main.CapacityGate(1, shed_threshold=2)
+        assert gate.try_acquire()
+        assert not gate.should_shed()
+        waiters = [asyncio.create_task(gate.acquire()) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert gate.should_shed()
+        assert gate.shed == 1
+        for task in waiters:
+            task.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        assert not gate.should_shed()
+
+    asyncio.run(body())
+
+
+def test_estimate_uses_the_average_hold():
+    gate = main.CapacityGate(2, shed_threshold=10)
+    assert gate.estimate() == (0, 0.0)
+    gate.try_acquire()
+    gate.try_acquire()
+    assert gate.estimate() == (1, pytest.approx(30.0))
+    gate.release(held_for=160.0)
+    assert gate.avg_hold == pytest.approx(70.0)
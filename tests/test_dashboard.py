@@ -0,0 +1,121 @@
+import json
+from types import SimpleNamespace
+
+from telegram.error import BadRequest
+
+import main
+
+
+class FakeBot:
+
+    def __init__(self):
+        self.sent = []
+        self.pinned = set()
+        self.edits = []
+        self.gone = set()  # chats whose dashboard message was deleted
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(message_id=100 + len(self.sent))
+
+    async def pin_chat_message(self, chat_id, message_id, **kwargs):
+        self.pinned.add((chat_id, message_id))
+
+    async def unpin_chat_message(self, chat_id, message_id):
+        self.pinned.discard((chat_id, message_id))
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        if chat_id in self.gone:
+            raise BadRequest("Message to edit not found")
+        self.edits.append((chat_id, message_id))
+
+
+def _dashboard(tenant):
+    tenant.app = SimpleNamespace(bot=FakeBot())
+    tenant.dashboard = main.Dashboard(tenant, 60)
+    return tenant.dashboard, tenant.app.bot
+
+
+async def _stock(repo, country_code: str, n: int):
+    return [
+        await repo.add_account(country_code, f"+1555000{i:04d}",
+                               f"{country_code}_{i}.session", None, 1, 1.0)
+        for i in range(n)
+    ]
+
+
+def test_render_caches_stock_until_it_changes(shop):
+
+    async def body(tenant):
+        dashboard, _ = _dashboard(tenant)
+        await _stock(tenant.repo, "US", 2)
+        dashboard.record_sale(2.5)
+        dashboard.record_sale(1.0)
+        text = await dashboard.render()
+        assert "🇺🇸 US: 2 / 0" in text
+        assert "2 sale(s), ₹3.5" in text
+        await tenant.repo.claim_account("US", {"reserved_by": 7})
+        assert "US: 2 / 0" in await dashboard.render()  # cached
+        main.stock_changed()
+        assert "US: 1 / 1" in await dashboard.render()
+
+    shop(body)
+
+
+def test_refresh_edits_only_when_the_text_changes(shop):
+
+    async def body(tenant):
+        dashboard, bot = _dashboard(tenant)
+        await dashboard.add(1)
+        await dashboard.add(2)
+        await dashboard.stop()
+        assert bot.pinned == {(1, 101), (2, 102)}
+        await dashboard._refresh()
+        assert sorted(bot.edits) == [(1, 101), (2, 102)]
+        await dashboard._refresh()  # same text: no edits
+        assert len(bot.edits) == 2 and dashboard.unchanged == 1
+        # a deleted message drops that chat's dashboard
+        bot.gone.add(2)
+        dashboard.record_sale(1.0)
+        await dashboard._refresh()
+        assert dashboard.messages == {1: 101}
+        assert json.loads(await tenant.repo.get_setting(
+            main.DASHBOARD_SETTING)) == {"1": 101}
+        assert await dashboard.remove(1) is True
+        assert bot.pinned == {(2, 102)}
+        assert await dashboard.remove(1) is False
+
+    shop(body)
+
+
+def test_pinned_dashboards_resume_after_a_restart(shop):
+
+    async def body(tenant):
+        dashboard, _ = _dashboard(tenant)
+        await dashboard.add(1)
+        await dashboard.stop()
+        restarted, _ = _dashboard(tenant)
+        await restarted.restore()
+        try:
+            assert restarted.messages == {1: 101}
+            assert restarted._task is not None
+        finally:
+            await restarted.stop()
+
+    shop(body)
+
+
+def test_errors_are_counted_over_the_window(shop):
+
+    async def body(tenant):
+        dashboard, _ = _dashboard(tenant)
+        assert dashboard._error_rates()["throttled"] == 0
+        tenant.usage["throttled"] += 3
+        assert dashboard._error_rates()["throttled"] == 3
+        # once those samples are older than the window, they stop counting
+        dashboard._samples = type(dashboard._samples)(
+            (at - main.DASHBOARD_ERROR_WINDOW - 1, counters)
+            for at, counters in dashboard._samples)
+        assert dashboard._error_rates()["throttled"] == 0
+
+    shop(body)
@@ -0,0 +1,49 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    async def start_purchase(context, user, cc, show):
+        calls.append(("purchase", cc))
+
+    async def get_user(user_id, username):
+        return {"id": user_id, "username": username, "last_country": None}
+
+    async def show_main_menu(update, context, last_country):
+        calls.append(("menu", None))
+
+    monkeypatch.setattr(main, "start_purchase", start_purchase)
+    monkeypatch.setattr(main, "get_user", get_user)
+    monkeypatch.setattr(main, "show_main_menu", show_main_menu)
+    return calls
+
+
+def _start(*args):
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=5,
+                                                            username="b"),
+                             message=None)
+    asyncio.run(main.start(update, SimpleNamespace(args=list(args))))
+
+
+@pytest.mark.parametrize("arg, expected", [
+    ("buy_us", ("purchase", "US")),
+    ("buy_IN", ("purchase", "IN")),
+    ("buy_ZZ", ("menu", None)),
+    ("buy_USA", ("menu", None)),
+    ("ref_123", ("menu", None)),
+])
+def test_deep_link_country_must_be_sold(calls, arg, expected):
+    _start(arg)
+    assert calls == [expected]
+
+
+def test_plain_start_opens_the_menu(calls):
+    _start()
+    assert calls == [("menu", None)]
@@ -0,0 +1,57 @@
+import aiosqlite
+
+import main
+
+
+def test_placeholders_follow_the_param_renderer():
+    sql, params = main.export_query("accounts", "2026-01-01", "2026-02-01",
+                                    "US", lambda n: f"${n}")
+    assert sql.endswith("WHERE country_code = $1 AND created_at >= $2 "
+                        "AND created_at < $3 ORDER BY id")
+    assert params == ["US", "2026-01-01", "2026-02-01"]
+
+
+def test_no_filters_no_where():
+    sql, params = main.export_query("users", None, None, None, lambda n: "?")
+    assert sql == ("SELECT u.id, u.created_at, u.username, u.balance "
+                   "FROM users u ORDER BY u.id")
+    assert params == []
+
+
+def test_columns_match_export_columns():
+    for kind, columns in main.EXPORT_COLUMNS.items():
+        sql, _ = main.export_query(kind, None, None, None, lambda n: "?")
+        selected = sql.split("SELECT ", 1)[1].split(" FROM ", 1)[0]
+        assert [c.strip().split(".")[-1]
+                for c in selected.split(",")] == list(columns)
+
+
+def test_filters_on_sqlite(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        us = await repo.add_account("US", "+1", "us.session", None, 1, 1.0)
+        gb = await repo.add_account("GB", "+44", "gb.session", None, 1, 1.0)
+        async with aiosqlite.connect(tenant.db_path) as db:
+            await db.executemany(
+                "INSERT INTO users (id, created_at) VALUES (?, ?)",
+                [(1, "2026-01-05 10:00:00"), (2, "2026-02-05 10:00:00")])
+            await db.executemany(
+                "INSERT INTO transactions (user_id, account_id, amount, type, created_at) "
+                "VALUES (?, ?, ?, 'purchase', ?)",
+                [(1, us, 1.0, "2026-01-06 10:00:00"),
+                 (2, gb, 1.0, "2026-02-06 10:00:00")])
+            await db.commit()
+
+        async def export(*args):
+            return [row async for row in repo.iter_export(*args)]
+
+        january = await export("transactions", "2026-01-01", "2026-02-01",
+                               None)
+        assert [(r[2], r[4]) for r in january] == [(1, "US")]
+        assert [r[0] for r in await export("users", None, None, "GB")] == [2]
+        assert [r[0] for r in await export("accounts", None, None, "US")
+                ] == [us]
+        assert await export("users", "2026-03-01", None, None) == []
+
+    shop(body)
@@ -0,0 +1,130 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import ApplicationHandlerStop
+
+import main
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+
+def test_burst_then_refill(clock):
+    limiter = main.TokenBucketLimiter("t", rate=2.0, burst=3, max_entries=10)
+    assert [limiter.consume(1)[0] for _ in range(3)] == [0.0, 0.0, 0.0]
+    wait, first = limiter.consume(1)
+    assert wait == pytest.approx(0.5) and first
+    wait, first = limiter.consume(1)
+    assert wait > 0 and not first  # still the same throttle streak
+    clock.now += 0.5
+    assert limiter.consume(1) == (0.0, False)
+    # other users have their own bucket
+    assert limiter.consume(2) == (0.0, False)
+    assert limiter.stats()["throttled"] == 2
+
+
+def test_refill_is_capped_at_burst(clock):
+    limiter = main.TokenBucketLimiter("t", rate=1.0, burst=2, max_entries=10)
+    limiter.consume(1)
+    clock.now += 1000
+    assert [limiter.consume(1)[0] for _ in range(3)][-1] > 0
+
+
+def test_cost_above_the_tokens_left_waits_for_the_difference(clock):
+    limiter = main.TokenBucketLimiter("t", rate=1.0, burst=4, max_entries=10)
+    assert limiter.consume(1, cost=3)[0] == 0.0
+    assert limiter.consume(1, cost=3)[0] == pytest.approx(2.0)
+
+
+def test_idle_and_excess_buckets_are_evicted(clock):
+    limiter = main.TokenBucketLimiter("t", rate=1.0, burst=2, max_entries=2)
+    for user_id in (1, 2, 3):
+        limiter.consume(user_id)
+    assert limiter.stats()["tracked"] == 2
+    clock.now += 10
+    limiter.consume(4)
+    assert limiter.stats()["tracked"] == 1
+    assert limiter.stats()["evicted"] == 3
+
+
+def _update(user_id, data=None, text=None):
+    answered = []
+
+    async def answer(text):
+        answered.append(text)
+
+    query = SimpleNamespace(data=data, answer=answer) if data else None
+    message = None
+    if text is not None:
+        message = SimpleNamespace(text=text, reply_text=answer)
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id),
+                             callback_query=query,
+                             message=message)
+    return update, answered
+
+
+def _guard(update):
+    try:
+        asyncio.run(main.flood_guard(update, None))
+    except ApplicationHandlerStop:
+        return False
+    return True
+
+
+@pytest.fixture
+def limiters(monkeypatch, clock):
+    ui = main.TokenBucketLimiter("ui", 1.0, 5, 100)
+    heavy = main.TokenBucketLimiter("heavy", 1.0, 1, 100)
+    monkeypatch.setattr(main, "FLOOD_UI", ui)
+    monkeypatch.setattr(main, "FLOOD_HEAVY", heavy)
+    return ui, heavy
+
+
+def test_heavy_prefixes_use_the_heavy_bucket(limiters):
+    ui, heavy = limiters
+    update, answered = _update(10, data="country_US")
+    assert _guard(update)
+    assert (ui.allowed, heavy.allowed) == (0, 1)
+    update, answered = _update(10, data="country_GB")
+    assert not _guard(update)
+    assert answered == ["⏳ Slow down! Try again in 1s."]
+    # the UI bucket is untouched by the heavy taps
+    update, _ = _update(10, data="back_to_menu")
+    assert _guard(update)
+    update, _ = _update(10, text="/start buy_US")
+    assert not _guard(update)
+    assert heavy.throttled == 2
+
+
+def test_messages_reply_once_per_throttle_streak(limiters):
+    ui, _ = limiters
+    replies = []
+    for _ in range(8):
+        update, answered = _update(11, text="hello")
+        _guard(update)
+        replies += answered
+    assert ui.throttled == 3
+    assert len(replies) == 1
+
+
+def test_admins_are_exempt(limiters):
+    ui, heavy = limiters
+    admin = main.tenant_config("ADMIN_IDS")[0]
+    for _ in range(5):
+        update, _ = _update(admin, data="country_US")
+        assert _guard(update)
+    assert heavy.allowed == heavy.throttled == 0
@@ -0,0 +1,40 @@
+import sqlite3
+
+import main
+
+
+def _auto_vacuum(path):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute("PRAGMA auto_vacuum").fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_new_database_starts_incremental(shop):
+
+    async def body(tenant):
+        return _auto_vacuum(tenant.db_path)
+
+    assert shop(body) == 2
+
+
+def test_existing_database_is_converted_only_on_demand(shop, tmp_path):
+    path = str(tmp_path / "shop.db")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE legacy (id INTEGER PRIMARY KEY)")
+    db.executemany("INSERT INTO legacy (id) VALUES (?)", [(1, ), (2, )])
+    db.commit()
+    db.close()
+
+    async def body(tenant):
+        assert _auto_vacuum(tenant.db_path) == 0  # startup left it alone
+        assert "see /backup vacuum" in main.sqlite_incremental_vacuum()
+        assert main.sqlite_convert_incremental().startswith("rebuilt")
+        assert _auto_vacuum(tenant.db_path) == 2
+        assert main.sqlite_convert_incremental() == "already incremental"
+        db = sqlite3.connect(tenant.db_path)
+        assert db.execute("SELECT COUNT(*) FROM legacy").fetchone()[0] == 2
+        db.close()
+
+    shop(body, group_commit=False)
@@ -0,0 +1,137 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import aiosqlite
+import pytest
+
+import main
+
+
+@pytest.fixture
+def monitors(monkeypatch):
+    registry = main.MonitorRegistry()
+    monkeypatch.setattr(main, "MONITORS", registry)
+    return registry
+
+
+async def _forever():
+    await asyncio.Event().wait()
+
+
+async def _reserve(db_path, user_id, until, price=1.0):
+    meta = json.dumps({"reserved_by": user_id, "reserved_until": until})
+    async with aiosqlite.connect(db_path) as db:
+        cur = await db.execute(
+            "INSERT INTO accounts (country_code, phone_number, session_file, "
+            "status, price, metadata) VALUES ('US', '+15550001', 'a.session', "
+            "'reserved', ?, ?)", (price, meta))
+        await db.commit()
+        return cur.lastrowid
+
+
+async def _status(db_path, acc_id):
+    async with aiosqlite.connect(db_path) as db:
+        cur = await db.execute("SELECT status FROM accounts WHERE id=?",
+                               (acc_id, ))
+        return (await cur.fetchone())[0]
+
+
+def _callback(data, user_id, edits):
+
+    async def edit_message_text(text, **kwargs):
+        edits.append(text)
+
+    async def answer(*args, **kwargs):
+        pass
+
+    q = SimpleNamespace(data=data,
+                        from_user=SimpleNamespace(id=user_id, username="buyer"),
+                        answer=answer,
+                        edit_message_text=edit_message_text)
+    return SimpleNamespace(callback_query=q)
+
+
+def _context():
+
+    async def send_message(*args, **kwargs):
+        pass
+
+    return SimpleNamespace(bot=SimpleNamespace(send_message=send_message))
+
+
+def test_one_monitor_per_account(monitors):
+
+    async def body():
+        assert monitors.start(1, 7, _forever) == "started"
+        task = monitors._entries[1]["task"]
+        assert monitors.start(1, 7, _forever) == "reused"
+        assert monitors.start(1, 8, _forever) == "refused"
+        assert monitors._entries[1]["task"] is task
+        assert monitors.cancel(1) is True
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled() and len(monitors) == 0
+        assert monitors.cancel(1) is False
+        assert monitors.start(1, 8, _forever) == "started"
+        await monitors.cancel_all()
+        assert len(monitors) == 0
+
+    asyncio.run(body())
+
+
+def test_finished_monitor_leaves_the_registry(monitors):
+
+    async def body():
+
+        async def quick():
+            return None
+
+        monitors.start(2, 7, quick)
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert len(monitors) == 0
+
+    asyncio.run(body())
+
+
+def test_expiry_tick_cancels_the_released_monitor(shop, monitors):
+
+    async def body(tenant):
+        past = (datetime.now(main.IST) - timedelta(minutes=1)).isoformat()
+        future = (datetime.now(main.IST) + timedelta(minutes=10)).isoformat()
+        expired = await _reserve(tenant.db_path, 7, past)
+        held = await _reserve(tenant.db_path, 8, future)
+        monitors.start(expired, 7, _forever)
+        monitors.start(held, 8, _forever)
+        await main.release_expired_reservations_tick()
+        assert await _status(tenant.db_path, expired) == "available"
+        assert [m["acc_id"] for m in monitors.snapshot()] == [held]
+        await monitors.cancel_all()
+
+    shop(body)
+
+
+@pytest.mark.parametrize("balance, status", [(5.0, "sold"),
+                                             (0.0, "available")])
+def test_done_cancels_the_monitor(shop, monitors, balance, status):
+
+    async def body(tenant):
+        future = (datetime.now(main.IST) + timedelta(minutes=10)).isoformat()
+        acc_id = await _reserve(tenant.db_path, 7, future, price=2.0)
+        await main.get_user(7, "buyer")
+        async with aiosqlite.connect(tenant.db_path) as db:
+            await db.execute("UPDATE users SET balance=? WHERE id=7",
+                             (balance, ))
+            await db.commit()
+        tenant.dashboard = main.Dashboard(tenant, 60)
+        monitors.start(acc_id, 7, _forever)
+        task = monitors._entries[acc_id]["task"]
+        edits = []
+        await main.done_cb(_callback(f"done_{acc_id}", 7, edits), _context())
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled() and len(monitors) == 0
+        assert await _status(tenant.db_path, acc_id) == status
+        assert edits
+
+    shop(body)
@@ -0,0 +1,152 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+T0 = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def _msg(text, minutes):
+    """A 777000 history message sent `minutes` after T0."""
+    return SimpleNamespace(sender_id=main.TARGET_UID,
+                           message=text,
+                           date=T0 + timedelta(minutes=minutes))
+
+
+class FakeClient:
+    """The part of TelegramClient the OTP watchers use."""
+
+    def __init__(self, history=()):
+        self.handlers = []
+        self.history = list(history)  # newest first, like get_messages
+        self.fetched_with_handler = None
+
+    def add_event_handler(self, handler, event):
+        self.handlers.append(handler)
+
+    def remove_event_handler(self, handler, event):
+        self.handlers.remove(handler)
+
+    async def get_messages(self, chat, limit=None):
+        assert chat == main.TARGET_UID
+        self.fetched_with_handler = bool(self.handlers)
+        return self.history[:limit]
+
+    async def push(self, text, sender=main.TARGET_UID):
+        event = SimpleNamespace(message=SimpleNamespace(
+            sender_id=sender, message=text, to_id=None))
+        for handler in list(self.handlers):
+            await handler(event)
+
+
+@pytest.mark.parametrize("text, code", [
+    ("Login code: 12345. Do not give this code to anyone", "12345"),
+    ("LOGIN CODE: 12-345", "12345"),
+    ("Your code is 1 2 3 4 5, valid for 5 minutes", "12345"),
+    ("Login code: 123456789", "12345"),
+    ("Code 54321", "54321"),
+    ("Order #1234 shipped", None),
+    ("", None),
+    (None, None),
+])
+def test_extract_otp(text, code):
+    assert main.extract_otp(text) == code
+
+
+def test_watch_returns_the_first_code_from_the_service_chat():
+
+    async def body():
+        client = FakeClient()
+        watch = asyncio.create_task(main.watch_for_otp(client, 5))
+        await asyncio.sleep(0)
+        await client.push("Login code: 11111", sender=12345)  # not 777000
+        await client.push("Welcome to Telegram")
+        await client.push("Login code: 22222")
+        await client.push("Login code: 33333")
+        assert await watch == "22222"
+        assert client.handlers == []
+
+    asyncio.run(body())
+
+
+def test_watch_times_out_with_none():
+
+    async def body():
+        client = FakeClient()
+        assert await main.watch_for_otp(client, 0.05) is None
+        assert client.handlers == []
+
+    asyncio.run(body())
+
+
+def test_history_before_since_is_ignored():
+
+    async def body():
+        client = FakeClient([_msg("Login code: 22222", -1),
+                             _msg("Login code: 11111", -5)])
+        assert await main.recent_otp(client, T0.timestamp()) is None
+        assert await main.recent_otp(client, None) is None
+
+    asyncio.run(body())
+
+
+def test_history_newest_matching_code_wins():
+
+    async def body():
+        client = FakeClient([_msg("Welcome back", 4),
+                             _msg("Login code: 33333", 3),
+                             _msg("Login code: 22222", 2),
+                             _msg("Login code: 11111", -1)])
+        otp, msg = await main.recent_otp(client, T0.timestamp())
+        assert otp == "33333" and msg is client.history[1]
+
+    asyncio.run(body())
+
+
+def test_history_skips_delivered_codes():
+
+    async def body():
+        client = FakeClient([_msg("Login code: 33333", 3),
+                             _msg("Login code: 22222", 2)])
+        since = T0.timestamp()
+        otp, _ = await main.recent_otp(client, since, {"33333"})
+        assert otp == "22222"
+        assert await main.recent_otp(client, since,
+                                     {"33333", "22222"}) is None
+
+    asyncio.run(body())
+
+
+def test_code_in_history_settles_the_watch():
+
+    async def body():
+        client = FakeClient([_msg("Login code: 44444", 1)])
+        trace = {}
+        otp = await asyncio.wait_for(
+            main.watch_for_otp(client, 30, T0.timestamp(), (), trace), 1)
+        assert otp == "44444"
+        assert trace["source"] == "history"
+        assert trace["message_at"] == client.history[0].date.timestamp()
+        # the live handler was already registered when history was read
+        assert client.fetched_with_handler is True
+        assert client.handlers == []
+
+    asyncio.run(body())
+
+
+def test_live_events_skip_delivered_codes():
+
+    async def body():
+        client = FakeClient([_msg("Login code: 44444", 1)])
+        watch = asyncio.create_task(
+            main.watch_for_otp(client, 5, T0.timestamp(), {"44444"}))
+        await asyncio.sleep(0)
+        await client.push("Login code: 44444")
+        await client.push("Login code: 55555")
+        assert await watch == "55555"
+
+    asyncio.run(body())
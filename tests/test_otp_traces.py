@@ -0,0 +1,82 @@
+import sqlite3
+import time
+
+import main
+
+
+def _trace(sent_at: float) -> dict:
+    return {"source": "listener", "reserved_at": sent_at - 60,
+            "queued_at": sent_at - 4.5, "admitted_at": sent_at - 4,
+            "connected_at": sent_at - 3, "handler_at": sent_at - 2.5,
+            "message_at": sent_at - 2, "extracted_at": sent_at - 1.5,
+            "sent_at": sent_at}
+
+
+def test_percentile_is_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert main.percentile(values, 50) == 50.0
+    assert main.percentile(values, 95) == 95.0
+    assert main.percentile(values, 99) == 99.0
+    assert main.percentile(values, 100) == 100.0
+
+
+def test_percentile_of_small_samples():
+    assert main.percentile([7.0], 50) == 7.0
+    assert main.percentile([7.0], 99) == 7.0
+    assert main.percentile([1.0, 2.0, 3.0], 0) == 1.0
+    assert main.percentile([1.0, 2.0, 3.0], 50) == 2.0
+    assert main.percentile([1.0, 2.0, 3.0], 95) == 3.0
+
+
+def test_traces_go_through_the_writer_and_feed_the_report(shop):
+
+    async def body(tenant):
+        now = time.time()
+        await main.record_otp_trace(1, "US", _trace(now))
+        await main.record_otp_trace(2, "GB", _trace(now - 10))
+        await main.record_otp_trace(3, "GB", {"source": "live",
+                                              "sent_at": now})
+        assert tenant.repo.writer.stats()["ops"] == 3
+        report = await main.latency_report(1)
+        assert set(report) == {"ALL", "US", "GB"}
+        # the partial trace only counts towards stages it has both ends of
+        assert report["ALL"]["code→buyer"] == (2, 2.0, 2.0, 2.0)
+        # connect starts once a Telethon slot is held, not at the reservation
+        assert report["US"]["queue"] == (1, 0.5, 0.5, 0.5)
+        assert report["US"]["connect"] == (1, 1.0, 1.0, 1.0)
+        assert set(await main.latency_report(1, "US")) == {"ALL", "US"}
+
+    shop(body)
+
+
+def test_old_traces_are_pruned(shop):
+
+    async def body(tenant):
+        old = time.time() - (main.CONFIG["OTP_TRACE_RETENTION_DAYS"] + 1) * 86400
+        await main.record_otp_trace(1, "US", _trace(old))
+        await main.record_otp_trace(2, "US", _trace(time.time()))
+        await main.prune_otp_traces_tick()
+        rows = await tenant.repo.otp_traces_since(0)
+        assert len(rows) == 1
+
+    shop(body)
+
+
+def test_old_trace_tables_gain_the_queue_columns(shop, tmp_path):
+    # the table as created before the queue stage was traced
+    db = sqlite3.connect(str(tmp_path / "shop.db"))
+    db.execute(
+        "CREATE TABLE otp_traces (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "account_id INTEGER, country_code TEXT, source TEXT, reserved_at REAL, "
+        "connected_at REAL, handler_at REAL, message_at REAL, "
+        "extracted_at REAL, sent_at REAL NOT NULL)")
+    db.commit()
+    db.close()
+
+    async def body(tenant):
+        trace = _trace(time.time())
+        await main.record_otp_trace(1, "US", trace)
+        [row] = await tenant.repo.otp_traces_since(0)
+        assert row[2:4] == (trace["queued_at"], trace["admitted_at"])
+
+    shop(body)
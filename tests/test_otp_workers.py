@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+class FakeConn:
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, cmd):
+        self.sent.append(cmd)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """An OtpWorkerPool of two workers whose pipes are recorded, not spawned."""
+
+    async def session_ref(session_file):
+        return ("string", f"ref-{session_file}")
+
+    monkeypatch.setattr(main, "session_ref", session_ref)
+    pool = main.OtpWorkerPool(2)
+    pool._conns = [FakeConn(), FakeConn()]
+    return pool
+
+
+def test_watch_goes_to_the_owning_worker_and_resolves(pool):
+
+    async def body():
+        pool._loop = asyncio.get_running_loop()
+        watch = asyncio.create_task(pool.watch(7, "a.session", 30))
+        await asyncio.sleep(0)
+        [cmd] = pool._conns[7 % 2].sent
+        assert cmd[0] == "watch" and cmd[1] == 7 and cmd[3] == (
+            "string", "ref-a.session")
+        assert pool._conns[0].sent == []
+        pool._on_result(("result", 7, cmd[2], {"otp": "12345"}))
+        assert await watch == "12345"
+        assert pool.stats()["watching"] == 0
+
+    asyncio.run(body())
+
+
+def test_results_of_superseded_watches_are_ignored(pool):
+
+    async def body():
+        pool._loop = asyncio.get_running_loop()
+        first = asyncio.create_task(pool.watch(4, "a.session", 30))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(pool.watch(4, "a.session", 30))
+        await asyncio.sleep(0)
+        old, new = pool._conns[0].sent
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        pool._on_result(("result", 4, old[2], {"otp": "11111"}))
+        assert not second.done()
+        pool._on_result(("result", 4, new[2], {"otp": "22222"}))
+        assert await second == "22222"
+
+    asyncio.run(body())
+
+
+def test_cancelling_a_watch_cancels_it_in_the_worker(pool):
+
+    async def body():
+        pool._loop = asyncio.get_running_loop()
+        watch = asyncio.create_task(pool.watch(3, "a.session", 30))
+        await asyncio.sleep(0)
+        watch.cancel()
+        await asyncio.gather(watch, return_exceptions=True)
+        assert pool._conns[1].sent[-1] == ("cancel", 3)
+        assert pool.stats()["watching"] == 0
+
+    asyncio.run(body())
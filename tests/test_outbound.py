@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import main
+
+
+class FakeBot:
+    """Stands in for the Bot whose bound _do_post PTB hands the rate limiter."""
+
+    def __init__(self, token, retry_after=None):
+        self.token = token
+        self.retry_after = retry_after
+        self.sent = []
+
+    async def post(self, text):
+        loop = asyncio.get_running_loop()
+        if self.retry_after is not None:
+            retry_after, self.retry_after = self.retry_after, None
+            raise RetryAfter(retry_after)
+        self.sent.append((text, loop.time()))
+        return text
+
+
+def run_scheduler(body, **kwargs):
+    settings = dict(global_rate=1000, chat_rate=1000, chat_burst=100,
+                    group_per_minute=6000)
+    settings.update(kwargs)
+
+    async def runner():
+        scheduler = main.OutboundScheduler(**settings)
+        await scheduler.initialize()
+        try:
+            return await body(scheduler)
+        finally:
+            await scheduler.shutdown()
+
+    return asyncio.run(runner())
+
+
+def send(scheduler, bot, text, chat_id=1, priority=main.PRIORITY_UI):
+    return scheduler.process_request(bot.post, (text, ), {}, "sendMessage",
+                                     {"chat_id": chat_id},
+                                     {"priority": priority})
+
+
+def test_retry_after_pauses_the_bot_and_retries():
+
+    async def body(scheduler):
+        loop = asyncio.get_running_loop()
+        limited = FakeBot("111:a", retry_after=1)
+        other = FakeBot("222:b")
+        started = loop.time()
+        first = asyncio.create_task(send(scheduler, limited, "one"))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(send(scheduler, limited, "two", 2))
+        assert await send(scheduler, other, "free") == "free"
+        assert await first == "one"
+        await second
+        assert other.sent[0][1] - started < 0.5  # not held by the other bot's pause
+        # the retried request keeps its place at the head of the class
+        assert [text for text, _ in limited.sent] == ["one", "two"]
+        assert limited.sent[0][1] - started >= 1.0
+        assert scheduler.retry_after_hits == 1
+
+    run_scheduler(body)
+
+
+def test_retry_after_is_raised_after_max_retries():
+
+    class AlwaysLimited(FakeBot):
+
+        async def post(self, text):
+            raise RetryAfter(0)
+
+    async def body(scheduler):
+        with pytest.raises(RetryAfter):
+            await send(scheduler, AlwaysLimited("111:a"), "x")
+        assert scheduler.retry_after_hits == 3
+
+    run_scheduler(body, max_retries=2)
+
+
+def test_sends_to_one_chat_are_spaced():
+
+    async def body(scheduler):
+        bot = FakeBot("111:a")
+        await asyncio.gather(*(send(scheduler, bot, f"c{i}", chat_id=1)
+                               for i in range(3)),
+                             send(scheduler, bot, "other", chat_id=2))
+        times = {text: at for text, at in bot.sent}
+        assert times["c1"] - times["c0"] >= 0.09
+        assert times["c2"] - times["c1"] >= 0.09
+        # another chat is not held up behind chat 1
+        assert times["other"] < times["c1"]
+
+    run_scheduler(body, chat_rate=10, chat_burst=1)
+
+
+def test_higher_priority_classes_go_first():
+
+    async def body(scheduler):
+        bot = FakeBot("111:a")
+        await asyncio.gather(
+            send(scheduler, bot, "broadcast", 3, main.PRIORITY_BROADCAST),
+            send(scheduler, bot, "ui", 2, main.PRIORITY_UI),
+            send(scheduler, bot, "otp", 1, main.PRIORITY_OTP))
+        assert [text for text, _ in bot.sent] == ["otp", "ui", "broadcast"]
+
+    run_scheduler(body, global_rate=5)
+
+
+def test_only_message_endpoints_are_spaced():
+
+    async def body(scheduler):
+        loop = asyncio.get_running_loop()
+        bot = FakeBot("111:a")
+        await send(scheduler, bot, "first")
+        # the chat bucket is empty: another message would wait ~10s
+        started = loop.time()
+        result = await scheduler.process_request(bot.post, ("member", ), {},
+                                                 "getChatMember",
+                                                 {"chat_id": 1}, None)
+        assert result == "member"
+        assert loop.time() - started < 0.5
+        assert scheduler.sent[main.PRIORITY_UI] == 1
+
+    run_scheduler(body, chat_rate=0.1, chat_burst=1)
+
+
+def test_other_endpoints_wait_out_a_retry_after():
+
+    async def body(scheduler):
+        loop = asyncio.get_running_loop()
+        bot = FakeBot("111:a", retry_after=1)
+        started = loop.time()
+        sending = asyncio.create_task(send(scheduler, bot, "one"))
+        await asyncio.sleep(0.05)
+        await scheduler.process_request(bot.post, ("answer", ), {},
+                                        "answerCallbackQuery", {}, None)
+        await sending
+        assert dict(bot.sent)["answer"] - started >= 1.0
+
+    run_scheduler(body)
@@ -0,0 +1,183 @@
+"""
+PostgresRepository against a real server. Uses TEST_DATABASE_URL when set,
+otherwise starts a throwaway cluster with initdb/pg_ctl from PATH; skipped
+when neither is available or asyncpg is not installed. Every test works in
+its own schemas, dropped afterwards.
+"""
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import uuid
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(main.asyncpg is None,
+                                reason="asyncpg is not installed")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def pg_dsn():
+    dsn = os.getenv("TEST_DATABASE_URL")
+    if dsn:
+        yield dsn
+        return
+    initdb, pg_ctl = shutil.which("initdb"), shutil.which("pg_ctl")
+    if not (initdb and pg_ctl):
+        pytest.skip("no TEST_DATABASE_URL and no initdb/pg_ctl on PATH")
+    data = tempfile.mkdtemp(prefix="shop-pg-")
+    port = _free_port()
+    subprocess.run([initdb, "-D", data, "-U", "postgres", "-A", "trust"],
+                   check=True, capture_output=True)
+    subprocess.run([
+        pg_ctl, "-D", data, "-w", "-l", os.path.join(data, "log"), "-o",
+        f"-p {port} -k {data} -c listen_addresses=127.0.0.1", "start"
+    ], check=True, capture_output=True)
+    try:
+        yield f"postgresql://postgres@127.0.0.1:{port}/postgres"
+    finally:
+        subprocess.run([pg_ctl, "-D", data, "-m", "immediate", "stop"],
+                       capture_output=True)
+        shutil.rmtree(data, ignore_errors=True)
+
+
+@pytest.fixture
+def pg(pg_dsn):
+    """
+    run(body, tenants=1): await body(*repos) with one PostgresRepository per
+    tenant, all sharing the DSN's pool, each in a fresh schema.
+    """
+
+    def run(body, tenants: int = 1):
+        schemas = [f"test_{uuid.uuid4().hex[:12]}" for _ in range(tenants)]
+        repos = [
+            main.PostgresRepository(pg_dsn, 8, schema, slot *
+                                    main.TENANT_ID_SPAN)
+            for slot, schema in enumerate(schemas)
+        ]
+
+        async def runner():
+            for repo in repos:
+                await repo.init()
+            try:
+                return await body(*repos)
+            finally:
+                async with repos[0].pool.acquire() as conn:
+                    for schema in schemas:
+                        await conn.execute(
+                            f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+                for repo in repos:
+                    await repo.close()
+
+        return asyncio.run(runner())
+
+    return run
+
+
+async def _stock(repo, country_code: str, n: int, price: float = 1.0):
+    return [
+        await repo.add_account(country_code, f"+1555000{i:04d}",
+                               f"{country_code}_{i}.session", None, 1, price)
+        for i in range(n)
+    ]
+
+
+def test_concurrent_claims_get_distinct_accounts(pg):
+
+    async def body(repo):
+        stocked = await _stock(repo, "US", 10)
+        claims = await asyncio.gather(*(repo.claim_account(
+            "US", {"reserved_by": user_id}) for user_id in range(16)))
+        ids = [c[0] for c in claims if c]
+        assert sorted(ids) == sorted(stocked)
+        assert claims.count(None) == 6
+        assert await repo.available_count("US") == 0
+
+    pg(body)
+
+
+def test_reserve_then_complete_sale(pg):
+
+    async def body(repo):
+        [acc_id] = await _stock(repo, "GB", 1, price=2.5)
+        await repo.get_or_create_user(7, "buyer")
+        await repo.set_balance(7, 4.0)
+        poor = await repo.reserve_for_buyer(8, "poor", "GB", 2.5,
+                                            {"reserved_by": 8})
+        assert poor["result"] == "insufficient"
+        held = await repo.reserve_for_buyer(7, "buyer", "GB", 2.5,
+                                            {"reserved_by": 7})
+        assert held["result"] == "reserved"
+        assert held["account"][0] == acc_id
+        # reserved for 7: nobody else can buy it
+        assert (await repo.complete_sale(acc_id, 8))["result"] == "unavailable"
+        sale = await repo.complete_sale(acc_id, 7)
+        assert sale["result"] == "sold"
+        assert sale["balance"] == pytest.approx(1.5)
+        assert await repo.get_balance(7) == pytest.approx(1.5)
+        assert (await repo.get_account(acc_id))["status"] == "sold"
+        assert (await repo.complete_sale(acc_id, 7))["result"] == "unavailable"
+
+    pg(body)
+
+
+def test_balance_batch_skips_an_insufficient_row(pg):
+
+    async def body(repo):
+        for user_id in (1, 2):
+            await repo.get_or_create_user(user_id, None)
+        await repo.set_balance(1, 5.0)
+        results = await repo.apply_balance_batch([
+            (1, 3.0, "deposit", "a"),
+            (2, -1.0, "admin_deduct", "b"),
+            (1, -7.0, "admin_deduct", "c"),
+            (99, 1.0, "deposit", "d"),
+        ])
+        assert results == [(True, 8.0), (False, 0.0), (True, 1.0),
+                           (False, None)]
+        assert await repo.get_balance(1) == pytest.approx(1.0)
+        assert await repo.get_balance(2) == pytest.approx(0.0)
+
+    pg(body)
+
+
+def test_concurrent_balance_batches_serialise_on_row_locks(pg):
+
+    async def body(repo):
+        await repo.get_or_create_user(1, None)
+        await repo.set_balance(1, 10.0)
+        results = await asyncio.gather(*(repo.apply_balance_batch(
+            [(1, -1.0, "admin_deduct", str(i))]) for i in range(15)))
+        assert sum(ok for [(ok, _)] in results) == 10
+        assert await repo.get_balance(1) == pytest.approx(0.0)
+
+    pg(body)
+
+
+def test_two_tenant_schemas_share_one_pool(pg):
+
+    async def body(first, second):
+        assert first.pool is second.pool
+        [a] = await _stock(first, "US", 1)
+        [b] = await _stock(second, "US", 1)
+        assert a < main.TENANT_ID_SPAN <= b
+        assert await first.get_account(b) is None
+        assert await second.get_account(a) is None
+        upload_id = await second.upload_create(1, "US", main.now_iso())
+        assert upload_id >= main.TENANT_ID_SPAN
+        await second.get_or_create_user(5, "x")
+        assert await first.get_balance(5) is None
+        assert await first.count_users() == 0
+        assert await second.count_users() == 1
+
+    pg(body, tenants=2)
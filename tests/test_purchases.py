@@ -0,0 +1,53 @@
+import aiosqlite
+
+import main
+
+
+async def _purchases(tenant, user_id: int, n: int):
+    acc_id = await tenant.repo.add_account("US", "+15550001", "us.session",
+                                         None, 1, 1.0)
+    async with aiosqlite.connect(tenant.db_path) as db:
+        await db.executemany(
+            "INSERT INTO transactions (user_id, account_id, amount, type, created_at) "
+            "VALUES (?, ?, ?, ?, '2026-01-05 10:00:00')",
+            [(user_id, acc_id, float(i + 1), "purchase") for i in range(n)] +
+            [(user_id, None, 50.0, "deposit"), (user_id + 1, acc_id, 9.0,
+                                                "purchase")])
+        await db.commit()
+
+
+def test_pages_walk_back_without_gaps_or_repeats(shop):
+
+    async def body(tenant):
+        await _purchases(tenant, 7, 23)
+        amounts, before, pages = [], None, 0
+        while True:
+            text, rows, has_more = await main.purchase_history_page(7, before)
+            pages += 1
+            amounts += [row[2] for row in rows]
+            if not has_more:
+                break
+            before = rows[-1][0]
+        assert pages == 3
+        assert amounts == [float(a) for a in range(23, 0, -1)]
+        text, rows, _ = await main.purchase_history_page(7, None)
+        assert len(rows) == main.PURCHASES_PAGE_SIZE
+        assert "`+15550001` 🇺🇸 US — ₹23 — 05 Jan 2026 15:30" in text
+        assert await main.purchase_history_page(99, None) == ("", [], False)
+
+    shop(body)
+
+
+def test_history_is_a_covering_index_range_search(shop):
+
+    async def body(tenant):
+        async with aiosqlite.connect(tenant.db_path) as db:
+            cur = await db.execute(
+                "EXPLAIN QUERY PLAN SELECT t.id, t.created_at, t.amount "
+                "FROM transactions t WHERE t.user_id=? AND t.type='purchase' "
+                "AND t.id < ? ORDER BY t.id DESC LIMIT ?", (7, 100, 11))
+            plan = " ".join(row[-1] for row in await cur.fetchall())
+        assert "COVERING INDEX idx_transactions_user_history" in plan
+        assert "TEMP B-TREE" not in plan
+
+    shop(body)
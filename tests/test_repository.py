@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+async def _stock(repo, country_code: str, n: int, price: float = 1.0):
+    return [
+        await repo.add_account(country_code, f"+1555000{i:04d}",
+                               f"{country_code}_{i}.session", None, 1, price)
+        for i in range(n)
+    ]
+
+
+@pytest.mark.parametrize("group_commit", [True, False])
+def test_concurrent_claims_get_distinct_accounts(shop, group_commit):
+
+    async def body(tenant):
+        repo = tenant.repo
+        stocked = await _stock(repo, "US", 5)
+        claims = await asyncio.gather(*(repo.claim_account(
+            "US", {"reserved_by": user_id}) for user_id in range(8)))
+        ids = [c[0] for c in claims if c]
+        assert sorted(ids) == sorted(stocked)
+        assert claims.count(None) == 3
+        assert (await repo.get_account(ids[0]))["status"] == "reserved"
+
+    shop(body, group_commit)
+
+
+def test_sale_charges_only_the_reserving_buyer(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        [acc_id] = await _stock(repo, "GB", 1, price=2.5)
+        for user_id in (7, 8):
+            await repo.get_or_create_user(user_id, None)
+            await repo.set_balance(user_id, 4.0)
+        await repo.claim_account("GB", {"reserved_by": 7})
+        # reserved for 7: nobody else can buy it
+        assert (await repo.complete_sale(acc_id, 8))["result"] == "unavailable"
+        sale = await repo.complete_sale(acc_id, 7)
+        assert sale["result"] == "sold"
+        assert sale["balance"] == pytest.approx(1.5)
+        assert await repo.get_balance(7) == pytest.approx(1.5)
+        assert await repo.get_balance(8) == pytest.approx(4.0)
+        assert (await repo.get_account(acc_id))["status"] == "sold"
+        assert (await repo.complete_sale(acc_id, 7))["result"] == "unavailable"
+        assert await repo.total_revenue() == pytest.approx(2.5)
+
+    shop(body)
+
+
+def test_short_balance_releases_the_reservation(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        [acc_id] = await _stock(repo, "GB", 1, price=2.5)
+        await repo.get_or_create_user(7, None)
+        await repo.claim_account("GB", {"reserved_by": 7})
+        sale = await repo.complete_sale(acc_id, 7)
+        assert sale["result"] == "insufficient"
+        assert (await repo.get_account(acc_id))["status"] == "available"
+
+    shop(body)
+
+
+@pytest.mark.parametrize("group_commit", [True, False])
+def test_deductions_never_go_below_zero(shop, group_commit):
+
+    async def body(tenant):
+        repo = tenant.repo
+        await repo.get_or_create_user(1, None)
+        await repo.set_balance(1, 3.0)
+        results = await asyncio.gather(*(repo.adjust_balance(
+            1, -1.0, "admin_deduct") for _ in range(5)))
+        assert sum(ok for ok, _ in results) == 3
+        assert await repo.get_balance(1) == pytest.approx(0.0)
+        assert await repo.adjust_balance(99, 1.0, "deposit") == (False, None)
+
+    shop(body, group_commit)
+
+
+def test_fast_path_reserves_in_one_step_and_remembers_the_country(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        [acc_id] = await _stock(repo, "GB", 1, price=2.5)
+        poor = await repo.reserve_for_buyer(8, "poor", "GB", 2.5,
+                                            {"reserved_by": 8})
+        assert poor["result"] == "insufficient" and poor["account"] is None
+        assert poor["user"]["username"] == "poor"  # created on the way
+        await repo.get_or_create_user(7, "buyer")
+        await repo.set_balance(7, 4.0)
+        held = await repo.reserve_for_buyer(7, "Buyer", "GB", 2.5,
+                                            {"reserved_by": 7})
+        assert held["result"] == "reserved"
+        assert held["account"][0] == acc_id
+        assert held["user"]["username"] == "Buyer"
+        again = await repo.reserve_for_buyer(7, "Buyer", "GB", 2.5,
+                                             {"reserved_by": 7})
+        assert again["result"] == "unavailable"
+        assert (await repo.complete_sale(acc_id, 7))["result"] == "sold"
+        user = await repo.get_or_create_user(7, "Buyer")
+        assert user["last_country"] == "GB"
+
+    shop(body)
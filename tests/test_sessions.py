@@ -0,0 +1,85 @@
+import os
+
+import aiosqlite
+import pytest
+from telethon.crypto import AuthKey
+from telethon.sessions import SQLiteSession, StringSession
+
+import main
+
+
+@pytest.fixture
+def session_dir(tmp_path, monkeypatch):
+    directory = tmp_path / "sessions"
+    directory.mkdir()
+    monkeypatch.setattr(main, "SESSION_DIR", str(directory))
+    monkeypatch.setattr(main, "SESSION_STORE", main.SessionStore(2))
+    return directory
+
+
+def _session_file(path, authorized=True):
+    sess = SQLiteSession(str(path))
+    sess.set_dc(2, "149.154.167.51", 443)
+    if authorized:
+        sess.auth_key = AuthKey(os.urandom(256))
+    sess.save()
+    sess.close()
+
+
+async def _stored_names(db_path):
+    async with aiosqlite.connect(db_path) as db:
+        cur = await db.execute("SELECT name FROM sessions ORDER BY name")
+        return [r[0] for r in await cur.fetchall()]
+
+
+def _cached(store):
+    """Cached session names, least recently used first."""
+    return [name for _, name in store._cache]
+
+
+def test_store_caches_and_writes_through(shop, session_dir):
+
+    async def body(tenant):
+        store = main.SessionStore(2)
+        for name in ("a", "b", "c"):
+            await store.put(f"{name}.session", f"data-{name}")
+        assert _cached(store) == ["b.session", "c.session"]  # LRU cap
+        # evicted from the cache, still in the table
+        assert await store.get("a.session") == "data-a"
+        assert _cached(store) == ["c.session", "a.session"]
+        await store.delete("a.session")
+        assert await store.get("a.session") is None
+        assert await _stored_names(tenant.db_path) == ["b.session", "c.session"]
+
+    shop(body)
+
+
+def test_migration_imports_authorized_files_once(shop, session_dir):
+    _session_file(session_dir / "good.session")
+    _session_file(session_dir / "empty.session", authorized=False)
+
+    async def body(tenant):
+        report = await main.migrate_session_files()
+        assert report == {"migrated": 1, "skipped": 0, "failed": 1}
+        assert await _stored_names(tenant.db_path) == ["good.session"]
+        again = await main.migrate_session_files()
+        assert again == {"migrated": 0, "skipped": 1, "failed": 1}
+        # the legacy files stay as a backup
+        assert (session_dir / "good.session").exists()
+
+    shop(body)
+
+
+def test_build_client_imports_a_legacy_file_lazily(shop, session_dir):
+    _session_file(session_dir / "old.session")
+
+    async def body(tenant):
+        client = await main.build_client("old.session")
+        assert isinstance(client.session, StringSession)
+        assert client.session.auth_key is not None
+        assert await _stored_names(tenant.db_path) == ["old.session"]
+        await main.discard_session("old.session")
+        assert await _stored_names(tenant.db_path) == []
+        assert not (session_dir / "old.session").exists()
+
+    shop(body)
@@ -0,0 +1,141 @@
+import asyncio
+
+import aiosqlite
+import pytest
+
+import main
+
+
+def run_writer(tmp_path, body, max_ops=64, max_delay_ms=20,
+               durability="normal"):
+    """await body(writer, path) with a started SqliteWriter over table t(x)."""
+    path = str(tmp_path / "w.db")
+
+    async def runner():
+        async with aiosqlite.connect(path) as db:
+            await db.execute("CREATE TABLE t (x INTEGER UNIQUE)")
+            await db.commit()
+        writer = main.SqliteWriter(path, max_ops, max_delay_ms, durability)
+        await writer.start()
+        try:
+            return await body(writer, path)
+        finally:
+            await writer.stop()
+
+    return asyncio.run(runner())
+
+
+def insert(x):
+
+    async def op(db):
+        await db.execute("INSERT INTO t (x) VALUES (?)", (x, ))
+        return x
+
+    return op
+
+
+async def stored(path):
+    async with aiosqlite.connect(path) as db:
+        cur = await db.execute("SELECT x FROM t ORDER BY x")
+        return [r[0] for r in await cur.fetchall()]
+
+
+def test_concurrent_writes_share_one_commit(tmp_path):
+
+    async def body(writer, path):
+        results = await asyncio.gather(*(writer.submit(insert(i))
+                                         for i in range(10)))
+        assert results == list(range(10))
+        assert writer.stats()["commits"] == 1
+        assert writer.stats()["max_batch"] == 10
+        assert await stored(path) == list(range(10))
+
+    run_writer(tmp_path, body)
+
+
+def test_batches_are_capped_at_max_ops(tmp_path):
+
+    async def body(writer, path):
+        await asyncio.gather(*(writer.submit(insert(i)) for i in range(10)))
+        assert writer.stats()["commits"] == 3
+        assert writer.stats()["max_batch"] == 4
+
+    run_writer(tmp_path, body, max_ops=4)
+
+
+def test_failing_op_is_rolled_back_alone(tmp_path):
+
+    async def half_then_fail(db):
+        await db.execute("INSERT INTO t (x) VALUES (100)")
+        await db.execute("INSERT INTO t (x) VALUES (1)")  # duplicate of op 1
+
+    async def body(writer, path):
+        results = await asyncio.gather(writer.submit(insert(1)),
+                                       writer.submit(half_then_fail),
+                                       writer.submit(insert(2)),
+                                       return_exceptions=True)
+        assert results[0] == 1 and results[2] == 2
+        assert isinstance(results[1], aiosqlite.IntegrityError)
+        # 100 was written inside the failing op's savepoint: gone with it
+        assert await stored(path) == [1, 2]
+        stats = writer.stats()
+        assert (stats["commits"], stats["failed"]) == (1, 1)
+
+    run_writer(tmp_path, body)
+
+
+def test_callers_resolve_only_after_commit(tmp_path):
+
+    async def body(writer, path):
+        tasks = [asyncio.create_task(writer.submit(insert(i)))
+                 for i in range(5)]
+        execute = writer._db.execute
+        at_commit = []
+
+        async def watched(sql, *args):
+            if sql == "COMMIT":
+                at_commit.append([t.done() for t in tasks])
+                assert await stored(path) == []  # not visible before COMMIT
+            return await execute(sql, *args)
+
+        writer._db.execute = watched
+        await asyncio.gather(*tasks)
+        assert at_commit == [[False] * 5]
+        assert await stored(path) == list(range(5))
+
+    run_writer(tmp_path, body)
+
+
+def test_failed_commit_fails_every_caller(tmp_path):
+
+    async def body(writer, path):
+        execute = writer._db.execute
+
+        async def failing(sql, *args):
+            if sql == "COMMIT":
+                raise aiosqlite.OperationalError("disk I/O error")
+            return await execute(sql, *args)
+
+        writer._db.execute = failing
+        results = await asyncio.gather(*(writer.submit(insert(i))
+                                         for i in range(3)),
+                                       return_exceptions=True)
+        assert all(isinstance(r, aiosqlite.OperationalError) for r in results)
+        writer._db.execute = execute
+        assert await stored(path) == []
+        assert writer.stats()["commits"] == 0
+
+    run_writer(tmp_path, body)
+
+
+@pytest.mark.parametrize("durability, synchronous", [("full", 2),
+                                                     ("normal", 1)])
+def test_durability_sets_synchronous(tmp_path, durability, synchronous):
+
+    async def body(writer, path):
+        cur = await writer._db.execute("PRAGMA synchronous")
+        assert (await cur.fetchone())[0] == synchronous
+        cur = await writer._db.execute("PRAGMA journal_mode")
+        assert (await cur.fetchone())[0] == "wal"
+
+    run_writer(tmp_path, body, durability=durability)
@@ -0,0 +1,67 @@
+import asyncio
+
+import aiosqlite
+
+import main
+
+RESULTS = {"ok.session": True, "dead.session": False}
+
+
+async def _check(session_file):
+    if session_file not in RESULTS:
+        raise ConnectionError("unreachable")
+    return RESULTS[session_file]
+
+
+def test_sweep_marks_revoked_sessions_dead(shop, monkeypatch):
+    monkeypatch.setitem(main.CONFIG, "SWEEP_JITTER_SECONDS", 0)
+    monkeypatch.setattr(main, "check_session_active", _check)
+
+    async def body(tenant):
+        async with aiosqlite.connect(tenant.db_path) as db:
+            await db.executemany(
+                "INSERT INTO accounts (country_code, phone_number, session_file, status) "
+                "VALUES ('US', ?, ?, 'available')",
+                [("+1", "ok.session"), ("+2", "dead.session"),
+                 ("+3", "error.session"), ("+4", None)])
+            await db.commit()
+        report = await main.sweep_sessions_tick()
+        assert (report["checked"], report["ok"], report["dead"],
+                report["errors"]) == (4, 1, 2, 1)
+        async with aiosqlite.connect(tenant.db_path) as db:
+            cur = await db.execute(
+                "SELECT phone_number, status, last_check_result FROM accounts ORDER BY id")
+            rows = await cur.fetchall()
+        assert rows == [("+1", "available", "ok"), ("+2", "dead", "dead"),
+                        ("+3", "available", "error"), ("+4", "dead", "dead")]
+        # checked accounts are not checked again before SWEEP_RECHECK_HOURS
+        assert (await main.sweep_sessions_tick())["checked"] == 0
+
+    shop(body)
+
+
+def test_breaker_and_capacity_skips_are_reported_apart(monkeypatch):
+    monkeypatch.setitem(main.CONFIG, "SWEEP_JITTER_SECONDS", 0)
+    breakers = main.CircuitBreakers(1, 60, 60, 0, 60, 60)
+    monkeypatch.setattr(main, "BREAKERS", breakers)
+    gate = main.CapacityGate(1, 10)
+    monkeypatch.setattr(main, "CAPACITY", gate)
+
+    async def body():
+        sem = asyncio.Semaphore(5)
+        await breakers.record("cooling.session", "ConnectionError: boom")
+        assert await main._sweep_one(sem, 1, "cooling.session") == "breaker"
+        assert gate.try_acquire()  # no slot left for the sweep
+        assert await main._sweep_one(sem, 2, "other.session") == "skipped"
+
+    asyncio.run(body())
+
+
+def test_report_text_has_a_breaker_line():
+    text = main.sweep_report_text({
+        "finished_at": "2026-10-19T10:00:00", "checked": 3, "ok": 2,
+        "dead": 1, "errors": 0, "skipped": 4, "breaker": 5,
+        "duration": 1.0, "failure_rate": 1 / 3
+    })
+    assert "skipped (no capacity) 4\n" in text
+    assert "• held back by circuit breakers: 5\n" in text
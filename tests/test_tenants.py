@@ -0,0 +1,138 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def _tenant(tmp_path, name, slot, admin):
+    config = dict(main.TENANTS[0].config, ADMIN_IDS=[admin],
+                  BOT_TOKEN=f"{100 + slot}:{name}")
+    path = str(tmp_path / f"{name}.db")
+    tenant = main.Tenant(name, slot, config, path, None)
+    tenant.repo = main.SqliteRepository(path)
+    return tenant
+
+
+@pytest.fixture
+def tenants(tmp_path, monkeypatch):
+    """run(body): await body(first, second) with two initialised tenants."""
+    first = _tenant(tmp_path, "first", 0, 1)
+    second = _tenant(tmp_path, "second", 2, 2)
+    monkeypatch.setattr(main, "TENANTS", [first, second])
+
+    def run(body):
+
+        async def runner():
+            for tenant in (first, second):
+                with main.use_tenant(tenant):
+                    await main.init_db()
+                    await tenant.repo.init()
+            try:
+                return await body(first, second)
+            finally:
+                for tenant in (first, second):
+                    await tenant.repo.close()
+
+        return asyncio.run(runner())
+
+    return run
+
+
+async def _add_account(country_code="US"):
+    return await main.REPO.add_account(country_code, "+15550001",
+                                       "a.session", None, 1, 1.0)
+
+
+def test_ids_start_at_the_tenant_slot(tenants):
+
+    async def body(first, second):
+        with main.use_tenant(first):
+            assert await _add_account() == 1
+            assert await main.upload_create(1, "US") == 1
+        with main.use_tenant(second):
+            base = 2 * main.TENANT_ID_SPAN
+            assert await _add_account() == base + 1
+            assert await _add_account() == base + 2
+            assert await main.upload_create(2, "US") == base + 1
+        # re-running init_db never moves a sequence back
+        with main.use_tenant(second):
+            await main.init_db()
+            assert await _add_account() == base + 3
+
+    tenants(body)
+
+
+def test_repo_and_config_follow_the_bound_tenant(tenants):
+
+    async def body(first, second):
+        with main.use_tenant(second):
+            acc_id = await _add_account()
+            await main.REPO.get_or_create_user(5, "buyer")
+            assert main.tenant_config("ADMIN_IDS") == [2]
+        with main.use_tenant(first):
+            assert await main.REPO.get_account(acc_id) is None
+            assert await main.REPO.count_users() == 0
+            assert main.tenant_config("ADMIN_IDS") == [1]
+        assert await second.repo.count_users() == 1
+        # outside any binding, code sees the first tenant
+        assert main.current_tenant() is first
+
+    tenants(body)
+
+
+def test_jobs_run_once_per_tenant_and_updates_bind_theirs(tenants):
+
+    async def body(first, second):
+        seen = []
+
+        async def job():
+            seen.append(main.current_tenant().name)
+            if main.current_tenant() is first:
+                raise RuntimeError("one tenant failing does not stop the rest")
+
+        await main.for_each_tenant(job)()
+        assert seen == ["first", "second"]
+
+        async def handle():
+            context = SimpleNamespace(application=SimpleNamespace(
+                bot_data={"tenant": second}))
+            await main.bind_tenant(None, context)
+            return main.current_tenant()
+
+        # the binding stays inside the update's task
+        assert await asyncio.create_task(handle()) is second
+        assert main.current_tenant() is first
+        assert second.usage["updates"] == 1
+
+    tenants(body)
+
+
+def test_tenants_file(tmp_path, monkeypatch):
+    path = tmp_path / "tenants.json"
+    path.write_text(json.dumps([
+        {"name": "main"},
+        {"name": "shop2", "bot_token": "222:b", "admin_ids": ["7"],
+         "country_prices": {"US": 45.0}},
+    ]))
+    monkeypatch.setitem(main.CONFIG, "TENANTS_FILE", str(path))
+    monkeypatch.setattr(main, "DB_PATH", str(tmp_path / "shop.db"))
+    main_, shop2 = main.load_tenants()
+    assert (main_.slot, main_.db_path, main_.pg_schema) == (
+        0, str(tmp_path / "shop.db"), None)
+    assert (shop2.slot, shop2.db_path, shop2.pg_schema) == (
+        1, str(tmp_path / "shop_shop2.db"), "tenant_shop2")
+    assert shop2.id_base == main.TENANT_ID_SPAN
+    assert shop2.config["ADMIN_IDS"] == [7]
+    assert shop2.config["COUNTRY_PRICES"] == {"US": 45.0}
+    assert main_.config["COUNTRY_PRICES"] == main.CONFIG["COUNTRY_PRICES"]
+    assert shop2.bot_key == "222"
+
+    path.write_text(json.dumps([{"name": "a"}, {"name": "b", "slot": 0}]))
+    with pytest.raises(ValueError, match="slot"):
+        main.load_tenants()
+    path.write_text(json.dumps([{"name": "Bad-Name"}]))
+    with pytest.raises(ValueError, match="Invalid tenant name"):
+        main.load_tenants()
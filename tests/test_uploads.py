@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_upload_walks_the_state_machine(shop):
+
+    async def body(tenant):
+        upload_id = await main.upload_create(42, "US")
+        await main.upload_update(upload_id, state="otp", phone_number="+1555")
+        await main.upload_update(upload_id, state="2fa")
+        upload = await main.upload_get(upload_id)
+        assert upload["state"] == "2fa"
+        assert upload["phone_number"] == "+1555"
+        assert (await main.upload_for_message(42, None))["id"] == upload_id
+        await main.upload_update(upload_id, state="done")
+        assert await main.upload_for_message(42, None) is None
+        assert await main.REPO.uploads_active(42) == []
+
+    shop(body)
+
+
+def test_invalid_transition_is_rejected(shop):
+
+    async def body(tenant):
+        upload_id = await main.upload_create(42, "US")
+        with pytest.raises(ValueError, match="phone -> done"):
+            await main.upload_update(upload_id, state="done")
+        assert (await main.upload_get(upload_id))["state"] == "phone"
+
+    shop(body)
+
+
+def test_replies_pick_the_upload_of_their_prompt(shop):
+
+    async def body(tenant):
+        first = await main.upload_create(42, "US")
+        second = await main.upload_create(42, "GB")
+        await main.upload_update(first, prompt_message_id=100)
+        await main.upload_update(second, prompt_message_id=200)
+        assert (await main.upload_for_message(42, 100))["id"] == first
+        # not a reply to a prompt: the most recently updated upload
+        assert (await main.upload_for_message(42, None))["id"] == second
+        assert await main.upload_for_message(7, 100) is None
+
+    shop(body)
+
+
+def test_concurrent_steps_move_the_upload_once(shop):
+
+    async def body(tenant):
+        upload_id = await main.upload_create(42, "US")
+        results = await asyncio.gather(
+            main.upload_update(upload_id, state="cancelled"),
+            main.upload_update(upload_id, state="failed"),
+            return_exceptions=True)
+        failures = [r for r in results if isinstance(r, ValueError)]
+        assert len(failures) == 1
+        state = (await main.upload_get(upload_id))["state"]
+        assert state == ("cancelled" if results[0] is None else "failed")
+
+    shop(body)
+
+
+def test_expired_uploads_are_listed(shop):
+
+    async def body(tenant):
+        upload_id = await main.upload_create(42, "US")
+        await main.REPO.upload_update(upload_id,
+                                      {"expires_at": "2000-01-01 00:00:00"})
+        expired = await main.REPO.uploads_expired(main.now_iso())
+        assert [u["id"] for u in expired] == [upload_id]
+
+    shop(body)
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.disconnected = False
+
+    async def disconnect(self):
+        self.disconnected = True
+
+
+def test_cancel_after_finish_leaves_account_and_client(shop, monkeypatch):
+    discarded = []
+
+    async def discard(session_file):
+        discarded.append(session_file)
+
+    monkeypatch.setattr(main, "discard_session", discard)
+
+    async def body(tenant):
+        upload_id = await main.upload_create(42, "US")
+        await main.upload_update(upload_id, state="otp", phone_number="+1555",
+                                 session_file="US_1555.session")
+        await main.upload_update(upload_id, state="note_2fa")
+        upload = await main.upload_get(upload_id)
+        upload["account_id"] = await main.upload_add_account(upload)
+        client = FakeClient()
+        main.UPLOAD_CLIENTS[upload_id] = client
+        try:
+            # the upload expired ("done") under a stale copy the admin cancels
+            await main.upload_update(upload_id, state="done")
+            with pytest.raises(ValueError, match="done -> cancelled"):
+                await main.cancel_upload(upload)
+            assert main.UPLOAD_CLIENTS[upload_id] is client
+            assert not client.disconnected
+            assert discarded == []
+            assert await main.REPO.get_account(upload["account_id"])
+        finally:
+            main.UPLOAD_CLIENTS.pop(upload_id, None)
+
+    shop(body)
+
+
+def test_finish_releases_the_client_after_moving_on(shop, monkeypatch):
+    discarded = []
+
+    async def discard(session_file):
+        discarded.append(session_file)
+
+    monkeypatch.setattr(main, "discard_session", discard)
+    released = []
+    monkeypatch.setattr(main.CAPACITY, "release", lambda: released.append(1))
+
+    async def body(tenant):
+        upload_id = await main.upload_create(42, "US")
+        await main.upload_update(upload_id, state="otp",
+                                 session_file="US_1555.session")
+        upload = await main.upload_get(upload_id)
+        client = FakeClient()
+        main.UPLOAD_CLIENTS[upload_id] = client
+        await main.cancel_upload(upload)
+        assert upload_id not in main.UPLOAD_CLIENTS
+        assert client.disconnected and released == [1]
+        assert discarded == ["US_1555.session"]
+        assert (await main.upload_get(upload_id))["state"] == "cancelled"
+
+    shop(body)
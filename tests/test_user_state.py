@@ -0,0 +1,80 @@
+import json
+
+from telegram.ext import ApplicationBuilder
+
+import main
+
+
+def _persistence(repo, max_resident=1):
+    persistence = main.UserStatePersistence(repo, 60, 3600, max_resident)
+    app = ApplicationBuilder().token("0:test").persistence(persistence).build()
+    persistence.application = app
+    return persistence, app
+
+
+async def _update(persistence, app, user_id, **changes):
+    """What Application.process_update does around a handler."""
+    await persistence.refresh_user_data(user_id, app.user_data[user_id])
+    app.user_data[user_id].update(changes)
+    app.mark_data_for_update_persistence(user_ids=user_id)
+
+
+async def _stored(repo, user_id):
+    text = (await repo.user_state_get_many([user_id])).get(user_id)
+    return json.loads(text) if text else None
+
+
+def test_evicted_user_is_written_and_rehydrated(shop):
+
+    async def body(tenant):
+        persistence, app = _persistence(tenant.repo)
+        await _update(persistence, app, 1, menu="countries")
+        await app.update_persistence()
+        await _update(persistence, app, 2, menu="balance")  # evicts 1
+        await app.update_persistence()
+        await persistence.flush()
+        assert 1 not in app.user_data
+        assert await _stored(tenant.repo, 1) == {"menu": "countries"}
+        await _update(persistence, app, 1, page=2)
+        assert app.user_data[1] == {"menu": "countries", "page": 2}
+        assert persistence.stats()["evictions"] == 2
+
+    shop(body)
+
+
+def test_changes_after_eviction_survive_the_next_persistence_update(shop):
+
+    async def body(tenant):
+        persistence, app = _persistence(tenant.repo)
+        await _update(persistence, app, 1, step=1)
+        await app.update_persistence()
+        await _update(persistence, app, 2, step=1)  # evicts 1
+        # 1 is back before PTB has processed the eviction
+        await _update(persistence, app, 1, step=2)
+        await app.update_persistence()
+        await persistence.flush()
+        assert await _stored(tenant.repo, 1) == {"step": 2}
+        await _update(persistence, app, 2, step=2)  # evicts 1 again
+        await app.update_persistence()
+        await persistence.flush()
+        assert await _stored(tenant.repo, 1) == {"step": 2}
+        assert await _stored(tenant.repo, 2) == {"step": 2}
+
+    shop(body)
+
+
+def test_returning_user_changes_are_written_without_another_update(shop):
+
+    async def body(tenant):
+        persistence, app = _persistence(tenant.repo)
+        await _update(persistence, app, 1, step=1)
+        await _update(persistence, app, 2, step=1)  # evicts 1
+        await _update(persistence, app, 1, step=2)  # evicts 2
+        # one persistence update and no further updates from 1
+        await app.update_persistence()
+        await persistence.flush()
+        assert await _stored(tenant.repo, 1) == {"step": 2}
+        assert await _stored(tenant.repo, 2) == {"step": 1}
+        assert app.user_data[1] == {"step": 2}
+
+    shop(body)
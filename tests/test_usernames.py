@@ -0,0 +1,56 @@
+import main
+
+
+def _resolver(monkeypatch, size=10):
+    resolver = main.UsernameResolver(size)
+    monkeypatch.setattr(main, "USERNAMES", resolver)
+    return resolver
+
+
+def test_ids_and_names_resolve_case_insensitively(shop, monkeypatch):
+
+    async def body(tenant):
+        resolver = _resolver(monkeypatch)
+        await tenant.repo.get_or_create_user(5, "Alice")
+        assert await resolver.resolve("42") == 42
+        assert await resolver.resolve("@ALICE") == 5
+        assert (resolver.hits, resolver.misses) == (0, 1)
+        assert await resolver.resolve("alice") == 5
+        assert (resolver.hits, resolver.misses) == (1, 1)
+        assert await resolver.resolve("@nobody") is None
+        assert await resolver.resolve("@") is None
+
+    shop(body)
+
+
+def test_renamed_user_moves_the_name(shop, monkeypatch):
+
+    async def body(tenant):
+        resolver = _resolver(monkeypatch)
+        await main.get_user(5, "alice")
+        assert await resolver.resolve("alice") == 5
+        await main.get_user(5, "alice2")
+        # the old name is free, in the cache and in the table
+        assert await resolver.resolve("alice") is None
+        assert await resolver.resolve("alice2") == 5
+        await main.get_user(6, "Alice2")
+        assert await resolver.resolve("alice2") == 6
+        assert (await main.get_user(5, None))["username"] is None
+        assert await tenant.repo.find_user_id("ALICE2") == 6
+
+    shop(body)
+
+
+def test_cache_is_bounded(shop, monkeypatch):
+
+    async def body(tenant):
+        resolver = _resolver(monkeypatch, size=2)
+        for user_id, name in ((1, "a"), (2, "b"), (3, "c")):
+            await main.get_user(user_id, name)
+        assert list(resolver._ids) == ["b", "c"]
+        assert set(resolver._names) == {2, 3}
+        # evicted names still resolve from the database
+        assert await resolver.resolve("a") == 1
+        assert resolver.misses == 1
+
+    shop(body)
@@ -0,0 +1,99 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+
+class FakeBot:
+    """Records (user_id, text) of what the notifier sends; user 13 blocked the bot."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == 13:
+            raise RuntimeError("bot was blocked by the user")
+        self.sent.append((chat_id, text))
+
+
+def _bot(tenant) -> FakeBot:
+    bot = FakeBot()
+    tenant.app = SimpleNamespace(bot=bot)
+    return bot
+
+
+async def _stock(repo, country_code: str, n: int):
+    for i in range(n):
+        await repo.add_account(country_code, f"+1555000{i:04d}",
+                               f"{country_code}_{i}.session", None, 1, 1.0)
+
+
+def test_waitlist_positions_follow_join_order(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        assert [await repo.waitlist_add("US", uid)
+                for uid in (10, 11, 12)] == [1, 2, 3]
+        assert await repo.waitlist_add("US", 10) == 1  # joining twice is a no-op
+        assert await repo.waitlist_add("GB", 12) == 1
+        assert await repo.waitlist_pop("US", 2) == [10, 11]
+        assert await repo.waitlist_add("US", 10) == 2
+        assert sorted(await repo.waitlist_counts()) == [("GB", 1), ("US", 2)]
+
+    shop(body)
+
+
+def test_restocks_are_batched_and_capped_at_availability(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        sent = _bot(tenant).sent
+        notifier = main.RestockNotifier(0.05)
+        for uid in (10, 11, 12, 13, 14):
+            await repo.waitlist_add("US", uid)
+        await repo.waitlist_add("GB", 20)
+        await _stock(repo, "US", 3)
+        for _ in range(4):  # one unit was bought again before the batch ran
+            notifier.note("US")
+        await asyncio.sleep(0.01)
+        assert notifier.pending == {(tenant, "US"): 4} and sent == []
+        await notifier._task
+        assert notifier.batches == 1
+        assert [uid for uid, _ in sent] == [10, 11, 12]
+        assert "US numbers are back in stock" in sent[0][1]
+        assert await repo.waitlist_pop("US", 10) == [13, 14]
+        assert await repo.waitlist_pop("GB", 10) == [20]
+
+    shop(body)
+
+
+def test_failed_sends_are_counted_and_not_retried(shop):
+
+    async def body(tenant):
+        repo = tenant.repo
+        _bot(tenant)
+        notifier = main.RestockNotifier(0)
+        for uid in (12, 13):
+            await repo.waitlist_add("US", uid)
+        await _stock(repo, "US", 2)
+        notifier.note("US", 2)
+        await notifier._task
+        assert notifier.stats() == {"pending": {}, "batches": 1,
+                                    "notified": 1, "failed": 1}
+        assert await repo.waitlist_pop("US", 10) == []
+
+    shop(body)
+
+
+def test_nothing_is_sent_while_sold_out(shop):
+
+    async def body(tenant):
+        sent = _bot(tenant).sent
+        notifier = main.RestockNotifier(0)
+        await tenant.repo.waitlist_add("US", 10)
+        notifier.note("US")
+        await notifier._task
+        assert sent == [] and notifier.batches == 0
+        assert await tenant.repo.waitlist_pop("US", 10) == [10]
+
+    shop(body)
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+
+import main
+
+
+def test_percentiles_come_from_the_histogram():
+    watchdog = main.LoopWatchdog(0.1, 0.5)
+    assert watchdog.percentile(0.99) == 0
+    for lag in [0.0005] * 98 + [0.03, 10.0]:
+        watchdog.record(lag)
+    stats = watchdog.stats()
+    assert stats["samples"] == 100
+    assert stats["p50"] == main.LAG_BUCKETS_MS[0]
+    assert stats["p99"] == next(b for b in main.LAG_BUCKETS_MS if b >= 30)
+    assert watchdog.percentile(1.0) is None  # above the largest bucket
+    assert stats["max_ms"] == 10000.0
+
+
+def _block_the_loop(seconds):
+    time.sleep(seconds)
+
+
+def test_a_blocked_loop_is_reported_once_with_its_stack():
+
+    async def body():
+        watchdog = main.LoopWatchdog(0.02, 0.1)
+        watchdog.start()
+        try:
+            await asyncio.sleep(0.1)
+            _block_the_loop(0.5)
+            await asyncio.sleep(0.1)
+        finally:
+            await watchdog.stop()
+        return watchdog
+
+    watchdog = asyncio.run(body())
+    assert watchdog.stalls == 1
+    assert watchdog.last_stall["where"].startswith("test_watchdog.py:")
+    assert watchdog.last_stall["where"].endswith(" _block_the_loop")
+    assert watchdog.max_lag >= 0.3
+
+
+def test_expired_reservations_are_found_off_the_loop():
+    now = datetime.now(main.IST)
+
+    def meta(**kwargs):
+        return json.dumps(kwargs)
+
+    rows = [
+        (1, meta(reserved_until=(now - timedelta(minutes=1)).isoformat())),
+        (2, meta(reserved_until=(now + timedelta(minutes=5)).isoformat())),
+        (3, meta(reserved_until=(now - timedelta(minutes=1)).replace(
+            tzinfo=None).isoformat())),  # naive: read as IST
+        (4, "{not json"),
+        (5, meta(reserved_by=7)),
+        (6, None),
+    ]
+    assert main.expired_reservations(rows) == [1, 3, 4]